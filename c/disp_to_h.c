@@ -72,7 +72,8 @@ void disp_to_lonlatalt(double *lonlatalt, float *err,  // outputs
                  float *msk_orig, int w, int h,
                  double ha[9], double hb[9],
                  struct rpc *rpca, struct rpc *rpcb,
-                 float orig_img_bounding_box[4])
+                 float orig_img_bounding_box[4],
+                 int nthreads)  // number of OpenMP threads
 {
     // invert homographies
     double ha_inv[9];
@@ -86,27 +87,25 @@ void disp_to_lonlatalt(double *lonlatalt, float *err,  // outputs
     float row_min = orig_img_bounding_box[2];
     float row_max = orig_img_bounding_box[3];
 
-    // initialize output images to nan
+    // loop over all the pixels of the input disp map, by blocks of rows
+    // a 3D point is produced for each non-masked disparity
+    #pragma omp parallel for schedule(dynamic, 8) num_threads(nthreads > 0 ? nthreads : 1)
     for (int row = 0; row < ny; row++)
     for (int col = 0; col < nx; col++) {
         int pix = col + nx*row;
+
+        // initialize output images to nan
         err[pix] = NAN;
         for (int k = 0; k < 3; k++)
             lonlatalt[3 * pix + k] = NAN;
-    }
-
-    // intermediate buffers
-    double p[2], q[2], lonlat[2];
-    double e, z;
 
-    // loop over all the pixels of the input disp map
-    // a 3D point is produced for each non-masked disparity
-    for (int row = 0; row < ny; row++)
-    for (int col = 0; col < nx; col++) {
-        int pix = col + nx*row;
         if (!msk[pix])
             continue;
 
+        // intermediate buffers
+        double p[2], q[2], lonlat[2];
+        double e, z;
+
         // compute coordinates of pix in the full reference image
         double a[2] = {col, row};
         apply_homography(p, ha_inv, a);
@@ -149,9 +148,11 @@ float squared_distance_between_3d_points(double a[3], double b[3])
 }
 
 
-void count_3d_neighbors(int *count, double *xyz, bool *mask, int nx, int ny, float r, int p)
+void count_3d_neighbors(int *count, double *xyz, bool *mask, int nx, int ny, float r, int p,
+                        int nthreads)
 {
-    // count the 3d neighbors of each point
+    // count the 3d neighbors of each point, by blocks of rows
+    #pragma omp parallel for schedule(dynamic, 8) num_threads(nthreads > 0 ? nthreads : 1)
     for (int y = 0; y < ny; y++)
     for (int x = 0; x < nx; x++) {
         int pos = x + nx * y;
@@ -186,7 +187,8 @@ void remove_isolated_3d_points(
     float r,     // filtering radius, in meters
     int p,       // filtering window (square of width is 2p+1 pixels)
     int n,       // minimal number of neighbors to be an inlier
-    int q)       // neighborhood for the saving step (square of width 2q+1)
+    int q,       // neighborhood for the saving step (square of width 2q+1)
+    int nthreads)  // number of OpenMP threads
 {
     int *count = (int*) malloc(nx * ny * sizeof(int));
     bool *rejected = (bool*) malloc(nx * ny * sizeof(bool));
@@ -196,7 +198,7 @@ void remove_isolated_3d_points(
         mask[i] = isfinite(xyz[i * 3]);
 
     // count the 3d neighbors of each point
-    count_3d_neighbors(count, xyz, mask, nx, ny, r, p);
+    count_3d_neighbors(count, xyz, mask, nx, ny, r, p, nthreads);
 
     // brutally reject any point with less than n neighbors
     for (int i = 0; i < ny * nx; i++)
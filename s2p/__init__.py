@@ -26,11 +26,11 @@ import multiprocessing
 import tempfile
 import logging
 from typing import List
-import subprocess
+import shutil
 
 import numpy as np
+import affine
 import rasterio
-import rasterio.merge
 from plyflatten import plyflatten_from_plyfiles_list
 
 from s2p import common
@@ -39,9 +39,15 @@ from s2p import geographiclib
 from s2p import initialization
 from s2p import pointing_accuracy
 from s2p import rectification
+from s2p import rpc_utils
 from s2p import block_matching
 from s2p import masking
 from s2p import ply
+from s2p import compact_cloud
+from s2p import rasterization
+from s2p import mosaic
+from s2p import telemetry
+from s2p import profiling
 from s2p import triangulation
 from s2p import fusion
 from s2p import visualisation
@@ -53,6 +59,9 @@ from .gpu_memory_manager import GPUMemoryManager
 
 logger = logging.getLogger(__name__)
 
+# DSM accumulator of the tiles, written if cfg['direct_rasterization']
+ACCUMULATOR_NAME = 'dsm_accumulator.tif'
+
 
 def pointing_correction(cfg, tile: Tile, i) -> bool:
     """
@@ -176,11 +185,20 @@ def triangulation_iterative(rpc1, rpc2, x1, y1, x2, y2, A=None):
     return lon, lat, h, err
 
 
-def refine_matches(rpcA, rpcB, matches, A, max_altitude_span, altitude_margin):
+def refine_matches(rpcA, rpcB, matches, A, max_altitude_span, altitude_margin,
+                   max_localization_error=None):
 
     if (matches is None) or (len(matches) == 0):
         return matches
 
+    if max_localization_error is not None:
+        # the iterations localize all the matches several times: interpolate
+        # the localization function on the bounding box of the matches
+        (x, y), (w, h) = matches[:, :2].min(axis=0), np.ptp(matches[:, :2], axis=0)
+        rpcA = rpc_utils.LocalizationGrid(rpcA, x, y, w, h,
+                                          *rpc_utils.altitude_range_coarse(rpcA),
+                                          max_error=max_localization_error)
+
     lon, lat, alt, err = triangulation_iterative(rpcA, rpcB, matches[:,0] , matches[:,1] , matches[:,2], matches[:,3],(A))
 
     mmin, mmed, mmax = np.quantile(alt, [.01, .5, .99])
@@ -192,13 +210,17 @@ def refine_matches(rpcA, rpcB, matches, A, max_altitude_span, altitude_margin):
 
     return matches
 
-def rectification_pair(cfg, tile: Tile, i: int) -> bool:
+def rectify_tile_pair(cfg, tile: Tile, i: int, rect1: str, rect2: str) -> tuple:
     """
-    Rectify a pair of images on a given tile.
+    Rectify a pair of images on a given tile, and write the rectified crops.
 
     Args:
         tile: Tile containing the information needed to process a tile.
         i: index of the processed pair
+        rect1, rect2: paths to the output rectified crops
+
+    Returns:
+        H1, H2, disp_min, disp_max, success (see rectification.rectify_pair)
     """
     out_dir = os.path.join(tile.dir, 'pair_{}'.format(i))
     x, y, w, h = tile.coordinates
@@ -238,17 +260,28 @@ def rectification_pair(cfg, tile: Tile, i: int) -> bool:
                 logger.warning('%s does not exist' % sift_from_neighborhood)
 
     # remove sift matches that triangulate to points that are extreme
-    m = refine_matches(rpc1, rpc2, m, A, cfg['max_altitude_span'], cfg['altitude_margin'])
+    m = refine_matches(rpc1, rpc2, m, A, cfg['max_altitude_span'], cfg['altitude_margin'],
+                       cfg['localization_grid_max_error'])
+
+    return rectification.rectify_pair(cfg, img1, img2, rpc1, rpc2, x, y, w, h,
+                                      rect1, rect2, A, m,
+                                      method=cfg['rectification_method'],
+                                      hmargin=cfg['horizontal_margin'],
+                                      vmargin=cfg['vertical_margin'])
 
+
+def rectification_pair(cfg, tile: Tile, i: int) -> bool:
+    """
+    Rectify a pair of images on a given tile.
+
+    Args:
+        tile: Tile containing the information needed to process a tile.
+        i: index of the processed pair
+    """
+    out_dir = os.path.join(tile.dir, 'pair_{}'.format(i))
     rect1 = os.path.join(out_dir, 'rectified_ref.tif')
     rect2 = os.path.join(out_dir, 'rectified_sec.tif')
-    H1, H2, disp_min, disp_max, success = rectification.rectify_pair(cfg, img1, img2,
-                                                                     rpc1, rpc2,
-                                                                     x, y, w, h,
-                                                                     rect1, rect2, A, m,
-                                                                     method=cfg['rectification_method'],
-                                                                     hmargin=cfg['horizontal_margin'],
-                                                                     vmargin=cfg['vertical_margin'])
+    H1, H2, disp_min, disp_max, success = rectify_tile_pair(cfg, tile, i, rect1, rect2)
 
     if success:
         np.savetxt(os.path.join(out_dir, 'H_ref.txt'), H1, fmt='%12.6f')
@@ -309,24 +342,17 @@ def disparity_range_check(cfg, tile: Tile, i: int):
         return True
 
 
-def stereo_matching(cfg, tile: Tile, i: int, gpu_mem_manager: GPUMemoryManager) -> None:
+def match_tile_pair(cfg, rect1: str, rect2: str, disp: str, mask: str,
+                    disp_min: float, disp_max: float,
+                    gpu_mem_manager: GPUMemoryManager) -> None:
     """
-    Compute the disparity of a pair of images on a given tile.
+    Compute the disparity map and the rejection mask of a rectified pair.
 
     Args:
-        tile: Tile containing the information needed to process a tile.
-        i: index of the processed pair
+        rect1, rect2: paths to the rectified crops
+        disp, mask: paths to the output disparity map and rejection mask
+        disp_min, disp_max: disparity range
     """
-    out_dir = os.path.join(tile.dir, 'pair_{}'.format(i))
-    x, y = tile.coordinates[:2]
-
-    logger.info('estimating disparity on tile {} {} pair {}...'.format(x, y, i))
-    rect1 = os.path.join(out_dir, 'rectified_ref.tif')
-    rect2 = os.path.join(out_dir, 'rectified_sec.tif')
-    disp = os.path.join(out_dir, 'rectified_disp.tif')
-    mask = os.path.join(out_dir, 'rectified_mask.png')
-    disp_min, disp_max = np.loadtxt(os.path.join(out_dir, 'disp_min_max.txt'))
-
     try:
         # block_matching might fail (due to timeout)
         block_matching.compute_disparity_map(cfg, rect1, rect2, disp, mask,
@@ -342,6 +368,27 @@ def stereo_matching(cfg, tile: Tile, i: int, gpu_mem_manager: GPUMemoryManager)
         # TODO: take note of the failed block matching
         logger.exception('block_matching.compute_disparity_map has failed:')
 
+
+def stereo_matching(cfg, tile: Tile, i: int, gpu_mem_manager: GPUMemoryManager) -> None:
+    """
+    Compute the disparity of a pair of images on a given tile.
+
+    Args:
+        tile: Tile containing the information needed to process a tile.
+        i: index of the processed pair
+    """
+    out_dir = os.path.join(tile.dir, 'pair_{}'.format(i))
+    x, y = tile.coordinates[:2]
+
+    logger.info('estimating disparity on tile {} {} pair {}...'.format(x, y, i))
+    rect1 = os.path.join(out_dir, 'rectified_ref.tif')
+    rect2 = os.path.join(out_dir, 'rectified_sec.tif')
+    disp = os.path.join(out_dir, 'rectified_disp.tif')
+    mask = os.path.join(out_dir, 'rectified_mask.png')
+    disp_min, disp_max = np.loadtxt(os.path.join(out_dir, 'disp_min_max.txt'))
+
+    match_tile_pair(cfg, rect1, rect2, disp, mask, disp_min, disp_max, gpu_mem_manager)
+
     if cfg['clean_intermediate']:
         if len(cfg['images']) > 2:
             common.remove(rect1)
@@ -349,6 +396,111 @@ def stereo_matching(cfg, tile: Tile, i: int, gpu_mem_manager: GPUMemoryManager)
 #        common.remove(os.path.join(out_dir, 'disp_min_max.txt'))
 
 
+def stereo_matching_batch(cfg, tiles_pairs: list, max_memory: float = None) -> None:
+    """
+    Compute the disparities of several pairs of image tiles with batched
+    stereoanywhere inference.
+
+    Args:
+        tiles_pairs: list of (tile, i) tuples, i being the index of the
+            processed pair of the tile
+        max_memory (optional): memory budget of a forward pass, in MB
+    """
+    from s2p.sota_correlators.stereoanywhere import disparity
+
+    pairs = []
+    disp_ranges = []
+    for tile, i in tiles_pairs:
+        out_dir = os.path.join(tile.dir, 'pair_{}'.format(i))
+        try:
+            disp_min, disp_max = np.loadtxt(os.path.join(out_dir, 'disp_min_max.txt'))
+        except Exception:
+            logger.exception('cannot read the disparity range of %s, skipping it:', out_dir)
+            continue
+        pairs.append((os.path.join(out_dir, 'rectified_ref.tif'),
+                      os.path.join(out_dir, 'rectified_sec.tif'),
+                      os.path.join(out_dir, 'rectified_disp.tif'),
+                      os.path.join(out_dir, 'rectified_mask.png')))
+        disp_ranges.append((int(np.floor(disp_min)), int(np.ceil(disp_max))))
+
+    try:
+        failed = disparity.run_batch(pairs, cfg['mono_ckpt'], cfg['stereo_ckpt'],
+                                     max_batch_size=cfg['stereoanywhere_batch_size'],
+                                     max_memory=max_memory,
+                                     persistent=cfg['stereoanywhere_persistent_engine'],
+                                     disp_ranges=disp_ranges if cfg['stereoanywhere_use_disp_range'] else None,
+                                     flow_tol=cfg['stereoanywhere_flow_tol'])
+    except Exception:
+        logger.exception('stereoanywhere batched inference has failed:')
+        failed = range(len(pairs))
+    pairs = [p for k, p in enumerate(pairs) if k not in failed]
+
+    for rect1, rect2, disp, mask in pairs:
+        try:
+            # add margin around masked pixels
+            masking.erosion(mask, mask, cfg['msk_erosion'])
+        except Exception:
+            logger.exception('masking.erosion has failed on %s:', mask)
+
+        if cfg['clean_intermediate']:
+            if len(cfg['images']) > 2:
+                common.remove(rect1)
+            common.remove(rect2)
+
+
+def tile_pipeline(cfg, tile: Tile, i: int, gpu_mem_manager: GPUMemoryManager) -> bool:
+    """
+    Rectify, match and triangulate a pair of images on a given tile, in a
+    single worker (two input images only).
+
+    The rectified crops, the disparity map and the mask are written to a
+    scratch directory in cfg['temporary_dir'] and removed at the end. Only
+    the point cloud is written to the tile directory, plus the rectification
+    and matching outputs if cfg['tile_pipeline_checkpoints'] is set.
+
+    Args:
+        tile: Tile containing the information needed to process a tile.
+        i: index of the processed pair
+    """
+    out_dir = os.path.join(tile.dir, 'pair_{}'.format(i))
+    x, y = tile.coordinates[:2]
+    remove_accumulator(cfg, tile)
+
+    with tempfile.TemporaryDirectory(dir=os.path.expandvars(cfg['temporary_dir'])) as tmp:
+        rect1 = os.path.join(tmp, 'rectified_ref.tif')
+        rect2 = os.path.join(tmp, 'rectified_sec.tif')
+        disp = os.path.join(tmp, 'rectified_disp.tif')
+        mask = os.path.join(tmp, 'rectified_mask.png')
+        extra = os.path.join(tmp, 'rectified_disp_confidence.tif')
+
+        logger.info('rectifying tile {} {} pair {}...'.format(x, y, i))
+        H1, H2, disp_min, disp_max, success = rectify_tile_pair(cfg, tile, i, rect1, rect2)
+        if not success:
+            return False
+
+        logger.info('estimating disparity on tile {} {} pair {}...'.format(x, y, i))
+        match_tile_pair(cfg, rect1, rect2, disp, mask, disp_min, disp_max, gpu_mem_manager)
+        if not os.path.exists(disp):
+            logger.error(f'input file: {disp}')
+            return False
+
+        logger.info('triangulating tile {} {}...'.format(x, y))
+        triangulate_tile_pair(cfg, tile, H1, H2, rect1, disp, mask,
+                              extra if os.path.exists(extra) else '',
+                              os.path.join(tile.dir, cloud_name(cfg)))
+
+        if cfg['tile_pipeline_checkpoints']:
+            np.savetxt(os.path.join(out_dir, 'H_ref.txt'), H1, fmt='%12.6f')
+            np.savetxt(os.path.join(out_dir, 'H_sec.txt'), H2, fmt='%12.6f')
+            np.savetxt(os.path.join(out_dir, 'disp_min_max.txt'), [disp_min, disp_max],
+                       fmt='%3.1f')
+            for f in [rect1, disp, mask, extra]:
+                if os.path.exists(f):
+                    shutil.copy(f, out_dir)
+
+    return True
+
+
 def disparity_to_height(cfg, tile: Tile, i: int) -> None:
     """
     Compute a height map from the disparity map of a pair of image tiles.
@@ -380,7 +532,8 @@ def disparity_to_height(cfg, tile: Tile, i: int) -> None:
     height_map = triangulation.height_map(x, y, w, h, rpc1, rpc2, H_ref, H_sec,
                                           disp_img, mask_rect_img,
                                           mask_orig_img,
-                                          A=np.loadtxt(pointing))
+                                          A=np.loadtxt(pointing),
+                                          nb_threads=cfg['omp_num_threads'])
 
     # write height map to a file
     common.rasterio_write(os.path.join(out_dir, 'height_map.tif'), height_map)
@@ -392,54 +545,40 @@ def disparity_to_height(cfg, tile: Tile, i: int) -> None:
         common.remove(mask)
 
 
-def disparity_to_ply(cfg, tile: Tile) -> None:
+def triangulate_tile_pair(cfg, tile: Tile, H_ref: np.ndarray, H_sec: np.ndarray,
+                          rect_ref: str, disp: str, mask_rect: str, extra: str,
+                          ply_file: str) -> None:
     """
-    Compute a point cloud from the disparity map of a pair of image tiles.
-
-    This function is called by s2p.main only if there are two input images (not
-    three).
+    Compute a point cloud from the disparity map of a rectified pair of image
+    tiles, and write it to a ply file.
 
     Args:
         tile: Tile containing the information needed to process a tile.
+        H_ref, H_sec: 3x3 numpy arrays with the rectifying homographies
+        rect_ref: path to the rectified reference crop
+        disp, mask_rect: paths to the disparity map and rejection mask
+        extra: path to the disparity confidence map, or ''
+        ply_file: path to the output ply file
     """
-    out_dir = tile.dir
-    ply_file = os.path.join(out_dir, 'cloud.ply')
     x, y, w, h = tile.coordinates
     rpc1 = cfg['images'][0]['rpcm']
     rpc2 = cfg['images'][1]['rpcm']
 
-    logger.info('triangulating tile {} {}...'.format(x, y))
-    H_ref = os.path.join(out_dir, 'pair_1', 'H_ref.txt')
-    H_sec = os.path.join(out_dir, 'pair_1', 'H_sec.txt')
-    pointing = os.path.join(cfg['out_dir'], 'global_pointing_pair_1.txt')
-    disp = os.path.join(out_dir, 'pair_1', 'rectified_disp.tif')
-    extra = os.path.join(out_dir, 'pair_1', 'rectified_disp_confidence.tif')
-    if not os.path.exists(extra):    # confidence file not always generated
-        extra = ''
-    mask_rect = os.path.join(out_dir, 'pair_1', 'rectified_mask.png')
-    mask_orig = os.path.join(out_dir, 'mask.tif')
-
-    # first check if disp exists for this tile
-    if os.path.exists(disp) is False:
-        #TODO: take note of the missing tile and move to the next
-        logger.error(f'input file: {disp}')
-        return
-
     # prepare the image needed to colorize point cloud
     if cfg['images'][0]['clr']:
         # we want colors image and rectified_ref.tif to have the same size
-        with rasterio.open(os.path.join(out_dir, 'pair_1', 'rectified_ref.tif')) as f:
+        with rasterio.open(rect_ref) as f:
             ww, hh = f.width, f.height
 
         colors_path = tempfile.NamedTemporaryFile()
         common.image_apply_homography(colors_path.name, cfg['images'][0]['clr'],
-                                      np.loadtxt(H_ref), ww, hh)
+                                      H_ref, ww, hh)
         with rasterio.open(colors_path.name, "r") as f:
             colors = f.read()
         colors_path.close()
 
     else:
-        with rasterio.open(os.path.join(out_dir, 'pair_1', 'rectified_ref.tif')) as f:
+        with rasterio.open(rect_ref) as f:
             img = f.read()
         colors = common.linear_stretching_and_quantization_8bit(img)
 
@@ -448,17 +587,18 @@ def disparity_to_ply(cfg, tile: Tile) -> None:
         disp_img = f.read().squeeze()
     with rasterio.open(mask_rect, 'r') as f:
         mask_rect_img = f.read().squeeze()
-    with rasterio.open(mask_orig, 'r') as f:
+    with rasterio.open(os.path.join(tile.dir, 'mask.tif'), 'r') as f:
         mask_orig_img = f.read().squeeze()
 
     out_crs = geographiclib.pyproj_crs(cfg['out_crs'])
     xyz_array, err = triangulation.disp_to_xyz(rpc1, rpc2,
-                                               np.loadtxt(H_ref), np.loadtxt(H_sec),
+                                               H_ref, H_sec,
                                                disp_img, mask_rect_img,
                                                img_bbx=(x, x+w, y, y+h),
                                                mask_orig=mask_orig_img,
-                                               A=np.loadtxt(pointing),
-                                               out_crs=out_crs)
+                                               A=np.loadtxt(os.path.join(cfg['out_dir'], 'global_pointing_pair_1.txt')),
+                                               out_crs=out_crs,
+                                               nb_threads=cfg['omp_num_threads'])
 
     # 3D filtering
     gsd_radius = cfg['3d_filtering_radius_gsd']
@@ -467,19 +607,97 @@ def disparity_to_ply(cfg, tile: Tile) -> None:
     if gsd_radius  and  fillfactor:
         r = gsd_radius * cfg['gsd']    # compute radius in meters
         n = int(fillfactor * 2*3.14*gsd_radius**2)  # fraction of the disk 
-        triangulation.filter_xyz(xyz_array, r, n, cfg['gsd'])
+        triangulation.filter_xyz(xyz_array, r, n, cfg['gsd'],
+                                 nb_threads=cfg['omp_num_threads'])
 
     # check result
     valid_out = np.sum(np.all(np.isfinite(xyz_array.reshape(-1, 3)), axis=1))
     if valid_out < valid_in//10:
         logger.warning("triangulation.filter_xyz with params {} has conserved only {} out of {}".format((r, n, cfg['gsd']), valid_out, valid_in))
 
-    proj_com = "CRS {}".format(cfg['out_crs'])
     try:
-        triangulation.write_to_ply(ply_file, xyz_array, colors, proj_com, confidence=extra)
+        write_tile_points(cfg, tile, ply_file, xyz_array, colors, extra)
     except Exception:
-        logger.error('triangulation.write_to_ply has failed: tile: {} {}'.format(*tile.coordinates[0:2]))
+        logger.error('write_tile_points has failed: tile: {} {}'.format(*tile.coordinates[0:2]))
+
+
+def remove_accumulator(cfg, tile: Tile) -> None:
+    """
+    Remove the DSM accumulator left in a tile directory by a previous run, if
+    cfg['direct_rasterization'], so that it is not rasterized if the tile
+    fails or yields no point this time.
+
+    Args:
+        tile: Tile containing the information needed to process a tile.
+    """
+    if cfg['direct_rasterization']:
+        common.remove(os.path.join(tile.dir, ACCUMULATOR_NAME))
+
+
+def write_tile_points(cfg, tile: Tile, ply_file: str, xyz_array: np.ndarray,
+                      colors: np.ndarray, extra: str = '') -> None:
+    """
+    Write the triangulated points of a tile to its point cloud file, and/or
+    rasterize them into its DSM accumulator if cfg['direct_rasterization'].
+
+    Args:
+        tile: Tile containing the information needed to process a tile.
+        ply_file: path to the output point cloud file
+        xyz_array: array of shape (h, w, 3) with the coordinates of the points
+        colors: colors image of shape (c, h, w)
+        extra: path to the disparity confidence map, or ''
+    """
+    if cfg['direct_rasterization']:
+        n = triangulation.write_to_accumulator(
+            os.path.join(tile.dir, ACCUMULATOR_NAME), xyz_array, colors,
+            confidence=extra, resolution=cfg['dsm_resolution'],
+            radius=cfg['dsm_radius'], sigma=cfg['dsm_sigma'],
+            crs=geographiclib.rasterio_crs(cfg['out_crs']),
+            nb_threads=cfg['omp_num_threads'])
+        if n == 0:
+            logger.warning('no points to rasterize in tile {} {}'.format(*tile.coordinates[0:2]))
+
+    if cfg['write_clouds'] or not cfg['direct_rasterization']:
+        proj_com = "CRS {}".format(cfg['out_crs'])
+        triangulation.write_to_ply(ply_file, xyz_array, colors, proj_com, confidence=extra,
+                                   compact=cfg['cloud_format'] == 'compact',
+                                   compression=cfg['cloud_compression'])
+
+
+def disparity_to_ply(cfg, tile: Tile) -> None:
+    """
+    Compute a point cloud from the disparity map of a pair of image tiles.
 
+    This function is called by s2p.main only if there are two input images (not
+    three).
+
+    Args:
+        tile: Tile containing the information needed to process a tile.
+    """
+    out_dir = tile.dir
+    ply_file = os.path.join(out_dir, cloud_name(cfg))
+    x, y = tile.coordinates[:2]
+    remove_accumulator(cfg, tile)
+
+    logger.info('triangulating tile {} {}...'.format(x, y))
+    H_ref = os.path.join(out_dir, 'pair_1', 'H_ref.txt')
+    H_sec = os.path.join(out_dir, 'pair_1', 'H_sec.txt')
+    disp = os.path.join(out_dir, 'pair_1', 'rectified_disp.tif')
+    extra = os.path.join(out_dir, 'pair_1', 'rectified_disp_confidence.tif')
+    if not os.path.exists(extra):    # confidence file not always generated
+        extra = ''
+    mask_rect = os.path.join(out_dir, 'pair_1', 'rectified_mask.png')
+    mask_orig = os.path.join(out_dir, 'mask.tif')
+
+    # first check if disp exists for this tile
+    if os.path.exists(disp) is False:
+        #TODO: take note of the missing tile and move to the next
+        logger.error(f'input file: {disp}')
+        return
+
+    triangulate_tile_pair(cfg, tile, np.loadtxt(H_ref), np.loadtxt(H_sec),
+                          os.path.join(out_dir, 'pair_1', 'rectified_ref.tif'),
+                          disp, mask_rect, extra, ply_file)
 
     if cfg['clean_intermediate']:
         common.remove(H_ref)
@@ -560,13 +778,15 @@ def heights_to_ply(cfg, tile: Tile) -> None:
     Args:
         tile: a Tile that provides all you need to process a tile
     """
+    remove_accumulator(cfg, tile)
+
     # merge the n-1 height maps of the tile (n = nb of images)
     heights_fusion(cfg, tile)
 
     # compute a ply from the merged height map
     out_dir = tile.dir
     x, y, w, h = tile.coordinates
-    plyfile = os.path.join(out_dir, 'cloud.ply')
+    plyfile = os.path.join(out_dir, cloud_name(cfg))
     height_map = os.path.join(out_dir, 'height_map.tif')
 
     if cfg['images'][0]['clr']:
@@ -581,7 +801,8 @@ def heights_to_ply(cfg, tile: Tile) -> None:
     out_crs = geographiclib.pyproj_crs(cfg['out_crs'])
     xyz_array = triangulation.height_map_to_xyz(height_map,
                                                 cfg['images'][0]['rpcm'], x, y,
-                                                out_crs)
+                                                out_crs,
+                                                cfg['localization_grid_max_error'])
 
     # 3D filtering
     gsd_radius = cfg['3d_filtering_radius_gsd']
@@ -589,30 +810,38 @@ def heights_to_ply(cfg, tile: Tile) -> None:
     if gsd_radius  and  fillfactor:
         r = gsd_radius * cfg['gsd']    # compute radius in meters
         n = int(fillfactor * 2*3.14*gsd_radius**2)  # fraction of the disk 
-        triangulation.filter_xyz(xyz_array, r, n, cfg['gsd'])
+        triangulation.filter_xyz(xyz_array, r, n, cfg['gsd'],
+                                 nb_threads=cfg['omp_num_threads'])
 
 
-    proj_com = "CRS {}".format(cfg['out_crs'])
-    triangulation.write_to_ply(plyfile, xyz_array, colors, proj_com)
+    write_tile_points(cfg, tile, plyfile, xyz_array, colors)
 
     if cfg['clean_intermediate']:
         common.remove(height_map)
         common.remove(os.path.join(out_dir, 'mask.tif'))
 
 
-def plys_to_dsm(cfg, tile: Tile) -> None:
+def cloud_name(cfg) -> str:
+    """
+    Name of the point cloud files of the tiles, depending on cfg['cloud_format'].
+    """
+    return 'cloud.s2pc' if cfg['cloud_format'] == 'compact' else 'cloud.ply'
+
+
+def clouds_to_dsm(cfg, tile: Tile):
     """
-    Generates DSM from plyfiles (cloud.ply)
+    Rasterize the point cloud of a tile and its neighbors' with plyflatten.
 
     Args:
         tile: a dictionary that provides all you need to process a tile
-    """
 
-    ply_name = 'cloud.ply'
+    Returns:
+        dsm and confidence (or None) arrays, and rasterio profile, or None if
+        the tile has no point cloud
+    """
+    ply_name = cloud_name(cfg)
+    compact = cfg['cloud_format'] == 'compact'
 
-    out_dsm = os.path.join(tile.dir, 'dsm.tif')
-    out_conf = os.path.join(tile.dir, 'confidence.tif')
-    out_dsm_filtered = os.path.join(tile.dir, 'dsm-filtered.tif')
     r = cfg['dsm_resolution']
 
     in_ply = os.path.join(tile.dir, ply_name)
@@ -620,26 +849,23 @@ def plys_to_dsm(cfg, tile: Tile) -> None:
     if not os.path.exists(in_ply):
         # TODO: take note of the missing part of the DSM
         logger.error(f'missing input file: {in_ply}')
-        return
+        return None
 
-    # compute the point cloud x, y bounds
-    points, _ = ply.read_3d_point_cloud_from_ply(in_ply)
-    if len(points) == 0:
+    # get the point cloud x, y bounds, from its sidecar file if available
+    if compact:
+        count, bmin, bmax = compact_cloud.read_bounds(in_ply)
+    else:
+        count, bmin, bmax = ply.read_bounds(in_ply)
+    if count == 0:
         # TODO: take note of the missing part of the DSM
         logger.error(f'plys_to_dsm no points in file: {in_ply}')
-        return
+        return None
 
-    xmin, ymin, *_ = np.min(points, axis=0)
-    xmax, ymax, *_ = np.max(points, axis=0)
+    xmin, ymin, _ = bmin
+    xmax, ymax, _ = bmax
 
     # compute xoff, yoff, xsize, ysize on a grid of unit r
-    xoff = np.floor(xmin / r) * r
-    xsize = int(1 + np.floor((xmax - xoff) / r))
-
-    yoff = np.ceil(ymax / r) * r
-    ysize = int(1 - np.floor((ymin - yoff) / r))
-
-    roi = xoff, yoff, xsize, ysize
+    roi = rasterization.grid(xmin, xmax, ymin, ymax, r)
 
     # since some tiles might have failed we test for the neighborhood tiles before feeding them to merge
     clouds = []
@@ -648,6 +874,9 @@ def plys_to_dsm(cfg, tile: Tile) -> None:
         if os.path.exists(nply):
             clouds.append(nply)
 
+    if compact:
+        return compact_clouds_to_dsm(cfg, clouds, roi)
+
     # this option controls the type of aggregation
     # TODO: this interface is VERY VERY ugly AND FRAGILE and will be reworked within a new plyflatten
     use_max_aggregation = cfg['dsm_aggregation_with_max']
@@ -670,164 +899,141 @@ def plys_to_dsm(cfg, tile: Tile) -> None:
         # the average raster is stored in #0
         dsm = raster[:, :, 0]
 
-    common.rasterio_write(out_dsm, dsm, profile=profile)
-
     # export confidence (optional)
     # note that the plys are assumed to contain the fields:
     # [x(float32), y(float32), z(float32), r(uint8), g(uint8), b(uint8), confidence(optional, float32)]
     # so the raster has 4 or 5 columns: [z, r, g, b, confidence (optional)]
-    if raster.shape[-1] == 5:
-        common.rasterio_write(out_conf, raster[:, :, 4], profile=profile)
-
-
-
-    # fill the small gaps in the dsm
-    if maxsize := cfg['fill_dsm_holes_smaller_than']:
-        import s2p.demtk
-        from s2p.specklefilter import specklefilter
+    confidence = raster[:, :, 4] if raster.shape[-1] == 5 else None
+    return dsm, confidence, profile
 
-        # compute the mask where the interpolation will not be applied
-        # (masked_nans is a mask of large connected components)
-        z = np.isnan(dsm).astype(np.float32)
-        z[z == 0] = np.nan
-        masked_nans = specklefilter(z, maxsize, 0) == 1
 
-        # apply the interpolation after removing the masked areas
-        dsm[masked_nans] = -1000
-        filtered = s2p.demtk.descending_neumann_interpolation(dsm).astype(np.float32)
-        filtered[masked_nans] = np.nan
-
-        common.rasterio_write(out_dsm_filtered, filtered, profile=profile)
-
-
-def merge_tiles_rasterio(paths, bounds, res, dst_path, creation_options, method):
+def compact_clouds_to_dsm(cfg, clouds: list, roi: tuple):
     """
-    Merge a list of raster tiles into a single raster.
+    Rasterize compact clouds with the rasterization module, with the same
+    footprints and weights as plyflatten.
 
-    Parameters:
-        paths (list of str): List of file paths to the input raster tiles to be merged.
-        bounds (tuple or None): Bounding box (left, bottom, right, top) to limit the merge.
-                                If None, bounds are inferred from the input tiles.
-        res (float or tuple): Output resolution (pixel size). Can be a single float or (xres, yres).
-        dst_path (str): Save path to the output merged raster file.
-        creation_options (dict): GDAL creation options (e.g., compression, tiling, block size).
-        method (str): Merge method to use when overlapping pixels exist.
+    Only the clouds overlapping the DSM are decoded, and only their
+    coordinates and confidence columns.
+
+    Args:
+        clouds: paths to the compact cloud files
+        roi: xoff, yoff, xsize, ysize of the DSM
 
     Returns:
-        None. The merged raster is written to `dst_path`.
+        dsm and confidence (or None) arrays, and rasterio profile
     """
-
-    rasterio.merge.merge(paths,
-                         bounds=bounds,
-                         res=res,
-                         nodata=np.nan,
-                         indexes=[1],
-                         dst_path=dst_path,
-                         dst_kwds=creation_options,
-                         method=method)
-    return
-
-
-def merge_with_gdalwarp(input_files, output_file, nb_workers, nodata=np.nan):
+    r = cfg['dsm_resolution']
+    xoff, yoff, xsize, ysize = roi
+    margin = (cfg['dsm_radius'] + 1) * r
+    columns = []
+    for path in clouds:
+        count, bmin, bmax = compact_cloud.read_bounds(path)
+        if count == 0 or bmax[0] < xoff - margin or bmin[0] > xoff + xsize * r + margin \
+                or bmax[1] < yoff - ysize * r - margin or bmin[1] > yoff + margin:
+            continue
+        columns.append(compact_cloud.read_compact_cloud_columns(
+            path, ['x', 'y', 'z', 'confidence'])[0])
+
+    names = [n for n in ['z', 'confidence'] if all(n in c for c in columns)]
+    x, y, *values = [np.concatenate([c[n] for c in columns]) for n in ['x', 'y'] + names]
+    acc = rasterization.rasterize(x, y, np.column_stack(values), xoff, yoff, r, xsize, ysize,
+                                  radius=cfg['dsm_radius'], sigma=cfg['dsm_sigma'],
+                                  nb_threads=cfg['omp_num_threads'])
+    average, highest = rasterization.bands(acc)
+
+    dsm = highest if cfg['dsm_aggregation_with_max'] else average[:, :, 0]
+    confidence = average[:, :, 1] if 'confidence' in names else None
+    profile = {'tiled': True, 'compress': 'deflate', 'predictor': 2,
+               'nodata': float('nan'),
+               'crs': geographiclib.rasterio_crs(cfg['out_crs']),
+               'transform': affine.Affine(r, 0.0, xoff, 0.0, -r, yoff)}
+    return dsm, confidence, profile
+
+
+def accumulators_to_dsm(cfg, tile: Tile):
     """
-    Merge multiple raster files using gdalwarp with maximum value resampling.
+    Compute the DSM of a tile from its DSM accumulator and the overlapping
+    strips of its neighbors' accumulators.
 
-    Parameters:
-        input_files (list of str): List of file paths to raster files to be merged.
-        output_file (str): Save path to the output merged raster file.
-        nb_workers (int): Number of threads to use for processing.
-        nodata (float, optional): NoData value to consider during merge (default: np.nan).
+    Args:
+        tile: a dictionary that provides all you need to process a tile
 
     Returns:
-        None. The result is saved to `output_file`.
+        dsm and confidence (or None) arrays, and rasterio profile, or None if
+        the tile has no accumulator
     """
-    os.environ['GDAL_NUM_THREADS'] = str(nb_workers) # allow GDAL more than one thread to allow gdalwarp to multiprocess
+    in_acc = os.path.join(tile.dir, ACCUMULATOR_NAME)
+    # it might not exist because of a failed blockmatching or an empty tile
+    if not os.path.exists(in_acc):
+        # TODO: take note of the missing part of the DSM
+        logger.error(f'missing input file: {in_acc}')
+        return None
 
-    if np.isnan(nodata):
-        nodata_str = "nan"
+    accumulators = [in_acc]
+    for n_dir in tile.neighborhood_dirs:
+        nacc = os.path.normpath(os.path.join(tile.dir, n_dir, ACCUMULATOR_NAME))
+        if os.path.exists(nacc) and nacc != os.path.normpath(in_acc):
+            accumulators.append(nacc)
+
+    average, highest, names, profile = rasterization.accumulators_to_dsm(accumulators)
+    if cfg['dsm_aggregation_with_max']:
+        dsm = highest
     else:
-        nodata_str = str(nodata)
-
-    nb_workers = min(nb_workers, len(input_files))
-
-    cmd = [
-        "gdalwarp",
-        "-q",
-        "-wo", f"NUM_THREADS={nb_workers}",
-        "-r", "max",
-        "-wo", "UNIFIED_SRC_NODATA=YES",
-        "-srcnodata", nodata_str,
-        "-dstnodata", nodata_str,
-        *input_files,
-        output_file
-    ]
-    subprocess.run(cmd, check=True)
-    os.environ['GDAL_NUM_THREADS'] = "1"
+        dsm = average[:, :, names.index('z')]
+    confidence = average[:, :, names.index('confidence')] if 'confidence' in names else None
+    return dsm, confidence, profile
 
 
-def merge_tiles_mp(nb_workers, global_dst_path, save_folder,
-                   paths, bounds, res, creation_options, method,
-                   remove_merged=True):
+def plys_to_dsm(cfg, tile: Tile) -> None:
     """
-    Merge a large number of DSM tiles in parallel using Rasterio and GDAL.
-
-    This function splits the input tile list into subsets, merges each subset in parallel
-    using Rasterio, and finally merges the intermediate results using `gdalwarp` with
-    multi-threading.
-
-    Parameters:
-        nb_workers (int): Number of worker processes to run in parallel.
-        global_dst_path (str): Path to save the final merged DSM.
-        save_folder (str): Directory where intermediate merged tiles are saved.
-        paths (list of str): List of paths to input DSM tile files.
-        bounds (tuple or None): Bounding box for the merge (left, bottom, right, top).
-                                If None, bounds are inferred from the input tiles.
-        res (float or tuple): Output resolution (pixel size). Can be a single float or (xres, yres).
-        creation_options (dict): GDAL creation options for output files.
-        method (str): Resampling method used in rasterio.merge.
-        remove_merged (bool, optional): If True (default), deletes intermediate merged tiles
-                                        after the final merge.
+    Generates DSM from plyfiles (cloud.ply), compact clouds (cloud.s2pc), or
+    DSM accumulators if cfg['direct_rasterization']
 
-    Returns:
-        None. The final merged DSM is saved to `global_dst_path`.
+    Args:
+        tile: a dictionary that provides all you need to process a tile
     """
+    out_dsm = os.path.join(tile.dir, 'dsm.tif')
+    out_conf = os.path.join(tile.dir, 'confidence.tif')
+    out_dsm_filtered = os.path.join(tile.dir, 'dsm-filtered.tif')
 
-    tiles_per_process = int(np.ceil(len(paths) / nb_workers))
-
-    if tiles_per_process <= 4:
-        # if there are only few tiles, it is faster to run everything at once
-        # merge_with_gdalwarp(paths, global_dst_path, nb_workers, nodata=np.nan)
-        merge_tiles_rasterio(paths, bounds, res, global_dst_path, creation_options, method)
+    if cfg['direct_rasterization']:
+        result = accumulators_to_dsm(cfg, tile)
+    else:
+        result = clouds_to_dsm(cfg, tile)
+    if result is None:
         return
+    dsm, confidence, profile = result
 
-    context = multiprocessing.get_context("spawn")
-    pool = context.Pool(nb_workers)
-
-    list_paths_to_merge = [
-        paths[i*tiles_per_process: (i+1)*tiles_per_process] for i in range(nb_workers)
-                                                            if i*tiles_per_process < len(paths) # only consider non-empty subsets of tiles
-    ]
-    dst_paths = [
-        os.path.join(save_folder, f"merge_{i}.tif") for i in range(len(list_paths_to_merge))
-    ]
+    common.rasterio_write(out_dsm, dsm, profile=profile)
 
-    results = []
+    # export confidence (optional)
+    if confidence is not None:
+        common.rasterio_write(out_conf, confidence, profile=profile)
 
-    for (paths_to_merge, dst_path) in zip(list_paths_to_merge, dst_paths):
-        results.append(pool.apply_async(
-            merge_tiles_rasterio, args=(paths_to_merge, bounds, res, dst_path, creation_options, method)
-        ))
+    # fill the small gaps in the dsm
+    if maxsize := cfg['fill_dsm_holes_smaller_than']:
+        import s2p.demtk
+        from s2p.specklefilter import specklefilter
 
-    pool.close()
-    pool.join()
+        # compute the mask where the interpolation will not be applied
+        # (masked_nans is a mask of large connected components)
+        z = np.isnan(dsm).astype(np.float32)
+        z[z == 0] = np.nan
+        masked_nans = specklefilter(z, maxsize, 0) == 1
 
-    merge_with_gdalwarp(dst_paths, global_dst_path, nb_workers, nodata=np.nan)
+        # apply the interpolation after removing the masked areas
+        dsm[masked_nans] = -1000
+        filtered = s2p.demtk.descending_neumann_interpolation_local(
+            dsm, workers=cfg['omp_num_threads']).astype(np.float32)
+        filtered[masked_nans] = np.nan
 
-    if remove_merged:
-        for dst_path in dst_paths:
-            os.remove(dst_path)
+        common.rasterio_write(out_dsm_filtered, filtered, profile=profile)
 
-    return
+    # overviews of the tiles rasters, read through the global VRTs
+    if cfg['global_dsm_mode'] == 'vrt':
+        for path in [out_dsm, out_conf, out_dsm_filtered]:
+            if os.path.exists(path):
+                mosaic.add_overviews(path)
 
 
 def global_dsm(cfg, tiles: List[Tile]) -> None:
@@ -847,67 +1053,142 @@ def global_dsm(cfg, tiles: List[Tile]) -> None:
                         "blockysize": 256,
                         "compress": "deflate",
                         "BIGTIFF": "IF_SAFER",
-                        "COPY_SRC_OVERVIEWS": "YES",
                         "predictor": 2}
 
-    dsms = []
-    dsms_filtered = []
-    confidence_maps = []
-
+    # products of each tile, read once for all of them
+    products = ["dsm", "dsm-filtered", "confidence"]
+    tile_products = []
     for t in tiles:
-        d = os.path.join(t.dir, "dsm.tif")
-        if os.path.exists(d):
-            dsms.append(d)
-
-        f = os.path.join(t.dir, "dsm-filtered.tif")
-        if os.path.exists(f):
-            dsms_filtered.append(f)
-
-        c = os.path.join(t.dir, "confidence.tif")
-        if os.path.exists(c):
-            confidence_maps.append(c)
-
-    nb_workers = cfg['max_processes'] or multiprocessing.cpu_count()
-    save_folder = os.path.join(cfg["out_dir"], "tile_merging")
-    os.makedirs(save_folder, exist_ok=True)
-
-    if dsms:
-        global_dst_path_dsm = os.path.join(cfg["out_dir"], "dsm.tif")
-        merge_tiles_mp(nb_workers,
-                       global_dst_path_dsm,
-                       save_folder,
-                       dsms,
-                       bounds,
-                       res=cfg["dsm_resolution"],
-                       creation_options=creation_options,
-                       method=cfg["dsm_merging_method"],
-                       remove_merged=True)
-
-    if dsms_filtered:
-        global_dst_path_dsm_filtered = os.path.join(cfg["out_dir"], "dsm-filtered.tif")
-        merge_tiles_mp(nb_workers,
-                       global_dst_path_dsm_filtered,
-                       save_folder,
-                       dsms_filtered,
-                       bounds,
-                       res=cfg["dsm_resolution"],
-                       creation_options=creation_options,
-                       method=cfg["dsm_merging_method"],
-                       remove_merged=True)
-
-    if confidence_maps:
-        global_dst_path_dsm_confidence = os.path.join(cfg["out_dir"], "confidence.tif")
-        merge_tiles_mp(nb_workers,
-                       global_dst_path_dsm_confidence,
-                       save_folder,
-                       confidence_maps,
-                       bounds,
-                       res=cfg["dsm_resolution"],
-                       creation_options=creation_options,
-                       method=cfg["dsm_merging_method"],
-                       remove_merged=True)
-
-    os.rmdir(save_folder)
+        paths = {p: os.path.join(t.dir, p + ".tif") for p in products}
+        paths = {p: f for p, f in paths.items() if os.path.exists(f)}
+        if paths:
+            tile_products.append(paths)
+
+    ext = ".vrt" if cfg["global_dsm_mode"] == "vrt" else ".tif"
+    outputs = {p: os.path.join(cfg["out_dir"], p + ext) for p in products
+               if any(p in t for t in tile_products)}
+    if outputs and cfg["global_dsm_mode"] == "vrt":
+        mosaic.write_vrt(tile_products, outputs, cfg["dsm_resolution"],
+                         bounds=bounds, method=cfg["dsm_merging_method"])
+    elif outputs:
+        nb_workers = cfg['max_processes'] or multiprocessing.cpu_count()
+        mosaic.mosaic(tile_products, outputs, cfg["dsm_resolution"],
+                      bounds=bounds, method=cfg["dsm_merging_method"],
+                      creation_options=creation_options, nb_workers=nb_workers)
+
+
+def tile_key(tile):
+    """
+    Key of a tile in the tasks of process_tiles_dag.
+    """
+    return os.path.normpath(tile.dir)
+
+
+def dag_tasks(cfg, tiles_pairs: list, gpu_mem_manager: GPUMemoryManager,
+              in_memory: bool) -> list:
+    """
+    Tasks of steps 3 to 6 run by process_tiles_dag before the global height
+    offsets computation (i.e. all of them with two images).
+
+    Args:
+        tiles_pairs: list of (cfg, tile, i) tuples
+        in_memory (bool): run steps 3 to 5 with tile_pipeline
+
+    Returns:
+        list of parallel.Task
+    """
+    n = len(cfg['images'])
+    Task = parallel.Task
+
+    tiles = {}
+    for _, t, _ in tiles_pairs:
+        tiles[tile_key(t)] = t
+
+    tasks = []
+    for _, t, i in tiles_pairs:
+        k = tile_key(t)
+        if in_memory:
+            tasks.append(Task(('match', k, i), tile_pipeline, (cfg, t, i, gpu_mem_manager),
+                              group='stereo'))
+            continue
+        tasks.append(Task(('rectify', k, i), rectification_pair, (cfg, t, i)))
+        tasks.append(Task(('check', k, i), disparity_range_check, (cfg, t, i),
+                          requires=[('rectify', k, i)]))
+        tasks.append(Task(('match', k, i), stereo_matching, (cfg, t, i, gpu_mem_manager),
+                          requires=[('check', k, i)], group='stereo'))
+        if n > 2:
+            tasks.append(Task(('height', k, i), disparity_to_height, (cfg, t, i),
+                              requires=[('match', k, i)]))
+
+    if n == 2:
+        if in_memory:
+            # tile_pipeline writes the cloud of the tile
+            tasks += dsm_tasks(cfg, tiles, lambda k: ('match', k, 1))
+        else:
+            for k, t in tiles.items():
+                tasks.append(Task(('cloud', k), disparity_to_ply, (cfg, t),
+                                  requires=[('match', k, 1)]))
+            tasks += dsm_tasks(cfg, tiles, lambda k: ('cloud', k))
+    else:
+        for k, t in tiles.items():
+            pairs = [('height', tile_key(u), i) for _, u, i in tiles_pairs if tile_key(u) == k]
+            tasks.append(Task(('mean_heights', k), mean_heights, (cfg, t), after=pairs))
+    return tasks
+
+
+def dsm_tasks(cfg, tiles: dict, cloud) -> list:
+    """
+    Tasks computing the DSM of each tile from its cloud and its neighbors'.
+
+    Args:
+        tiles: dictionary of the tiles, by tile_key
+        cloud: function giving the key of the task writing the cloud of a tile
+            from the tile key
+
+    Returns:
+        list of parallel.Task
+    """
+    out = []
+    for k, t in tiles.items():
+        neighbors = [os.path.normpath(os.path.join(t.dir, d)) for d in t.neighborhood_dirs]
+        out.append(parallel.Task(('dsm', k), plys_to_dsm, (cfg, t),
+                                 requires=[cloud(k)],
+                                 after=[cloud(d) for d in neighbors if d in tiles and d != k]))
+    return out
+
+
+def process_tiles_dag(cfg, tiles_pairs: list, nb_workers: int, nb_workers_stereo: int,
+                      gpu_mem_manager: GPUMemoryManager, in_memory: bool,
+                      timeout: int) -> list:
+    """
+    Run steps 3 to 6 with a dependency-driven scheduler: each tile goes
+    through rectification, stereo matching, triangulation and rasterization
+    as soon as its own inputs (and its neighbors' clouds, for the
+    rasterization) are ready. With more than two images, the global height
+    offsets computation (step 5c) remains a barrier.
+
+    Args:
+        tiles_pairs: list of (cfg, tile, i) tuples
+        nb_workers: number of calls run simultaneously
+        nb_workers_stereo: number of stereo matching calls run simultaneously
+        in_memory (bool): run steps 3 to 5 with tile_pipeline
+
+    Returns:
+        the list of (cfg, tile, i) tuples whose stereo matching was run
+    """
+    tasks = dag_tasks(cfg, tiles_pairs, gpu_mem_manager, in_memory)
+    group_limits = {'stereo': nb_workers_stereo}
+    outputs = parallel.launch_dag(cfg, tasks, nb_workers, group_limits=group_limits,
+                                  separate_groups=['stereo'], timeout=timeout)
+
+    if len(cfg['images']) > 2:
+        tiles = {tile_key(t): t for _, t, _ in tiles_pairs}
+        global_mean_heights(cfg, list(tiles.values()))
+        tasks = [parallel.Task(('cloud', k), heights_to_ply, (cfg, t)) for k, t in tiles.items()]
+        tasks += dsm_tasks(cfg, tiles, lambda k: ('cloud', k))
+        parallel.launch_dag(cfg, tasks, nb_workers, timeout=timeout)
+
+    return [x for x in tiles_pairs if ('match', tile_key(x[1]), x[2]) in outputs]
 
 
 def main(user_cfg, start_from=0):
@@ -940,6 +1221,53 @@ def main(user_cfg, start_from=0):
     # multiprocessing setup
     nb_workers = cfg['max_processes'] or multiprocessing.cpu_count()  # nb of available cores
 
+    # stereo matching resources
+    if cfg['max_processes_stereo_matching'] is not None:
+        nb_workers_stereo = cfg['max_processes_stereo_matching']
+    else:
+        nb_workers_stereo = nb_workers
+
+    if cfg["gpu_total_memory"] is not None:
+        gpu_total_memory = cfg["gpu_total_memory"]
+        # keep some space for the CUDA contexts
+        gpu_total_memory -= nb_workers_stereo * 120
+        gpu_mem_manager = GPUMemoryManager.make_bounded(
+            max_memory_in_megabytes=gpu_total_memory,
+            mp_context=parallel.get_mp_context(),
+        )
+    else:
+        gpu_mem_manager = GPUMemoryManager.make_unbounded()
+
+    if cfg['persistent_pool']:
+        # pools of workers reused by all the steps, with the heavy modules already imported.
+        # The stereo matching calls have workers of their own, so that the models kept
+        # loaded by persistent engines are in at most nb_workers_stereo processes
+        parallel.start_pool(nb_workers, gpu_mem_manager, warm_imports=['s2p'], cfg=cfg)
+        warm_imports = ['s2p']
+        if cfg['matching_algorithm'] == 'stereoanywhere':
+            warm_imports.append('s2p.sota_correlators.stereoanywhere.disparity')
+        parallel.start_pool(nb_workers_stereo, gpu_mem_manager, warm_imports=warm_imports,
+                            cfg=cfg, name='stereo')
+
+    try:
+        run_steps(cfg, start_from, nb_workers, nb_workers_stereo, gpu_mem_manager)
+    except BaseException:
+        parallel.stop_pool(terminate=True)
+        raise
+    parallel.stop_pool()
+
+
+def run_steps(cfg, start_from: int, nb_workers: int, nb_workers_stereo: int,
+              gpu_mem_manager: GPUMemoryManager) -> None:
+    """
+    Run the steps of the s2p pipeline.
+
+    Args:
+        cfg: s2p config dictionary
+        start_from: the step to start from
+        nb_workers: number of calls run simultaneously
+        nb_workers_stereo: number of stereo matching calls run simultaneously
+    """
     tw, th = initialization.adjust_tile_size(cfg)
     tiles_txt = os.path.join(cfg['out_dir'], 'tiles.txt')
     if start_from <= 1:
@@ -960,6 +1288,9 @@ def main(user_cfg, start_from=0):
                 f.write(t.json)
                 f.write('\n')
 
+    if cfg['profile_functions']:
+        profiling.remove_profiles(cfg)
+
     n = len(cfg['images'])
     tiles_pairs = [(cfg, t, i) for i in range(1, n) for t in tiles]
     tiles_with_cfg = [(cfg, t) for t in tiles]
@@ -968,6 +1299,7 @@ def main(user_cfg, start_from=0):
     # local-pointing step:
     if start_from <= 1:
         logger.info('1) correcting pointing locally...')
+        telemetry.step(cfg, '1_pointing_correction')
         successes = parallel.launch_calls(cfg, pointing_correction, tiles_pairs, nb_workers,
                               timeout=timeout)
 
@@ -977,12 +1309,36 @@ def main(user_cfg, start_from=0):
     # global-pointing step:
     if start_from <= 2:
         logger.info('2) correcting pointing globally...')
+        telemetry.step(cfg, '2_global_pointing_correction')
         global_pointing_correction(cfg, tiles)
         common.print_elapsed_time()
 
+    # with the dag scheduler, steps 3 to 6 run tile by tile as soon as their inputs are ready
+    dag = cfg['scheduler'] == 'dag' and start_from <= 3
+
+    # with two images, steps 3 to 5 can run tile by tile in a single worker
+    in_memory = cfg['tile_pipeline_in_memory'] and n == 2 and start_from <= 3
+
+    if dag:
+        logger.info('3-6) processing the tiles as soon as their inputs are ready...')
+        telemetry.step(cfg, '3-6_tiles_dag')
+        tiles_pairs = process_tiles_dag(cfg, tiles_pairs, nb_workers, nb_workers_stereo,
+                                        gpu_mem_manager, in_memory, timeout)
+    elif in_memory:
+        logger.info('3-5) rectifying, matching and triangulating tiles...')
+        telemetry.step(cfg, '3-5_tile_pipeline')
+        successes = parallel.launch_calls(cfg, tile_pipeline, tiles_pairs,
+                                          nb_workers_stereo,
+                                          gpu_mem_manager,
+                                          timeout=timeout, pool='stereo')
+
+        # update the tiles removing the discarded tiles
+        tiles_pairs = [x for x, b in zip(tiles_pairs, successes) if b]
+
     # rectification step:
-    if start_from <= 3:
+    if start_from <= 3 and not (dag or in_memory):
         logger.info('3) rectifying tiles...')
+        telemetry.step(cfg, '3_rectification')
         successes = parallel.launch_calls(cfg, rectification_pair, tiles_pairs, nb_workers,
                               timeout=timeout)
 
@@ -990,8 +1346,9 @@ def main(user_cfg, start_from=0):
         tiles_pairs = [x for x, b in zip(tiles_pairs, successes) if b]
 
     # disparity range reasoning step: (WIP)
-    if start_from <= 4:
+    if start_from <= 4 and not (dag or in_memory):
         logger.info('4) reason about the disparity ranges... (WIP)')
+        telemetry.step(cfg, '4_disparity_range_check')
         # extra step checking the disparity range
         # verity if the disparity range of a tile is not too different from its neighbors
         tiles_usefulnesses = parallel.launch_calls(cfg, disparity_range_check, tiles_pairs, nb_workers,
@@ -1005,66 +1362,77 @@ def main(user_cfg, start_from=0):
 
 
     # matching step:
-    if start_from <= 4:
+    if start_from <= 4 and not (dag or in_memory):
         logger.info('4) running stereo matching...')
-        if cfg['max_processes_stereo_matching'] is not None:
-            nb_workers_stereo = cfg['max_processes_stereo_matching']
-        else:
-            nb_workers_stereo = nb_workers
-
-        if cfg["gpu_total_memory"] is not None:
-            gpu_total_memory = cfg["gpu_total_memory"]
-            # keep some space for the CUDA contexts
-            gpu_total_memory -= nb_workers_stereo * 120
-            gpu_mem_manager = GPUMemoryManager.make_bounded(
-                max_memory_in_megabytes=gpu_total_memory,
-                mp_context=parallel.get_mp_context(),
-            )
+        telemetry.step(cfg, '4_stereo_matching')
+        batch_size = cfg['stereoanywhere_batch_size']
+        if cfg['matching_algorithm'] == 'stereoanywhere' and batch_size > 1:
+            # each call processes a chunk of pairs, grouped in batches of similar sizes
+            max_memory = cfg['stereoanywhere_batch_memory']
+            if max_memory is None and cfg['gpu_total_memory'] is not None:
+                # share of the GPU memory of each stereo worker, minus its CUDA context
+                max_memory = cfg['gpu_total_memory'] / nb_workers_stereo - 120
+            chunk_size = 4 * batch_size
+            chunks = [(cfg, [(t, i) for _, t, i in tiles_pairs[k:k + chunk_size]])
+                      for k in range(0, len(tiles_pairs), chunk_size)]
+            parallel.launch_calls(cfg, stereo_matching_batch, chunks,
+                                  nb_workers_stereo, max_memory,
+                                  tilewise=False,
+                                  timeout=None if timeout is None else timeout * chunk_size,
+                                  pool='stereo')
         else:
-            gpu_mem_manager = GPUMemoryManager.make_unbounded()
-
-        parallel.launch_calls(cfg, stereo_matching, tiles_pairs,
-                              nb_workers_stereo,
-                              gpu_mem_manager,
-                              timeout=timeout)
+            parallel.launch_calls(cfg, stereo_matching, tiles_pairs,
+                                  nb_workers_stereo,
+                                  gpu_mem_manager,
+                                  timeout=timeout, pool='stereo')
 
     ### UPDATE TILES_WITH_CFG FROM CURRENT TILES_PAIRS
     tilesdict = dict( [(t.json,t) for _,t,_ in tiles_pairs] )
     tiles_with_cfg = [(cfg,t) for t in tilesdict.values()]
 
-    if start_from <= 5:
+    if start_from <= 5 and not (dag or in_memory):
         if n > 2:
             # disparity-to-height step:
             logger.info('5a) computing height maps...')
+            telemetry.step(cfg, '5a_disparity_to_height')
             parallel.launch_calls(cfg, disparity_to_height, tiles_pairs, nb_workers,
                                   timeout=timeout)
 
             logger.info('5b) computing local pairwise height offsets...')
+            telemetry.step(cfg, '5b_mean_heights')
             parallel.launch_calls(cfg, mean_heights, tiles_with_cfg, nb_workers, timeout=timeout)
 
             # global-mean-heights step:
             logger.info('5c) computing global pairwise height offsets...')
+            telemetry.step(cfg, '5c_global_mean_heights')
             global_mean_heights(cfg, tiles)
 
             # heights-to-ply step:
             logger.info('5d) merging height maps and computing point clouds...')
+            telemetry.step(cfg, '5d_heights_to_ply')
             parallel.launch_calls(cfg, heights_to_ply, tiles_with_cfg, nb_workers,
                                   timeout=timeout)
         else:
             # triangulation step:
             logger.info('5) triangulating tiles...')
+            telemetry.step(cfg, '5_triangulation')
             parallel.launch_calls(cfg, disparity_to_ply, tiles_with_cfg, nb_workers,
                                   timeout=timeout)
 
     # local-dsm-rasterization step:
-    if start_from <= 6:
+    if start_from <= 6 and not dag:
         logger.info('6) computing DSM by tile...')
+        telemetry.step(cfg, '6_plys_to_dsm')
         parallel.launch_calls(cfg, plys_to_dsm, tiles_with_cfg, nb_workers, timeout=timeout)
 
     # global-dsm-rasterization step:
     if start_from <= 7:
         logger.info('7) computing global DSM...')
+        telemetry.step(cfg, '7_global_dsm')
         global_dsm(cfg, tiles)
+    telemetry.step(cfg)
+    if cfg['profile_functions']:
+        profiling.merge_profiles(cfg)
     common.print_elapsed_time()
     common.print_elapsed_time(since_first_call=True)
 
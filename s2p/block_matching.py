@@ -395,4 +395,9 @@ def compute_disparity_map(cfg, im1, im2, disp, mask, algo, disp_min=None,
 
     if algo == "stereoanywhere":
         from s2p.sota_correlators.stereoanywhere import disparity
-        disparity.run(im1, im2, cfg["mono_ckpt"], cfg["stereo_ckpt"],  disp, mask)
+        disparity.run(im1, im2, cfg["mono_ckpt"], cfg["stereo_ckpt"], disp, mask,
+                      persistent=cfg["stereoanywhere_persistent_engine"],
+                      max_memory=cfg["stereoanywhere_max_memory"],
+                      window_overlap=cfg["stereoanywhere_window_overlap"],
+                      disp_range=(disp_min, disp_max) if cfg["stereoanywhere_use_disp_range"] else None,
+                      flow_tol=cfg["stereoanywhere_flow_tol"])
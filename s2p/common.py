@@ -15,6 +15,9 @@ import rasterio
 from scipy import ndimage
 from typing import Optional
 
+from s2p import morphology
+from s2p import telemetry
+
 logger = logging.getLogger()
 
 # silent rasterio NotGeoreferencedWarning
@@ -58,7 +61,9 @@ def run(cmd, env=os.environ, timeout=None, shell=False):
         cmd = cmd.split()
     subprocess.run(cmd, shell=shell, stdout=sys.stdout, stderr=sys.stderr,
                    env=env, timeout=timeout, check=True)
-    logging.info("execution time: %s", datetime.datetime.now() - t)
+    elapsed = datetime.datetime.now() - t
+    telemetry.add_subprocess_time(elapsed.total_seconds())
+    logging.info("execution time: %s", elapsed)
 
 
 def matrix_translation(x, y):
@@ -149,20 +154,15 @@ def cargarse_basura(inputf, outputf):
     se=5
     im = rio_read_as_array_with_nans(inputf)
 
-    tmp1 = minimum_filter_ignore_nan(im,   size=se)
-    tmp1 = maximum_filter_ignore_nan(tmp1, size=se)
-
-    tmp2 = maximum_filter_ignore_nan(im,   size=se)
-    tmp2 = minimum_filter_ignore_nan(tmp2, size=se)
+    # opening and closing, in two sweeps of the image
+    tmp1, tmp2 = morphology.opening_closing(im, se)
 
     # put to nan if dilation minus erosion is larger than 5
     tmpM = np.where( np.abs(tmp1 - tmp2) > 5, np.nan, im)
 
     # remove small connected components
+    tmpM = morphology.remove_small_cc(tmpM, 200, 5)
     rasterio_write(outputf, tmpM)
-    run('remove_small_cc %s %s %d %d' % (outputf, outputf, 200, 5))
-    #tmpM = specklefilter(tmpM,200,5)
-    #rasterio_write(outputf, tmpM)
 
 
 _t0 = datetime.datetime.now()
@@ -0,0 +1,352 @@
+"""
+compact point cloud tile format
+
+The x, y, z coordinates are stored as int32 with a per-tile scale and offset,
+as in the LAS format, and the other properties (colors, confidence) with their
+own type. The columns are stored in chunks, optionally compressed with zstd.
+
+A file is made of the magic line, a json header line, and the data blocks:
+for each chunk of points, the block of each column.
+
+The export command converts such files to standard formats:
+    s2p-cloud ply out.ply tiles/*/*/cloud.s2pc
+    s2p-cloud las tiles/row_0000000_height_500/col_0000000_width_500/cloud.s2pc out.las
+"""
+
+import re
+import json
+import struct
+import argparse
+
+import numpy as np
+
+from s2p import ply
+from s2p import geographiclib
+
+
+MAGIC = b'S2PC1\n'
+
+# default quantization step of the coordinates, in meters
+SCALE = 1e-3
+
+
+def compress(data, compression):
+    if compression is None:
+        return data
+    if compression == 'zstd':
+        import zstandard
+        return zstandard.ZstdCompressor(level=3).compress(data)
+    raise ValueError('unknown compression: {}'.format(compression))
+
+
+def decompress(data, compression):
+    if compression is None:
+        return data
+    if compression == 'zstd':
+        import zstandard
+        return zstandard.ZstdDecompressor().decompress(data)
+    raise ValueError('unknown compression: {}'.format(compression))
+
+
+def write_compact_cloud(path, coordinates, colors=None, extra_properties=None,
+                        extra_properties_names=None, comments=[], scale=SCALE,
+                        compression=None, chunk_size=1 << 20):
+    """
+    Write a 3D point cloud to a compact cloud file.
+
+    Args:
+        path (str): path to the output file
+        coordinates (array): numpy array of shape (n, 3) containing x, y, z coordinates
+        colors (array): numpy array of shape (n, 3) or (n, 1) containing either
+            r, g, b or gray levels
+        extra_properties (array): optional numpy array of shape (n, k)
+        extra_properties_names (list): list of k strings with the names of the
+            (optional) extra properties
+        comments (list): list of strings containing the header comments
+        scale (float): quantization step of the coordinates
+        compression (str): None or 'zstd'
+        chunk_size (int): number of points per chunk
+    """
+    n = len(coordinates)
+    columns = []
+    arrays = []
+    for i, name in enumerate(['x', 'y', 'z']):
+        c = coordinates[:, i]
+        offset = float(np.floor(np.min(c))) if n else 0.0
+        q = np.round((c - offset) / scale)
+        if n and np.max(q) > np.iinfo(np.int32).max:
+            raise ValueError('{} coordinates span too large for a scale of '
+                             '{}'.format(name, scale))
+        columns.append({'name': name, 'dtype': '<i4', 'scale': scale,
+                        'offset': offset})
+        arrays.append(q.astype('<i4'))
+
+    if colors is not None:
+        if colors.shape[1] == 1:  # replicate grayscale 3 times
+            colors = np.column_stack([colors] * 3)
+        elif colors.shape[1] not in [3, 4]:
+            raise Exception('Error: colors must have either 1, 3 or 4 channels')
+        names = ['red', 'green', 'blue', 'ir'][:colors.shape[1]]
+        for i, name in enumerate(names):
+            arrays.append(colors[:, i])
+            columns.append({'name': name})
+
+    if extra_properties is not None:
+        if extra_properties.ndim == 1:
+            extra_properties = extra_properties[..., None]
+        for i, name in enumerate(extra_properties_names):
+            arrays.append(extra_properties[:, i])
+            columns.append({'name': name})
+
+    for c, a in zip(columns, arrays):
+        c['dtype'] = a.dtype.newbyteorder('<').str
+
+    blocks = []
+    for start in range(0, n, chunk_size):
+        blocks.append([compress(np.ascontiguousarray(a[start:start + chunk_size],
+                                                     dtype=c['dtype']).tobytes(),
+                                compression)
+                       for c, a in zip(columns, arrays)])
+
+    header = {'count': n, 'comments': list(comments),
+              'compression': compression, 'chunk_size': chunk_size,
+              'columns': columns,
+              'blocks': [[len(b) for b in chunk] for chunk in blocks]}
+    if n:
+        header['min'] = np.min(coordinates, axis=0).tolist()
+        header['max'] = np.max(coordinates, axis=0).tolist()
+
+    with open(path, 'wb') as f:
+        f.write(MAGIC)
+        f.write(json.dumps(header).encode() + b'\n')
+        for chunk in blocks:
+            for b in chunk:
+                f.write(b)
+
+
+def read_compact_cloud_header(path):
+    """
+    Read the header of a compact cloud file.
+
+    Args:
+        path (str): path to a compact cloud file
+
+    Returns:
+        the header dictionary, and the position of the data in the file
+    """
+    with open(path, 'rb') as f:
+        if f.readline() != MAGIC:
+            raise ValueError('{} is not a compact cloud file'.format(path))
+        header = json.loads(f.readline())
+        return header, f.tell()
+
+
+def read_compact_cloud_columns(path, names=None, dequantize=True):
+    """
+    Read some columns of a compact cloud file.
+
+    Args:
+        path (str): path to a compact cloud file
+        names (list): names of the columns to read, ignoring those missing
+            from the file. All of them if None
+        dequantize (bool): whether to convert the quantized int32 coordinates
+            to float64
+
+    Returns:
+        dictionary of decoded 1D numpy arrays
+        the header dictionary
+    """
+    header, pos = read_compact_cloud_header(path)
+    columns = header['columns']
+    if names is None:
+        names = [c['name'] for c in columns]
+
+    out = {c['name']: [] for c in columns if c['name'] in names}
+    with open(path, 'rb') as f:
+        f.seek(pos)
+        for sizes in header['blocks']:
+            for c, size in zip(columns, sizes):
+                if c['name'] not in out:
+                    f.seek(size, 1)
+                    continue
+                b = decompress(f.read(size), header['compression'])
+                out[c['name']].append(np.frombuffer(b, dtype=c['dtype']))
+
+    for c in columns:
+        if c['name'] in out:
+            a = np.concatenate(out[c['name']]) if out[c['name']] else np.empty(0, c['dtype'])
+            if dequantize and 'scale' in c:
+                a = a * c['scale'] + c['offset']
+            out[c['name']] = a
+    return {n: out[n] for n in names if n in out}, header
+
+
+def read_compact_cloud(path):
+    """
+    Read a 3D point cloud from a compact cloud file.
+
+    Args:
+        path (str): path to a compact cloud file
+
+    Returns:
+        numpy array with the list of 3D points, one point per line, as
+        ply.read_3d_point_cloud_from_ply
+        list of strings with the header comments
+    """
+    columns, header = read_compact_cloud_columns(path)
+    arrays = list(columns.values())
+    array = np.empty((header['count'], len(arrays)),
+                     dtype=np.result_type(*arrays))
+    for i, a in enumerate(arrays):
+        array[:, i] = a
+    return array, header['comments']
+
+
+def compact_clouds_to_ply(paths, path_to_ply_file):
+    """
+    Concatenate compact clouds into a ply file.
+
+    Args:
+        paths (list): paths to compact cloud files with the same properties
+        path_to_ply_file (str): path to the output .ply file
+    """
+    clouds = [read_compact_cloud_columns(p) for p in paths]
+    columns = {n: np.concatenate([c[n] for c, _ in clouds]) for n in clouds[0][0]}
+    coordinates = np.column_stack([columns.pop(n) for n in 'xyz'])
+    colors = [columns.pop(n) for n in ['red', 'green', 'blue', 'ir'] if n in columns]
+    ply.write_3d_point_cloud_to_ply(
+        path_to_ply_file, coordinates,
+        colors=np.column_stack(colors) if colors else None,
+        extra_properties=np.column_stack(list(columns.values())) if columns else None,
+        extra_properties_names=list(columns), comments=clouds[0][1]['comments'])
+
+
+def read_bounds(path):
+    """
+    Get the number of points and the bounding box of a compact point cloud.
+
+    Args:
+        path (str): path to a compact cloud file
+
+    Returns:
+        number of points, and two arrays with the minimal and maximal x, y, z
+        coordinates (None if the cloud is empty)
+    """
+    header, _ = read_compact_cloud_header(path)
+    if header['count'] == 0:
+        return 0, None, None
+    return header['count'], np.array(header['min']), np.array(header['max'])
+
+
+def geokeys(crs):
+    """
+    GeoTIFF keys directory of the LAS projection record of a CRS.
+
+    Args:
+        crs (pyproj.crs.CRS): projected, or compound projected and vertical CRS
+
+    Returns:
+        list of uint16, or None if the CRS has no EPSG code
+    """
+    horizontal, vertical = crs, None
+    if crs.is_compound:
+        horizontal, vertical = crs.sub_crs_list[:2]
+    epsg = horizontal.to_epsg()
+    if epsg is None:
+        return None
+    # GTModelTypeGeoKey (projected), GTRasterTypeGeoKey (pixel is area) and
+    # ProjectedCSTypeGeoKey, then optionally VerticalCSTypeGeoKey
+    keys = [[1024, 0, 1, 1], [1025, 0, 1, 1], [3072, 0, 1, epsg]]
+    if vertical is not None and vertical.to_epsg() is not None:
+        keys.append([4096, 0, 1, vertical.to_epsg()])
+    return [1, 1, 0, len(keys)] + sum(keys, [])
+
+
+def compact_cloud_to_las(path, las_path):
+    """
+    Export a compact cloud file to a LAS 1.2 file (point data format 2).
+
+    The quantized coordinates and their scales and offsets are copied as is,
+    the 8-bit colors are expanded to 16 bits. The other properties are
+    dropped. The CRS found in the "projection: CRS ..." comment is written in
+    a GeoKeyDirectoryTag record if it has an EPSG code.
+
+    Args:
+        path (str): path to a compact cloud file
+        las_path (str): path to the output .las file
+    """
+    raw, header = read_compact_cloud_columns(
+        path, ['x', 'y', 'z', 'red', 'green', 'blue'], dequantize=False)
+    n = header['count']
+
+    points = np.zeros(n, dtype=[('X', '<i4'), ('Y', '<i4'), ('Z', '<i4'),
+                                ('intensity', '<u2'), ('flags', 'u1'),
+                                ('classification', 'u1'),
+                                ('scan_angle', 'i1'), ('user_data', 'u1'),
+                                ('point_source_id', '<u2'), ('red', '<u2'),
+                                ('green', '<u2'), ('blue', '<u2')])
+    for k, name in zip(['X', 'Y', 'Z'], ['x', 'y', 'z']):
+        points[k] = raw[name]
+    points['flags'] = 0b00001001  # return 1 of 1
+    for name in ['red', 'green', 'blue']:
+        if name in raw:
+            points[name] = raw[name].astype(np.uint16) * 257
+
+    # georeferencing record
+    vlrs = b''
+    crs = None
+    for comment in header['comments']:
+        s = re.search(r'^projection: CRS (.*)', comment)
+        if s:
+            crs = geographiclib.pyproj_crs(s.group(1))
+    keys = geokeys(crs) if crs is not None else None
+    if keys is not None:
+        data = struct.pack('<{}H'.format(len(keys)), *keys)
+        vlrs = struct.pack('<H16sHH32s', 0, b'LASF_Projection', 34735,
+                           len(data), b'GeoKeyDirectoryTag') + data
+
+    cols = {c['name']: c for c in header['columns']}
+    scales = [cols[k]['scale'] for k in 'xyz']
+    offsets = [cols[k]['offset'] for k in 'xyz']
+    bmin = header.get('min', [0, 0, 0])
+    bmax = header.get('max', [0, 0, 0])
+    header_size = 227
+    las_header = struct.pack(
+        '<4sHHIHH8sBB32s32sHHHIIBHI5I3d3d6d',
+        b'LASF', 0, 0, 0, 0, 0, b'\0' * 8, 1, 2,
+        b'S2P'.ljust(32, b'\0'), b's2p compact_cloud'.ljust(32, b'\0'),
+        0, 0, header_size, header_size + len(vlrs), int(keys is not None),
+        2, points.dtype.itemsize, n, n, 0, 0, 0, 0,
+        *scales, *offsets,
+        bmax[0], bmin[0], bmax[1], bmin[1], bmax[2], bmin[2])
+    assert len(las_header) == header_size
+
+    with open(las_path, 'wb') as f:
+        f.write(las_header)
+        f.write(vlrs)
+        points.tofile(f)
+
+
+def main():
+    """
+    Command line interface of the compact clouds export.
+    """
+    parser = argparse.ArgumentParser(description='S2P: compact point clouds export')
+    subparsers = parser.add_subparsers(dest='format', required=True)
+    p = subparsers.add_parser('ply', help='concatenate compact clouds into a ply file')
+    p.add_argument('ply', help='path to the output .ply file')
+    p.add_argument('clouds', nargs='+', metavar='cloud.s2pc',
+                   help='paths to the compact clouds, with the same properties')
+    p = subparsers.add_parser('las', help='export a compact cloud to a LAS file')
+    p.add_argument('cloud', metavar='cloud.s2pc', help='path to the compact cloud')
+    p.add_argument('las', help='path to the output .las file')
+    args = parser.parse_args()
+
+    if args.format == 'ply':
+        compact_clouds_to_ply(args.clouds, args.ply)
+    else:
+        compact_cloud_to_las(args.cloud, args.las)
+
+
+if __name__ == '__main__':
+    main()
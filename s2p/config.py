@@ -53,7 +53,32 @@ def get_default_config() -> dict:
     # It should be set if 'max_processes_stereo_matching' is not set.
     cfg['gpu_total_memory'] = None
 
-    # max number of OMP threads used by programs compiled with openMP
+    # with two input images, run the rectification, stereo matching and
+    # triangulation of each tile in a single worker. The intermediate rasters
+    # are written to 'temporary_dir' (preferably a local disk) and removed, only
+    # the point clouds are written to 'out_dir'
+    cfg['tile_pipeline_in_memory'] = False
+
+    # with 'tile_pipeline_in_memory', also keep the homographies, disparity range,
+    # rectified reference crop, disparity map and mask in the tile directories
+    cfg['tile_pipeline_checkpoints'] = False
+
+    # scheduling of the tilewise steps:
+    #   "barrier": each step is run on all the tiles before starting the next one
+    #   "dag": steps 3 to 6 are run on each tile as soon as its inputs (and its
+    #          neighbors' point clouds for the DSM rasterization) are ready.
+    #          'stereoanywhere_batch_size' is ignored in this mode
+    cfg['scheduler'] = "barrier"
+
+    # use the same pools of worker processes for all the steps of a run, instead
+    # of new pools per step: one for the stereo matching calls, with
+    # 'max_processes_stereo_matching' workers, and one for the other calls. The
+    # workers import s2p (and the stereo matching module) once, and keep them
+    # loaded until the end of the run
+    cfg['persistent_pool'] = False
+
+    # max number of OMP threads used by programs compiled with openMP, and by
+    # the triangulation and 3D filtering kernels of disp_to_h.so
     cfg['omp_num_threads'] = 1
 
     # timeout in seconds, after which a function that runs on a single tile is not
@@ -63,6 +88,21 @@ def get_default_config() -> dict:
     # debug mode (more verbose logs and intermediate results saved)
     cfg['debug'] = False
 
+    # record the wall and CPU times, peak memory, I/O and subprocess time of
+    # each tilewise call and of each step in out_dir/telemetry.jsonl. Summarize
+    # it with "s2p-telemetry out_dir/telemetry.jsonl"
+    cfg['telemetry'] = False
+
+    # names of the tilewise functions to profile with cProfile, e.g.
+    # ["stereo_matching", "disparity_to_ply", "plys_to_dsm"]. The profile of
+    # each call is written next to its stdout.log, and the profiles are merged
+    # in out_dir/profile.prof (and summarized in out_dir/profile.txt) at the
+    # end of the run
+    cfg['profile_functions'] = []
+
+    # fraction of the tiles profiled, chosen deterministically from their labels
+    cfg['profile_fraction'] = 1.0
+
     # resolution of the output digital surface model, in meters per pixel
     cfg['dsm_resolution'] = 4
 
@@ -194,6 +234,27 @@ def get_default_config() -> dict:
     cfg['3d_filtering_radius_gsd'] = None  # radius of the sphere as number of GSDs : usually set to 3 or 5
     cfg['3d_filtering_fill_factor'] = None  # number of points as fraction of the disk for the given radius : usually set to 1/3 or 1/4
 
+    # format of the tiles point clouds:
+    #   "ply": binary ply files (cloud.ply) with float64 coordinates
+    #   "compact": compact_cloud files (cloud.s2pc) with int32 coordinates
+    #              quantized to the millimeter, 1.6 to 2.2x smaller, exported
+    #              to ply or LAS files with the s2p-cloud command
+    cfg['cloud_format'] = "ply"
+
+    # compression of the compact clouds: None or "zstd" (needs the zstandard package)
+    cfg['cloud_compression'] = None
+
+    # Rasterize the triangulated points of each tile directly into a DSM
+    # accumulator (dsm_accumulator.tif: sums of weights, max height and
+    # weighted sums of the height, colors and confidence), and compute the DSM
+    # of each tile from its accumulator and the overlapping strips of its
+    # neighbors' ones, instead of rasterizing the point clouds with plyflatten.
+    # Uses dsm_resolution, dsm_radius, dsm_sigma and dsm_aggregation_with_max.
+    cfg['direct_rasterization'] = False
+
+    # Write the point clouds of the tiles when direct_rasterization is set
+    # (they are always written otherwise)
+    cfg['write_clouds'] = True
 
     # clean height maps outliers
     cfg['cargarse_basura'] = True
@@ -221,6 +282,18 @@ def get_default_config() -> dict:
     # This speeds-up the triangulation step if the localization rpc is not provided in the images.
     cfg['fit_localization_rpc'] = False
 
+    # Maximal error (in meters) of the localization grids used to speed-up the
+    # SIFT matches refinement and the height maps to point clouds conversion.
+    # The localization function is interpolated on a per-tile grid, refined
+    # until this error is reached, e.g. 0.01. None to always use the exact
+    # model.
+    cfg['localization_grid_max_error'] = None
+
+    # Evaluate the RPC projection and localization functions with the compiled
+    # kernels of the rpc_kernels module instead of rpcm. Batches of more than
+    # 65536 points use omp_num_threads threads.
+    cfg['compiled_rpc'] = False
+
     # Maximum allowed altitude span (in meters) among triangulated SIFT matches.
     # If the span exceeds this value, it is assumed that some matches are likely incorrect.
     # In that case, only points within median altitude ± 'altitude_margin' are kept.
@@ -236,6 +309,14 @@ def get_default_config() -> dict:
     # "min" or "max": pixel-wise (min or max) of existing and new
     cfg['dsm_merging_method'] = "max"
 
+    # How the tiles DSMs are assembled into the global ones:
+    #   "merge": dsm.tif, dsm-filtered.tif and confidence.tif mosaics
+    #   "vrt": dsm.vrt, dsm-filtered.vrt and confidence.vrt virtual rasters
+    #          referencing the tiles rasters, written instantly. The tiles
+    #          rasters get overviews, used by the virtual overviews of the VRTs.
+    #          The "min" and "max" merging methods need GDAL >= 3.8
+    cfg['global_dsm_mode'] = "merge"
+
     # Flag to configure the range of the disparity map.
     cfg['disp_range_flag'] = "positive"
 
@@ -243,6 +324,38 @@ def get_default_config() -> dict:
     cfg['stereo_ckpt'] = None  # Path to the stereoanywhere checkpoint
     cfg['mono_ckpt'] = None  # Path to the monoanywhere checkpoint
 
+    # keep the stereoanywhere models loaded in each stereo matching worker and
+    # reuse them for all the tiles it processes, instead of reloading the
+    # checkpoints for every tile
+    cfg['stereoanywhere_persistent_engine'] = False
+
+    # number of rectified pairs of similar sizes processed in a single forward
+    # pass by stereoanywhere. 1 disables the batched mode
+    cfg['stereoanywhere_batch_size'] = 1
+
+    # memory budget of a batched stereoanywhere forward pass, in MB. If None,
+    # 'gpu_total_memory' divided by the number of stereo matching workers is
+    # used, if set, otherwise only 'stereoanywhere_batch_size' limits the batches
+    cfg['stereoanywhere_batch_memory'] = None
+
+    # peak memory target of stereoanywhere, in MB (model weights included).
+    # If set, each rectified pair is processed by overlapping horizontal windows
+    # small enough to fit in this budget, and the overlaps are blended
+    cfg['stereoanywhere_max_memory'] = None
+
+    # number of rows shared by consecutive stereoanywhere windows
+    cfg['stereoanywhere_window_overlap'] = 64
+
+    # use the disparity range estimated by s2p with stereoanywhere: the secondary
+    # image is shifted by the center of the range, the number of GRU iterations
+    # is proportional to the width of the range, and the disparities outside of
+    # the range are rejected
+    cfg['stereoanywhere_use_disp_range'] = False
+
+    # stop the stereoanywhere GRU iterations once the mean absolute disparity
+    # update (in pixels at 1/4 resolution) is below this value. None disables it
+    cfg['stereoanywhere_flow_tol'] = None
+
     cfg['horizontal_translation_margin'] = 0.0  # Margin to add to the horizontal translation for disparity range adjustment
 
     return cfg
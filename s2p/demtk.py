@@ -100,7 +100,7 @@ def cross_median(d,p=3):
 
 
 def fill_nans_by_laplace_equation(xx):
-	from numpy import isnan
+	from numpy import isnan, where
 	from scipy.sparse import eye, diags
 	from scipy.sparse.linalg import spsolve
 	s = xx.shape                    # shape of the image domain
@@ -109,12 +109,12 @@ def fill_nans_by_laplace_equation(xx):
 	M = diags(0.0 + isnan(x))       # complementary mask operator
 	I = eye(s[0] * s[1])            # identity matrix
 	A = M @ L + I - M               # left hand-side matrix of the system
-	b = (I - M) @ x                 # right hand side vector
+	b = (I - M) @ where(isnan(x), 0, x)  # right hand side vector
 	u = spsolve(A.T @ A, A.T @ b)   # solve the symmetrized system
 	return u.reshape(s[0], s[1])    # reshape and return
 
 def descending_neumann_interpolation(xx):
-	from numpy import isnan
+	from numpy import isnan, where
 	from scipy.sparse import eye, diags
 	from scipy.sparse.linalg import spsolve
 	s = xx.shape                    # shape of the image domain
@@ -126,7 +126,7 @@ def descending_neumann_interpolation(xx):
 	L = -B.T @ B                    # laplacian matrix
 
 	A = M @ L + I - M               # left hand-side matrix of the system
-	b = (I - M) @ x                 # right hand side vector
+	b = (I - M) @ where(isnan(x), 0, x)  # right hand side vector
 	u = spsolve(A.T @ A, A.T @ b)   # solve the symmetrized system
 
 	n = 0 <= (B@m) * (B@u)          # descending edge complementary mask
@@ -135,10 +135,96 @@ def descending_neumann_interpolation(xx):
 	L = -B.T @ B                    # laplacian matrix
 
 	A = M @ L + I - M               # left hand-side matrix of the system
-	b = (I - M) @ x                 # right hand side vector
+	b = (I - M) @ where(isnan(x), 0, x)  # right hand side vector
 	u = spsolve(A.T @ A, A.T @ b)   # solve the symmetrized system
 	return u.reshape(s[0], s[1])    # reshape and return
 
+def solve_spd(A, b, x0, direct_size=4096):
+	from scipy.sparse.linalg import cg, spsolve
+	if len(b) <= direct_size:       # small systems: sparse direct solver
+		return spsolve(A.tocsc(), b)
+	u, _ = cg(A.tocsr(), b, x0=x0, rtol=1e-10)  # large systems: conjugate gradient
+	return u
+
+def hole_laplace_system(P, Q, m, x, k):
+	# laplace equation at the unknown pixels, on the graph of edges (P, Q),
+	# restricted to the unknowns. k maps the unknown pixels to their index
+	from numpy import bincount, concatenate, ones
+	from scipy.sparse import coo_matrix
+	n = m.sum()
+	p = concatenate([P, Q])         # each edge appears in the rows of
+	q = concatenate([Q, P])         # both its endpoints
+	e = m[p]                        # rows of the unknowns
+	p, q = p[e], q[e]
+	o = m[q]                        # edges between two unknowns
+	d = bincount(k[p], minlength=n)  # degrees
+	A = coo_matrix((concatenate([d, -ones(o.sum())]),
+	                (concatenate([range(n), k[p[o]]]),
+	                 concatenate([range(n), k[q[o]]]))), shape=(n, n))
+	b = bincount(k[p[~o]], weights=x[q[~o]], minlength=n)
+	return A, b
+
+def descending_neumann_interpolation_of_hole(xx, mm):
+	from numpy import arange, concatenate, flatnonzero, full, isnan, where
+	s = xx.shape                    # shape of the crop
+	m = mm.flatten()                # mask of the hole
+	x = xx.flatten()                # flattened data
+	x = where(isnan(x), 0, x)       # other holes are not adjacent to this one
+	U = flatnonzero(m)              # indices of the unknowns
+	k = full(x.size, -1)
+	k[U] = arange(len(U))
+
+	# edges (P, Q) of the grid touching the hole, oriented as in grid_incidence
+	i = arange(x.size).reshape(s)
+	P = concatenate([i[:, :-1].ravel(), i[:-1, :].ravel()])
+	Q = concatenate([i[:, 1:].ravel(), i[1:, :].ravel()])
+	e = m[P] | m[Q]
+	P, Q = P[e], Q[e]
+
+	u = x.copy()
+	u[U] = x[~m].mean()             # initial guess
+	A, b = hole_laplace_system(P, Q, m, x, k)
+	u[U] = solve_spd(A, b, u[U])
+
+	n = 0 <= (0.0 + m[Q] - m[P]) * (u[Q] - u[P])  # descending edge complementary mask
+	P, Q = P[n], Q[n]               # new graph without descending edges
+
+	A, b = hole_laplace_system(P, Q, m, x, k)
+	u[U] = solve_spd(A, b, u[U])
+	return u.reshape(s[0], s[1])    # reshape and return
+
+def descending_neumann_interpolation_local(xx, workers=1):
+	"""
+	Same as descending_neumann_interpolation, solved independently on each
+	connected component of NaNs (plus a one pixel ring around it), so that
+	the cost depends on the area of the holes instead of the area of the DEM
+
+	Input  xx      : DEM with NANs
+	Input  workers : number of threads used to fill the holes
+	Output u       : DEM without NANs
+	"""
+	from numpy import isnan
+	from scipy.ndimage import label, find_objects
+	from concurrent.futures import ThreadPoolExecutor
+	lab, n = label(isnan(xx))       # 4-connected holes are independent
+	u = xx.astype(float)
+
+	def fill(k, box):
+		r = tuple(slice(max(t.start - 1, 0), t.stop + 1) for t in box)
+		m = lab[r] == k + 1
+		if m.all():             # nothing to interpolate from
+			return r, m, xx[r]
+		return r, m, descending_neumann_interpolation_of_hole(xx[r], m)
+
+	if workers > 1:
+		with ThreadPoolExecutor(workers) as e:
+			filled = list(e.map(fill, range(n), find_objects(lab)))
+	else:
+		filled = map(fill, range(n), find_objects(lab))
+	for r, m, v in filled:
+		u[r][m] = v[m]
+	return u
+
 
 
 # API: d = demtk.fuse(D)
@@ -4,10 +4,11 @@
 # Copyright (C) 2015, Julien Michel <julien.michel@cnes.fr>
 
 import os
-import sys
 import shutil
+import warnings
 import numpy as np
 import rasterio
+import rasterio.windows
 
 from s2p import common
 
@@ -21,10 +22,60 @@ def average_if_close(x, threshold):
         return np.nanmedian(x)
 
 
-def merge_n(output, inputs, offsets, averaging='average_if_close', threshold=1, debug=False):
+def average_if_close_stack(x, threshold):
+    """
+    Vectorized version of average_if_close, applied along the last axis.
+
+    Args:
+        x: numpy array of shape (..., n)
+        threshold: maximal spread allowed between the values of a 1D slice
+
+    Returns:
+        numpy array of shape (...) containing the nanmedian of each slice, or
+        NaN where the slice spread is larger than threshold
+    """
+    with warnings.catch_warnings():
+        warnings.simplefilter('ignore', RuntimeWarning)  # all-NaN slices
+        spread = np.nanmax(x, axis=-1) - np.nanmin(x, axis=-1)
+        avg = np.nanmedian(x, axis=-1)
+    avg[spread > threshold] = np.nan
+    return avg
+
+
+def stack_operator(averaging, threshold=1):
+    """
+    Return a function that reduces a stack of images along its last axis.
+
+    Args:
+        averaging: 'average_if_close' or name of a numpy reduction function,
+            prefixed with 'np.' or 'numpy.'
+        threshold: threshold used by the 'average_if_close' operator
+
+    Returns:
+        function that takes a numpy array of shape (..., n) and returns a
+        numpy array of shape (...)
+    """
+    if averaging.startswith(('np.', 'numpy.')):
+        f = getattr(np, averaging.split('.')[1])
+
+        def reduce(x):
+            with warnings.catch_warnings():
+                warnings.simplefilter('ignore', RuntimeWarning)  # all-NaN slices
+                return f(x, axis=-1)
+        return reduce
+    elif averaging == 'average_if_close':
+        return lambda x: average_if_close_stack(x, threshold)
+    else:
+        raise ValueError('unknown fusion operator: {}'.format(averaging))
+
+
+def merge_n(output, inputs, offsets, averaging='average_if_close', threshold=1,
+            debug=False, block_rows=256):
     """
     Merge n images of equal sizes by taking the median/mean/min/max pixelwise.
 
+    The images are processed by blocks of rows to keep memory bounded.
+
     Args:
         inputs: list of paths to the input images
         output: path to the output image
@@ -33,35 +84,37 @@ def merge_n(output, inputs, offsets, averaging='average_if_close', threshold=1,
             the last axis. Possible values are, for instance np.min, np.max,
             np.mean, np.median and their nanproof counterparts, ie np.nanmin,
             np.nanmax, np.nanmean, np.nanmedian
+        block_rows: number of rows processed at once
     """
     assert(len(inputs) == len(offsets))
+    if not inputs:
+        return
 
-    # get input images size
-    if inputs:
-        with rasterio.open(inputs[0], 'r') as f:
-            h, w = f.shape
-
-    # read input images and apply offsets
-    x = np.empty((h, w, len(inputs)))
-    for i, img in enumerate(inputs):
-        with rasterio.open(img, 'r') as f:
-            x[:, :, i] = f.read(1) - offsets[i]
-        if debug:
-            common.rasterio_write('{}_registered.tif'.format(os.path.splitext(img)[0]),
-                                  x[:, :, i] + np.mean(offsets))
-
-    # apply the averaging operator
-    if averaging.startswith(('np.', 'numpy.')):
-        avg = np.apply_along_axis(getattr(sys.modules['numpy'], averaging.split('.')[1]),
-                                  axis=2, arr=x)
-    elif averaging == 'average_if_close':
-        avg = np.apply_along_axis(average_if_close, 2, x, threshold)
+    reduce = stack_operator(averaging, threshold)
+    mean_offset = np.mean(offsets)
+
+    if debug:
+        for img, offset in zip(inputs, offsets):
+            with rasterio.open(img, 'r') as f:
+                common.rasterio_write('{}_registered.tif'.format(os.path.splitext(img)[0]),
+                                      f.read(1) - offset + mean_offset)
+
+    shutil.copy(inputs[0], output)  # copy an input file to get the metadata
+    srcs = [rasterio.open(img, 'r') for img in inputs]
+    try:
+        h, w = srcs[0].shape
+        with rasterio.open(output, 'r+') as dst:
+            for row in range(0, h, block_rows):
+                window = rasterio.windows.Window(0, row, w, min(block_rows, h - row))
 
-    # add the mean offset
-    avg += np.mean(offsets)
+                # read the input blocks and apply offsets
+                x = np.empty((window.height, w, len(inputs)))
+                for i, f in enumerate(srcs):
+                    x[:, :, i] = f.read(1, window=window) - offsets[i]
 
-    # write the average to output
-    if inputs:
-        shutil.copy(inputs[0], output)  # copy an input file to get the metadata
-        with rasterio.open(output, 'r+') as f:
-            f.write(np.asarray([avg]).astype('float32'))  # update the output file content
+                # apply the averaging operator and add the mean offset
+                avg = reduce(x) + mean_offset
+                dst.write(avg.astype('float32'), 1, window=window)
+    finally:
+        for f in srcs:
+            f.close()
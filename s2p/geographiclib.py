@@ -3,6 +3,9 @@
 # Copyright (C) 2015, Enric Meinhardt <enric.meinhardt@cmla.ens-cachan.fr>
 # Copyright (C) 2015, Julien Michel <julien.michel@cnes.fr>
 
+import functools
+import threading
+
 import geojson
 from distutils.version import LooseVersion
 
@@ -116,9 +119,61 @@ def pyproj_crs(projparams):
             projparams = int(projparams)
         except (ValueError, TypeError):
             pass
+    try:
+        return cached_pyproj_crs(projparams)
+    except TypeError:  # unhashable parameters, e.g. a dict
+        return pyproj.crs.CRS(projparams)
+
+
+@functools.lru_cache(maxsize=64)
+def cached_pyproj_crs(projparams):
     return pyproj.crs.CRS(projparams)
 
 
+@functools.lru_cache(maxsize=64)
+def cached_transformer(in_crs, out_crs, thread_id):
+    return pyproj.Transformer.from_crs(in_crs, out_crs, always_xy=True)
+
+
+def pyproj_transformer(in_crs, out_crs):
+    """
+    Return a pyproj Transformer from a CRS to another, with the (x, y) axis
+    order. Transformers are built once per thread and pair of CRS.
+
+    Args:
+        in_crs (pyproj.crs.CRS or int): input coordinate reference system or EPSG code
+        out_crs (pyproj.crs.CRS or int): output coordinate reference system or EPSG code
+
+    Returns:
+        pyproj.Transformer object
+    """
+    return cached_transformer(in_crs, out_crs, threading.get_ident())
+
+
+def pyproj_transform_finite(xyz, in_crs, out_crs):
+    """
+    Convert in place the finite points of an array of 3D points from a CRS to
+    another. Points with non-finite coordinates are left untouched.
+
+    Args:
+        xyz (np.ndarray): C-contiguous float64 array of shape (..., 3)
+        in_crs (pyproj.crs.CRS or int): input coordinate reference system or EPSG code
+        out_crs (pyproj.crs.CRS or int): output coordinate reference system or EPSG code
+
+    Returns:
+        xyz, with its finite points expressed in out_crs
+    """
+    pts = xyz.reshape(-1, 3)
+    assert np.shares_memory(pts, xyz), 'expecting a C-contiguous array'
+    valid = np.flatnonzero(np.all(np.isfinite(pts), axis=1))
+    if valid.size:
+        # pyproj works in place only on contiguous arrays
+        x, y, z = pts[valid, 0], pts[valid, 1], pts[valid, 2]
+        pyproj_transformer(in_crs, out_crs).transform(x, y, z, inplace=True)
+        pts[valid, 0], pts[valid, 1], pts[valid, 2] = x, y, z
+    return xyz
+
+
 def pyproj_transform(x, y, in_crs, out_crs, z=None):
     """
     Wrapper around pyproj to convert coordinates from an EPSG system to another.
@@ -135,7 +190,7 @@ def pyproj_transform(x, y, in_crs, out_crs, z=None):
         scalar or array: y coordinate(s), expressed in out_crs
         scalar or array (optional if z): z coordinate(s), expressed in out_crs
     """
-    transformer = pyproj.Transformer.from_crs(in_crs, out_crs, always_xy=True)
+    transformer = pyproj_transformer(in_crs, out_crs)
     if z is None:
         return transformer.transform(x, y)
     else:
@@ -221,7 +276,7 @@ def crs_bbx(ll_poly, crs=None, align=None):
         crs = pyproj_crs(epsg)
 
     # convert lon lat polygon to target CRS
-    transformer = pyproj.Transformer.from_crs("epsg:4326", crs, always_xy=True)
+    transformer = pyproj_transformer("epsg:4326", crs)
     easting, northing = transformer.transform(ll_poly[:, 0], ll_poly[:, 1])
 
     # CRS bounding box
@@ -16,6 +16,7 @@ from typing import List, Tuple
 from s2p import common
 from s2p import geographiclib
 from s2p import rpc_utils
+from s2p import rpc_kernels
 from s2p import masking
 from s2p import parallel
 from s2p.tile import Tile
@@ -146,6 +147,12 @@ def build_cfg(cfg, user_cfg: dict) -> None:
     # with the content of the user_cfg dictionary
     cfg.update(user_cfg)
 
+    # evaluate the camera models with compiled kernels
+    if cfg['compiled_rpc']:
+        for img in cfg['images']:
+            img['rpcm'] = rpc_kernels.CompiledRPCModel(img['rpcm'],
+                                                       nb_threads=cfg['omp_num_threads'])
+
     # set keys 'clr', 'cld' and 'roi' of the reference image to None if they
     # are not already defined. The default values of these optional arguments
     # can not be defined directly in the config.py module. They would be
@@ -10,6 +10,7 @@ import warnings
 import rasterio
 
 from s2p import common
+from s2p import morphology
 
 # silent rasterio NotGeoreferencedWarning
 warnings.filterwarnings("ignore",
@@ -95,4 +96,6 @@ def erosion(out, msk, radius):
         radius (in pixels): size of the disk used for the erosion
     """
     if radius >= 2:
-        common.run('morsi disk%d erosion %s %s' % (int(radius), msk, out))
\ No newline at end of file
+        with rasterio.open(msk, 'r') as f:
+            mask = f.read(1)
+        common.rasterio_write(out, morphology.erosion(mask, int(radius)))
\ No newline at end of file
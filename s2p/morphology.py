@@ -0,0 +1,198 @@
+"""
+in-process mathematical morphology and connected components filtering
+
+NaN pixels are ignored by all the filters, as are the pixels outside of the
+image domain.
+"""
+
+import numpy as np
+from numba import jit
+from scipy import ndimage
+
+from s2p.specklefilter import find
+
+
+def disk(radius):
+    """
+    Discrete disk structuring element, same as the "diskR" element of morsi.
+
+    Args:
+        radius (float): radius of the disk, in pixels
+
+    Returns:
+        2D boolean numpy array, True on the pixels (i, j) such that
+        hypot(i, j) < radius
+    """
+    r = int(radius) + 1
+    i, j = np.mgrid[-r:r+1, -r:r+1]
+    return np.hypot(i, j) < radius
+
+
+def erosion(x, radius):
+    """
+    Erosion of an image by a disk, ignoring NaNs.
+
+    This replaces the "morsi diskR erosion" command.
+
+    Args:
+        x: 2D numpy array
+        radius (float): radius of the disk, in pixels
+
+    Returns:
+        numpy array with the same shape and dtype as x
+    """
+    footprint = disk(radius)
+    # for a disk centered on an image pixel, the nearest image pixel of an
+    # outside position is also in the disk, so 'nearest' ignores the outside
+    if not np.issubdtype(x.dtype, np.floating):
+        return ndimage.minimum_filter(x, footprint=footprint, mode='nearest')
+    y = ndimage.minimum_filter(np.where(np.isnan(x), np.inf, x),
+                               footprint=footprint, mode='nearest')
+    return np.where(np.isinf(y), np.nan, y).astype(x.dtype)
+
+
+@jit(nopython=True, cache=True)
+def _minmax_rows(a, b, size):
+    # running min of a and running max of b along the rows. NaN comparisons
+    # are always false, so NaNs are skipped and empty windows give +/-inf
+    h, w = a.shape
+    mn = np.empty((h, w), dtype=np.float64)
+    mx = np.empty((h, w), dtype=np.float64)
+    for j in range(h):
+        for i in range(w):
+            lo = np.inf
+            hi = -np.inf
+            for k in range(max(0, i - size // 2), min(w, i + (size - 1) // 2 + 1)):
+                if a[j, k] < lo:
+                    lo = a[j, k]
+                if b[j, k] > hi:
+                    hi = b[j, k]
+            mn[j, i] = lo
+            mx[j, i] = hi
+    return mn, mx
+
+
+@jit(nopython=True, cache=True)
+def _minmax_cols(a, b, size):
+    # same as _minmax_rows, along the columns. The loops are ordered to read
+    # the arrays row by row
+    h, w = a.shape
+    mn = np.full((h, w), np.inf)
+    mx = np.full((h, w), -np.inf)
+    for j in range(h):
+        for k in range(max(0, j - size // 2), min(h, j + (size - 1) // 2 + 1)):
+            for i in range(w):
+                if a[k, i] < mn[j, i]:
+                    mn[j, i] = a[k, i]
+                if b[k, i] > mx[j, i]:
+                    mx[j, i] = b[k, i]
+    return mn, mx
+
+
+def _minmax(a, b, size):
+    """
+    Square window min filter of a and max filter of b, in a single sweep.
+    Empty windows are set to +inf for the min and -inf for the max.
+    """
+    mn, mx = _minmax_rows(a, b, size)
+    return _minmax_cols(mn, mx, size)
+
+
+def _inf_to_nan(x):
+    return np.where(np.isinf(x), np.nan, x)
+
+
+def minmax_filter(x, size):
+    """
+    NaN-aware minimum and maximum filters over a square window, computed
+    in a single sweep of the image.
+
+    Args:
+        x: 2D numpy array
+        size (int): side of the square window, in pixels
+
+    Returns:
+        two float64 numpy arrays with the minimum and maximum filtered
+        images. Windows without valid values give NaN.
+    """
+    mn, mx = _minmax(x, x, size)
+    return _inf_to_nan(mn), _inf_to_nan(mx)
+
+
+def gradient(x, size):
+    """
+    NaN-aware morphological gradient (dilation minus erosion) over a square
+    window.
+
+    Args:
+        x: 2D numpy array
+        size (int): side of the square window, in pixels
+
+    Returns:
+        float64 numpy array
+    """
+    mn, mx = minmax_filter(x, size)
+    return mx - mn
+
+
+def opening_closing(x, size):
+    """
+    NaN-aware opening and closing over a square window.
+
+    The erosion and dilation are computed in the same sweep, then the
+    dilation of the erosion and the erosion of the dilation in a second one.
+
+    Args:
+        x: 2D numpy array
+        size (int): side of the square window, in pixels
+
+    Returns:
+        two float64 numpy arrays with the opening and closing of x
+    """
+    mn, mx = minmax_filter(x, size)
+    closing, opening = _minmax(mx, mn, size)
+    return _inf_to_nan(opening), _inf_to_nan(closing)
+
+
+@jit(nopython=True, cache=True)
+def _cc_labels(x, threshold):
+    # labels of the 4-connected components of non-NaN pixels, two neighbors
+    # being connected if their difference is smaller than threshold
+    h, w = x.shape
+    idx = np.arange(h * w).reshape((h, w))
+    for j in range(h):
+        for i in range(w):
+            if i > 0 and abs(x[j, i] - x[j, i-1]) < threshold:
+                a = find(j*w + i, idx)
+                b = find(j*w + i - 1, idx)
+                if a != b:
+                    idx.flat[a] = b
+            if j > 0 and abs(x[j, i] - x[j-1, i]) < threshold:
+                a = find(j*w + i, idx)
+                b = find((j-1)*w + i, idx)
+                if a != b:
+                    idx.flat[a] = b
+    lab = np.empty((h, w), dtype=np.int64)
+    for k in range(h * w):
+        lab.flat[k] = find(k, idx)
+    return lab
+
+
+def remove_small_cc(x, min_area, threshold=np.inf):
+    """
+    Remove the small connected components of non-NaN values of an image.
+
+    This replaces the remove_small_cc command.
+
+    Args:
+        x: 2D numpy array
+        min_area (int): components with at most min_area pixels are removed
+        threshold (float): two neighboring pixels belong to the same
+            component if their difference is smaller than threshold
+
+    Returns:
+        copy of x with the pixels of the removed components set to NaN
+    """
+    lab = _cc_labels(x, threshold)
+    area = np.bincount(lab.ravel(), minlength=lab.size)
+    return np.where(area[lab] <= min_area, np.nan, x)
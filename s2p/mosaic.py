@@ -0,0 +1,347 @@
+"""
+streaming mosaic of tilewise rasters
+
+The output GeoTIFFs are created once with their final size, and filled chunk
+by chunk. Each chunk, made of whole output blocks, is assembled in memory from
+the windows of the tiles intersecting it, read once for all the products, and
+written once. The merging method is applied only where the windows of several
+tiles overlap. The chunks are processed by a pool of threads, and the writes
+to each output file are serialized by a lock.
+
+Alternatively, the mosaics can be written as virtual rasters (VRT) referencing
+the rasters of the tiles, without reading them.
+"""
+
+import os
+import threading
+import xml.etree.ElementTree as ET
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+import affine
+import rasterio
+import rasterio.windows
+from rasterio.enums import Resampling
+
+
+# merging methods of rasterio.merge.merge, with NaN as nodata: the new values
+# are merged into the old ones
+METHODS = {'first': lambda old, new: np.where(np.isnan(old), new, old),
+           'last': lambda old, new: np.where(np.isnan(new), old, new),
+           'min': np.fmin,
+           'max': np.fmax}
+
+
+def mosaic_grid(tiles, res, bounds=None):
+    """
+    Compute the grid of a mosaic and the position of the tiles in it.
+
+    The tiles are assumed to be on grids aligned with the mosaic grid, as the
+    DSMs of the tiles of s2p: their offsets are rounded to the nearest pixel.
+
+    Args:
+        tiles (list): one dict per tile, mapping product names to the paths of
+            the rasters of the tile, which all share the same grid
+        res (float): resolution of the mosaic
+        bounds (tuple): left, bottom, right, top bounds of the mosaic. The
+            union of the tiles if None
+
+    Returns:
+        transform, width and height of the mosaic, crs and dtype of the tiles,
+        and array of shape (n, 4) with the first row and column, and the
+        height and width of each tile in the mosaic
+    """
+    extents = []
+    for t in tiles:
+        with rasterio.open(next(iter(t.values()))) as f:
+            a, e = f.transform.a, f.transform.e
+            if not np.allclose([a, -e], res):
+                raise ValueError('{} resolution differs from {}'.format(f.name, res))
+            extents.append((f.transform.c, f.transform.f, f.height, f.width))
+            crs, dtype = f.crs, f.dtypes[0]
+
+    if bounds is None:
+        left = min(e[0] for e in extents)
+        top = max(e[1] for e in extents)
+        right = max(e[0] + e[3] * res for e in extents)
+        bottom = min(e[1] - e[2] * res for e in extents)
+    else:
+        left, bottom, right, top = bounds
+    width = int(round((right - left) / res))
+    height = int(round((top - bottom) / res))
+
+    windows = np.array([(int(round((top - t) / res)), int(round((l - left) / res)), h, w)
+                        for l, t, h, w in extents], dtype=np.int64).reshape(-1, 4)
+    transform = affine.Affine(res, 0.0, left, 0.0, -res, top)
+    return transform, width, height, crs, dtype, windows
+
+
+def merge_chunk(tiles, windows, names, dtype, method, row, col, height, width):
+    """
+    Assemble a chunk of a mosaic.
+
+    Args:
+        tiles, windows: tiles and their positions in the mosaic, see
+            mosaic_grid
+        names (list): names of the products to assemble
+        dtype: type of the output arrays
+        method (str): merging method, one of METHODS
+        row, col, height, width (ints): window of the chunk in the mosaic
+
+    Returns:
+        dict of 2D arrays, one per product, or None if no tile intersects the
+        chunk
+    """
+    r0 = np.maximum(windows[:, 0], row)
+    r1 = np.minimum(windows[:, 0] + windows[:, 2], row + height)
+    c0 = np.maximum(windows[:, 1], col)
+    c1 = np.minimum(windows[:, 1] + windows[:, 3], col + width)
+    intersecting = np.flatnonzero((r0 < r1) & (c0 < c1))
+    if not len(intersecting):
+        return None
+
+    out = {n: np.full((height, width), np.nan, dtype=dtype) for n in names}
+    filled = {n: [] for n in names}
+    for k in intersecting:
+        box = (r0[k], r1[k], c0[k], c1[k])
+        dst = np.s_[r0[k] - row:r1[k] - row, c0[k] - col:c1[k] - col]
+        src = rasterio.windows.Window(c0[k] - windows[k, 1], r0[k] - windows[k, 0],
+                                      c1[k] - c0[k], r1[k] - r0[k])
+        for n in names:
+            if n not in tiles[k]:
+                continue
+            with rasterio.open(tiles[k][n]) as f:
+                data = f.read(1, window=src)
+            if any(b[0] < box[1] and box[0] < b[1] and b[2] < box[3] and box[2] < b[3]
+                   for b in filled[n]):
+                out[n][dst] = METHODS[method](out[n][dst], data)
+            else:
+                out[n][dst] = data
+            filled[n].append(box)
+    return out
+
+
+def mosaic(tiles, outputs, res, bounds=None, method='max', creation_options={},
+           nb_workers=1, blocks_per_chunk=4):
+    """
+    Merge tilewise rasters into mosaics, in a single pass over the tiles.
+
+    Args:
+        tiles (list): one dict per tile, mapping product names (e.g. 'dsm',
+            'confidence') to the paths of the rasters of the tile, which all
+            share the same grid. A tile may lack some products
+        outputs (dict): mapping product names to the paths of the output
+            mosaics, which all share the grid of the union of the tiles
+        res (float): resolution of the mosaics
+        bounds (tuple): left, bottom, right, top bounds of the mosaics. The
+            union of the tiles if None
+        method (str): merging method in the overlaps of the tiles, "first",
+            "last", "min" or "max", as in rasterio.merge.merge
+        creation_options (dict): GDAL creation options of the output tiled
+            GeoTIFF files
+        nb_workers (int): number of threads assembling the chunks, also used
+            by GDAL to compress the blocks
+        blocks_per_chunk (int): size of the chunks, in number of output blocks
+            along each dimension
+    """
+    if method not in METHODS:
+        raise ValueError('unknown merging method: {}'.format(method))
+    transform, width, height, crs, dtype, windows = mosaic_grid(tiles, res, bounds)
+
+    profile = dict(creation_options)
+    profile.update(driver='GTiff', width=width, height=height, count=1,
+                   dtype=dtype, crs=crs, transform=transform, nodata=np.nan,
+                   tiled=True, num_threads=nb_workers)
+    chunk_h = blocks_per_chunk * int(profile.get('blockysize', 256))
+    chunk_w = blocks_per_chunk * int(profile.get('blockxsize', 256))
+    chunks = [(r, c, min(chunk_h, height - r), min(chunk_w, width - c))
+              for r in range(0, height, chunk_h) for c in range(0, width, chunk_w)]
+
+    names = list(outputs)
+    datasets = {n: rasterio.open(outputs[n], 'w', **profile) for n in names}
+    locks = {n: threading.Lock() for n in names}
+
+    def process(chunk):
+        arrays = merge_chunk(tiles, windows, names, dtype, method, *chunk)
+        if arrays is None:
+            return
+        window = rasterio.windows.Window(chunk[1], chunk[0], chunk[3], chunk[2])
+        for n in names:
+            with locks[n]:
+                datasets[n].write(arrays[n], 1, window=window)
+
+    try:
+        with ThreadPoolExecutor(max(1, nb_workers)) as executor:
+            for _ in executor.map(process, chunks):
+                pass
+    finally:
+        for d in datasets.values():
+            d.close()
+
+
+def layers(windows):
+    """
+    Split tiles into layers of tiles that don't overlap each other.
+
+    Args:
+        windows (array): positions of the tiles in the mosaic, see mosaic_grid
+
+    Returns:
+        list of lists of tile indices
+    """
+    out = []
+    for k, (r, c, h, w) in enumerate(windows):
+        for layer in out:
+            if not any(r < windows[j, 0] + windows[j, 2] and windows[j, 0] < r + h and
+                       c < windows[j, 1] + windows[j, 3] and windows[j, 1] < c + w
+                       for j in layer):
+                layer.append(k)
+                break
+        else:
+            out.append([k])
+    return out
+
+
+def vrt_source(parent, path, vrt_dir, src, dst):
+    """
+    Append a ComplexSource with NaN nodata to a VRT band element.
+
+    Args:
+        parent (Element): VRTRasterBand element
+        path (str): path to the source raster
+        vrt_dir (str): directory of the VRT file, the path is written relative
+            to it
+        src, dst: (row, col, height, width) windows in the source and the VRT
+    """
+    e = ET.SubElement(parent, 'ComplexSource')
+    ET.SubElement(e, 'SourceFilename', relativeToVRT='1').text = os.path.relpath(path, vrt_dir)
+    ET.SubElement(e, 'SourceBand').text = '1'
+    ET.SubElement(e, 'SrcRect', xOff=str(src[1]), yOff=str(src[0]),
+                  xSize=str(src[3]), ySize=str(src[2]))
+    ET.SubElement(e, 'DstRect', xOff=str(dst[1]), yOff=str(dst[0]),
+                  xSize=str(dst[3]), ySize=str(dst[2]))
+    ET.SubElement(e, 'NODATA').text = 'nan'
+
+
+def overview_factors(width, height, min_size=64):
+    """
+    Decimation factors, powers of 2, of the overviews of a raster down to a
+    size of min_size pixels.
+    """
+    factors = []
+    while min(width, height) // 2 ** (len(factors) + 1) >= min_size:
+        factors.append(2 ** (len(factors) + 1))
+    return factors
+
+
+def write_vrt_file(path, width, height, transform, crs, dtype, sources,
+                   pixel_function=None, overviews=()):
+    """
+    Write a single band VRT file.
+
+    Args:
+        path (str): path to the output .vrt file
+        width, height, transform, crs, dtype: grid and type of the VRT
+        sources (list): (path, src, dst) tuples, see vrt_source. Without
+            pixel function, the later sources are painted over the earlier
+            ones, except on their NaN pixels
+        pixel_function (str): name of a GDAL pixel function combining the
+            sources
+        overviews (list): decimation factors of the virtual overviews,
+            computed on the fly from the overviews of the sources
+    """
+    vrt_dir = os.path.dirname(os.path.abspath(path))
+    root = ET.Element('VRTDataset', rasterXSize=str(width), rasterYSize=str(height))
+    if crs is not None:
+        ET.SubElement(root, 'SRS').text = crs.to_wkt()
+    ET.SubElement(root, 'GeoTransform').text = ', '.join(repr(float(v)) for v in transform.to_gdal())
+    if overviews:
+        ET.SubElement(root, 'OverviewList', resampling='average').text = ' '.join(map(str, overviews))
+    gdal_type = rasterio.dtypes.typename_fwd[rasterio.dtypes.dtype_rev[dtype]]
+    band = ET.SubElement(root, 'VRTRasterBand', dataType=gdal_type, band='1')
+    ET.SubElement(band, 'NoDataValue').text = 'nan'
+    if pixel_function is not None:
+        band.set('subClass', 'VRTDerivedRasterBand')
+        ET.SubElement(band, 'PixelFunctionType').text = pixel_function
+        ET.SubElement(band, 'PixelFunctionArguments', propagateNoData='false')
+    for source, src, dst in sources:
+        vrt_source(band, source, vrt_dir, src, dst)
+    ET.ElementTree(root).write(path)
+
+
+def write_vrt(tiles, outputs, res, bounds=None, method='max'):
+    """
+    Write virtual mosaics of tilewise rasters, without reading the rasters.
+
+    With the "first" and "last" methods, the tiles are painted in order. With
+    "min" and "max", the tiles are split into layers of non-overlapping tiles,
+    each written in a VRT file next to the output, and the layers are combined
+    by the min or max pixel function (GDAL >= 3.8). The VRT files declare
+    virtual overviews, read from the overviews of the tiles rasters (see
+    add_overviews).
+
+    Args:
+        tiles (list): one dict per tile, mapping product names to the paths of
+            the rasters of the tile, see mosaic
+        outputs (dict): mapping product names to the paths of the output .vrt
+            files
+        res (float): resolution of the mosaics
+        bounds (tuple): left, bottom, right, top bounds of the mosaics. The
+            union of the tiles if None
+        method (str): merging method in the overlaps of the tiles, "first",
+            "last", "min" or "max"
+    """
+    if method not in METHODS:
+        raise ValueError('unknown merging method: {}'.format(method))
+    transform, width, height, crs, dtype, windows = mosaic_grid(tiles, res, bounds)
+
+    def sources(name, indices):
+        out = []
+        for k in indices:
+            if name not in tiles[k]:
+                continue
+            r, c, h, w = windows[k]
+            # crop the tile to the mosaic
+            r0, c0 = max(r, 0), max(c, 0)
+            r1, c1 = min(r + h, height), min(c + w, width)
+            if r0 < r1 and c0 < c1:
+                out.append((tiles[k][name], (r0 - r, c0 - c, r1 - r0, c1 - c0),
+                            (r0, c0, r1 - r0, c1 - c0)))
+        return out
+
+    order = list(range(len(tiles)))
+    factors = overview_factors(width, height)
+    for name, path in outputs.items():
+        if method in ['first', 'last']:
+            write_vrt_file(path, width, height, transform, crs, dtype,
+                           sources(name, order[::-1] if method == 'first' else order),
+                           overviews=factors)
+            continue
+
+        layer_paths = []
+        for i, layer in enumerate(layers(windows)):
+            layer_paths.append('{}.layer{}.vrt'.format(os.path.splitext(path)[0], i))
+            write_vrt_file(layer_paths[-1], width, height, transform, crs, dtype,
+                           sources(name, layer), overviews=factors)
+        full = (0, 0, height, width)
+        write_vrt_file(path, width, height, transform, crs, dtype,
+                       [(p, full, full) for p in layer_paths], pixel_function=method,
+                       overviews=factors)
+
+
+def add_overviews(path, min_size=64, resampling=Resampling.average):
+    """
+    Add internal overviews to a raster file, if it has none.
+
+    Args:
+        path (str): path to a GeoTIFF file
+        min_size (int): size of the smallest overview
+        resampling (Resampling): resampling method
+    """
+    with rasterio.open(path, 'r+') as f:
+        if f.overviews(1):
+            return
+        factors = overview_factors(f.width, f.height, min_size)
+        if factors:
+            f.build_overviews(factors, resampling)
+            f.update_tags(ns='rio_overview', resampling=resampling.name)
@@ -3,11 +3,18 @@
 
 import os
 import sys
+import time
 import logging
+import importlib
+import threading
 import multiprocessing
 import multiprocessing.context
+from dataclasses import dataclass, field
+from typing import Any, Callable, Dict, Hashable, List, Optional
 
 from s2p import common
+from s2p import telemetry
+from s2p import profiling
 from s2p.gpu_memory_manager import GPUMemoryManager
 
 logger = logging.getLogger(__name__)
@@ -63,12 +70,43 @@ def undo_remap_extra_args(extra_args):
     for a in extra_args:
         if a == INIT_ARG_SENTINEL:
             out_args.append(next(subargs))
+        elif a == CFG_SENTINEL:
+            out_args.append(published_cfg)
         else:
             out_args.append(a)
     return out_args
 
 
+# the config is sent once to each worker, through the pool initializer, instead of
+# being pickled with every call: in the calls it is replaced by CFG_SENTINEL
+published_cfg = None
+CFG_SENTINEL = 'CFG_SENTINEL'
+
+
+def publish_cfg(cfg):
+    global published_cfg
+    published_cfg = cfg
+
+
+def remap_cfg(args, cfg):
+    """
+    Replace cfg by CFG_SENTINEL in args, if cfg is not None.
+    """
+    if cfg is None:
+        return args
+    return tuple(CFG_SENTINEL if a is cfg else a for a in args)
+
+
+def call_with_published_cfg(fun, *args):
+    """
+    Call fun on args, after substitution of the sentinels.
+    """
+    return fun(*undo_remap_extra_args(args))
+
+
 def tilewise_wrapper(cfg, fun, *args, stdout: str, tile_label: str, **kwargs):
+    if cfg == CFG_SENTINEL:
+        cfg = published_cfg
     args = undo_remap_extra_args(args)
 
     root = logging.getLogger()
@@ -102,7 +140,9 @@ def tilewise_wrapper(cfg, fun, *args, stdout: str, tile_label: str, **kwargs):
         root.addHandler(h)
 
     try:
-        out = fun(*args)
+        with telemetry.measure(telemetry.path(cfg), fun.__name__, tile_label), \
+                profiling.profile(cfg, fun.__name__, tile_label, stdout):
+            out = fun(*args)
     except Exception:
         logging.exception("Exception in %s" % fun.__name__)
         raise
@@ -121,14 +161,140 @@ def tilewise_wrapper(cfg, fun, *args, stdout: str, tile_label: str, **kwargs):
     return out
 
 
+def tile_label_from_dir(tile_dir: str) -> str:
+    """convert:
+           /path/to/output_s2p/tiles/row_0002145_height_715/col_0000000_width_667
+       to:
+           row_0002145_height_715/col_0000000_width_667
+    """
+    root = os.path.dirname(os.path.dirname(tile_dir))
+    return tile_dir.replace(root, '')
+
+
+def tilewise_log_and_label(x):
+    """
+    Path to the log file and label of a tilewise call.
+
+    Args:
+        x: (first positional) arguments of the call, either a tile, or a
+            (cfg, tile) or (cfg, tile, pair_id) tuple, optionally followed by
+            other arguments
+
+    Returns:
+        path to the stdout.log file of the tile (or pair), and tile label
+    """
+    if type(x) == tuple:
+        # we expect x = (cfg, tile_dictionary, ?)
+        tile_dir = x[1].dir
+        tile_label = tile_label_from_dir(tile_dir)
+        # we expect x = (cfg, tile_dictionary, pair_id, ...)
+        if len(x) >= 3 and isinstance(x[2], int):
+            tile_dir = os.path.join(tile_dir, 'pair_%d' % x[2])
+            tile_label = os.path.join(tile_label, 'pair_%d' % x[2])
+    else:  # we expect x = tile_dictionary
+        tile_dir = x.dir
+        tile_label = tile_label_from_dir(tile_dir)
+
+    return os.path.join(tile_dir, 'stdout.log'), tile_label
+
+
 def get_mp_context() -> multiprocessing.context.BaseContext:
         # use a `spawn` strategy, because 'fork' is unsafe when threads are involved
         # and forkserver is only available on linux (and might also be unsafe anyway)
     return multiprocessing.get_context("spawn")
 
 
+# pools shared by all the calls of launch_calls and launch_dag, indexed by name,
+# see start_pool. Each one is a (pool, nb_workers, init_args, cfg) tuple
+shared_pools = {}
+
+
+def init_worker(init_args, warm_imports=(), cfg=None):
+    """
+    Initializer of the pool workers.
+
+    Args:
+        init_args: arguments substituted in the calls (see remap_extra_args)
+        warm_imports: names of modules imported once when the worker starts
+        cfg: config substituted in the calls (see remap_cfg)
+    """
+    expand_initargs(*init_args)
+    publish_cfg(cfg)
+    for m in warm_imports:
+        importlib.import_module(m)
+
+
+def start_pool(nb_workers, *init_args, warm_imports=(), cfg=None, name='default') -> None:
+    """
+    Start a pool of workers reused by all the following calls of launch_calls
+    and launch_dag asking for this pool, until stop_pool is called.
+
+    Args:
+        nb_workers: number of worker processes
+        init_args (optional): objects that can't be pickled with the calls
+            arguments (GPUMemoryManager), given once to the workers
+        warm_imports (optional): names of modules imported by each worker when
+            it starts, so that the calls don't pay for it
+        cfg (optional): config given once to each worker. The calls using
+            this very object get it from the worker instead of pickling it
+        name (optional): name of the pool. The calls of launch_calls use the
+            pool given by their pool argument, and those of launch_dag the
+            pool named after their group if it is in separate_groups, the
+            'default' pool otherwise
+    """
+    stop_pool(name=name)
+    _, init_args = remap_extra_args(init_args)
+    pool = get_mp_context().Pool(nb_workers, initializer=init_worker,
+                                 initargs=(init_args, tuple(warm_imports), cfg))
+    shared_pools[name] = (pool, nb_workers, init_args, cfg)
+
+
+def stop_pool(terminate=False, name=None) -> None:
+    """
+    Stop pools started by start_pool, if any.
+
+    Args:
+        terminate (bool): stop the workers immediately instead of waiting for
+            the pending calls
+        name (optional): name of the pool to stop, or None to stop all of them
+    """
+    for n in list(shared_pools) if name is None else [name]:
+        if n not in shared_pools:
+            continue
+        pool = shared_pools.pop(n)[0]
+        if terminate:
+            pool.terminate()
+        else:
+            pool.close()
+        pool.join()
+
+
+def get_pool(nb_workers, init_args=(), cfg=None, name='default'):
+    """
+    Get a pool to run calls on at most nb_workers workers.
+
+    The shared pool of the given name is used if it has been started with
+    enough workers and with the same init_args, otherwise a new pool is
+    created, to which cfg is published.
+
+    Returns:
+        the pool, a boolean telling whether it has been created (and thus
+        must be closed by the caller), and the config published to its
+        workers (or None)
+    """
+    if nb_workers is None:
+        nb_workers = multiprocessing.cpu_count()
+    if name in shared_pools:
+        pool, size, pool_init_args, pool_cfg = shared_pools[name]
+        if nb_workers <= size and (not init_args or list(init_args) == list(pool_init_args)):
+            return pool, False, pool_cfg
+    pool = get_mp_context().Pool(nb_workers, initializer=init_worker,
+                                 initargs=(init_args, (), cfg))
+    return pool, True, cfg
+
+
 def launch_calls(cfg, fun, list_of_args, nb_workers, *extra_args, tilewise=True,
-                 timeout=600):
+                 timeout=600, pool='default'):
     """
     Run a function several times in parallel with different given inputs.
 
@@ -141,6 +307,8 @@ def launch_calls(cfg, fun, list_of_args, nb_workers, *extra_args, tilewise=True,
             fun (same value for all calls)
         tilewise (bool): whether the calls are run tilewise or not
         timeout (int): timeout for each function call (in seconds)
+        pool (str): name of the shared pool to run the calls on, if it was
+            started (see start_pool)
 
     Return:
         list of outputs
@@ -155,17 +323,18 @@ def launch_calls(cfg, fun, list_of_args, nb_workers, *extra_args, tilewise=True,
         # the init_args hack only work when calling tilewise_wrapper
         assert tilewise
 
-    def tile_label_from_dir(tile_dir: str) -> str:
-        """convert:
-               /path/to/output_s2p/tiles/row_0002145_height_715/col_0000000_width_667
-           to:
-               row_0002145_height_715/col_0000000_width_667
-        """
-        root = os.path.dirname(os.path.dirname(tile_dir))
-        return tile_dir.replace(root, '')
-
     if nb_workers != 1:
-        pool = get_mp_context().Pool(nb_workers, initializer=expand_initargs, initargs=init_args)
+        pool, own_pool, pool_cfg = get_pool(nb_workers, init_args, cfg, pool)
+
+        # the pool may be larger than nb_workers: limit the number of pending calls
+        slots = threading.BoundedSemaphore(nb_workers or multiprocessing.cpu_count())
+
+        def callback(x):
+            slots.release()
+            show_progress(x)
+
+        def error_callback(e):
+            slots.release()
 
         for x in list_of_args:
             args = tuple()
@@ -174,32 +343,27 @@ def launch_calls(cfg, fun, list_of_args, nb_workers, *extra_args, tilewise=True,
             else:
                 args += (x,)
             args += extra_args
+            slots.acquire()
             if tilewise:
-                if type(x) == tuple:
-                    # we expect x = (cfg, tile_dictionary, ?)
-                    tile_dir = x[1].dir
-                    tile_label = tile_label_from_dir(tile_dir)
-                    if len(x) == 3:  # we expect x = (cfg, tile_dictionary, pair_id)
-                        tile_dir = os.path.join(tile_dir, 'pair_%d' % x[2])
-                        tile_label = os.path.join(tile_label, 'pair_%d' % x[2])
-                else:  # we expect x = tile_dictionary
-                    tile_dir = x.dir
-                    tile_label = tile_label_from_dir(tile_dir)
-
-                log = os.path.join(tile_dir, 'stdout.log')
-                args = (cfg, fun,) + args
+                log, tile_label = tilewise_log_and_label(x)
+                args = remap_cfg((cfg, fun,) + args, pool_cfg)
                 results.append(pool.apply_async(tilewise_wrapper, args=args,
                                                 kwds={'stdout': log, 'tile_label': tile_label},
-                                                callback=show_progress))
+                                                callback=callback,
+                                                error_callback=error_callback))
             else:
-                results.append(pool.apply_async(fun, args=args, callback=show_progress))
+                args = (fun,) + remap_cfg(args, pool_cfg)
+                results.append(pool.apply_async(call_with_published_cfg, args=args,
+                                                callback=callback,
+                                                error_callback=error_callback))
 
         for r in results:
             o = r.get(timeout)
             outputs.append(o)
 
-        pool.close()
-        pool.join()
+        if own_pool:
+            pool.close()
+            pool.join()
 
     else:
         outputs = []
@@ -211,18 +375,7 @@ def launch_calls(cfg, fun, list_of_args, nb_workers, *extra_args, tilewise=True,
                 args += (x,)
             args += extra_args
             if tilewise:
-                if type(x) == tuple:
-                    # we expect x = (cfg, tile_dictionary, ?)
-                    tile_dir = x[1].dir
-                    tile_label = tile_label_from_dir(tile_dir)
-                    if len(x) == 3:  # we expect x = (cfg, tile_dictionary, pair_id)
-                        tile_dir = os.path.join(tile_dir, 'pair_%d' % x[2])
-                        tile_label = os.path.join(tile_label, 'pair_%d' % x[2])
-                else:  # we expect x = tile_dictionary
-                    tile_dir = x.dir
-                    tile_label = tile_label_from_dir(tile_dir)
-
-                log = os.path.join(tile_dir, 'stdout.log')
+                log, tile_label = tilewise_log_and_label(x)
                 args = (cfg, fun,) + args
                 outputs.append(tilewise_wrapper(*args, stdout=log, tile_label=tile_label))
             else:
@@ -231,3 +384,208 @@ def launch_calls(cfg, fun, list_of_args, nb_workers, *extra_args, tilewise=True,
 
     common.print_elapsed_time()
     return outputs
+
+
+@dataclass
+class Task:
+    """
+    A function call scheduled by launch_dag.
+
+    Attributes:
+        key: unique identifier of the task
+        fun: function to be called
+        args: positional arguments passed to fun. As in launch_calls, the
+            call is run tilewise on (cfg, tile) or (cfg, tile, pair_id) tuples
+        requires: keys of the tasks that must have succeeded before this one
+            is run. A task has failed if it returned False, or if it was
+            skipped. If one of them failed, this task is skipped
+        after: keys of the tasks that must have finished (successfully or
+            not) before this one is run
+        group: name of a group of tasks whose number of simultaneous calls
+            can be limited (see launch_dag)
+    """
+    key: Hashable
+    fun: Callable
+    args: tuple
+    requires: List[Hashable] = field(default_factory=list)
+    after: List[Hashable] = field(default_factory=list)
+    group: Optional[str] = None
+
+
+class _ImmediateResult:
+    """Result of a call run in the current process, mimics AsyncResult."""
+
+    def __init__(self, fun, args, kwds):
+        self.value = fun(*args, **kwds)
+
+    def ready(self):
+        return True
+
+    def get(self, timeout=None):
+        return self.value
+
+
+def check_dag(tasks: List[Task]) -> None:
+    """
+    Check that the keys of tasks are unique, and that their dependencies are
+    keys of tasks.
+    """
+    keys = set(t.key for t in tasks)
+    assert len(keys) == len(tasks), 'task keys must be unique'
+    for t in tasks:
+        unknown = set(t.requires + t.after) - keys
+        assert not unknown, 'unknown dependencies {} of task {}'.format(unknown, t.key)
+
+
+def launch_dag(cfg, tasks: List[Task], nb_workers: int, *, tilewise=True,
+               group_limits: Optional[Dict[str, int]] = None,
+               separate_groups: List[str] = (),
+               timeout=600) -> Dict[Hashable, Any]:
+    """
+    Run a set of interdependent function calls in parallel, each call being
+    launched as soon as its dependencies are satisfied.
+
+    Args:
+        tasks: list of Task. Ready tasks are launched in the order of the list
+        nb_workers: number of calls run simultaneously
+        tilewise (bool): whether the calls are run tilewise or not
+        group_limits (optional): dictionary giving, for some task groups, the
+            maximal number of calls of this group run simultaneously
+        separate_groups (optional): groups whose calls are run on a pool of
+            their own, of group_limits[group] workers: the shared pool named
+            after the group if it was started (see start_pool), otherwise a
+            new one. Their calls are thus run by at most group_limits[group]
+            distinct processes
+        timeout (int): timeout for each function call (in seconds), or None
+            for no timeout
+
+    Return:
+        dictionary with the outputs of the calls, indexed by task keys. The
+        skipped tasks are not in the dictionary.
+    """
+    group_limits = group_limits or {}
+    show_progress.counter = 0
+    show_progress.total = len(tasks)
+
+    check_dag(tasks)
+
+    # replace the GPU memory managers by sentinels (see remap_extra_args)
+    remapped = {}
+    init_args = []
+    for t in tasks:
+        args, task_init_args = remap_extra_args(t.args)
+        if task_init_args:
+            # the init_args hack only work when calling tilewise_wrapper
+            assert tilewise
+            assert not init_args or init_args == task_init_args
+            init_args = task_init_args
+        remapped[t.key] = args
+
+    # (pool, own_pool, pool_cfg) tuples indexed by group, None for the tasks
+    # that are not in a separate group. No pool runs the calls in this process
+    pools = {}
+    if nb_workers != 1:
+        pools[None] = get_pool(nb_workers, init_args, cfg)
+        for g in separate_groups:
+            pools[g] = get_pool(group_limits.get(g, nb_workers), init_args, cfg, g)
+    else:
+        expand_initargs(*init_args)
+
+    def pool_of(t):
+        return pools.get(t.group if t.group in separate_groups else None, (None, False, None))
+
+    calls = {}
+    for t in tasks:
+        pool_cfg = pool_of(t)[2]
+        args = remap_cfg(remapped[t.key], pool_cfg)
+        if tilewise:
+            log, tile_label = tilewise_log_and_label(t.args)
+            calls[t.key] = (tilewise_wrapper, remap_cfg((cfg, t.fun), pool_cfg) + args,
+                            {'stdout': log, 'tile_label': tile_label})
+        else:
+            calls[t.key] = (call_with_published_cfg, (t.fun,) + args, {})
+
+    # set each time a call finishes, to wake up the scheduling loop
+    event = threading.Event()
+
+    def callback(x):
+        show_progress(x)
+        event.set()
+
+    def error_callback(e):
+        event.set()
+
+    pending = list(tasks)
+    running = {}  # key -> (task, result, start time)
+    outputs = {}
+    failed = set()
+    finished = set()
+    try:
+        while pending or running:
+            progressed = False
+
+            # collect the finished calls
+            for key, (t, r, start) in list(running.items()):
+                if r.ready():
+                    progressed = True
+                    del running[key]
+                    out = r.get()  # raises the exception of the call, if any
+                    outputs[key] = out
+                    finished.add(key)
+                    if out is False:
+                        failed.add(key)
+                elif timeout is not None and time.time() - start > timeout:
+                    raise multiprocessing.TimeoutError('task {} timed out'.format(key))
+
+            # launch the ready calls
+            for t in list(pending):
+                if len(running) >= nb_workers:
+                    break
+                if any(k in failed for k in t.requires):
+                    # skip the task, and those that require it
+                    pending.remove(t)
+                    failed.add(t.key)
+                    finished.add(t.key)
+                    show_progress(None)
+                    progressed = True
+                    continue
+                if not all(k in finished for k in t.requires + t.after):
+                    continue
+                if t.group in group_limits:
+                    nb_running = sum(1 for u, _, _ in running.values() if u.group == t.group)
+                    if nb_running >= group_limits[t.group]:
+                        continue
+
+                pending.remove(t)
+                fun, args, kwds = calls[t.key]
+                pool = pool_of(t)[0]
+                if pool is None:
+                    r = _ImmediateResult(fun, args, kwds)
+                    show_progress(None)
+                else:
+                    r = pool.apply_async(fun, args=args, kwds=kwds,
+                                         callback=callback,
+                                         error_callback=error_callback)
+                running[t.key] = (t, r, time.time())
+                progressed = True
+
+            if pending and not running and not progressed:
+                # nothing can be launched nor is running: some dependencies can't be satisfied
+                raise ValueError('cyclic dependencies between tasks {}'.format([t.key for t in pending]))
+
+            if running and pools:
+                event.wait(1)
+                event.clear()
+    except BaseException:
+        for pool, own_pool, _ in pools.values():
+            if own_pool:
+                pool.terminate()
+        raise
+
+    for pool, own_pool, _ in pools.values():
+        if own_pool:
+            pool.close()
+            pool.join()
+
+    common.print_elapsed_time()
+    return outputs
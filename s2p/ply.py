@@ -1,9 +1,87 @@
 # Copyright (C) 2019, Carlo de Franchis <carlo.de-franchis@cmla.ens-cachan.fr>
 
+import os
+import json
+
 import numpy as np
 import plyfile
 
 
+# ply scalar types, with their aliases, and the numpy types used to write them
+PLY_TYPES = {'char': 'i1', 'int8': 'i1', 'uchar': 'u1', 'uint8': 'u1',
+             'short': 'i2', 'int16': 'i2', 'ushort': 'u2', 'uint16': 'u2',
+             'int': 'i4', 'int32': 'i4', 'uint': 'u4', 'uint32': 'u4',
+             'float': 'f4', 'float32': 'f4', 'double': 'f8', 'float64': 'f8'}
+NUMPY_TYPES = {'i1': 'char', 'u1': 'uchar', 'i2': 'short', 'u2': 'ushort',
+               'i4': 'int', 'u4': 'uint', 'f4': 'float', 'f8': 'double'}
+
+
+def read_ply_header(path_to_ply_file):
+    """
+    Parse the header of a ply file.
+
+    Args:
+        path_to_ply_file (str): path to a .ply file
+
+    Returns:
+        dictionary with the format of the file, the list of its elements as
+        (name, count, properties) tuples, where properties is a list of
+        (name, type) tuples with the ply types, the comments, and the size of
+        the header in bytes
+    """
+    header = {'format': None, 'elements': [], 'comments': []}
+    with open(path_to_ply_file, 'rb') as f:
+        if f.readline().strip() != b'ply':
+            raise ValueError('{} is not a ply file'.format(path_to_ply_file))
+        for line in f:
+            words = line.decode('ascii').split()
+            if not words:
+                continue
+            if words[0] == 'format':
+                header['format'] = words[1]
+            elif words[0] == 'comment':
+                header['comments'].append(line.decode('ascii')[8:].rstrip('\r\n'))
+            elif words[0] == 'element':
+                header['elements'].append((words[1], int(words[2]), []))
+            elif words[0] == 'property':
+                header['elements'][-1][2].append((words[-1], words[1:-1]))
+            elif words[0] == 'end_header':
+                header['size'] = f.tell()
+                return header
+    raise ValueError('{} has no end_header line'.format(path_to_ply_file))
+
+
+def memmap_3d_point_cloud_from_ply(path_to_ply_file):
+    """
+    Memory-map the vertices of a binary little endian ply file.
+
+    The file must not be overwritten while the returned array is in use.
+
+    Args:
+        path_to_ply_file (str): path to a .ply file
+
+    Returns:
+        read-only structured numpy array with one field per vertex property,
+        or None if the file can not be mapped (ascii or big endian format,
+        list properties, other elements before the vertices)
+        list of strings with the ply header comments
+    """
+    header = read_ply_header(path_to_ply_file)
+    if header['format'] != 'binary_little_endian' or not header['elements']:
+        return None, header['comments']
+    name, count, properties = header['elements'][0]
+    if name != 'vertex' or any(len(t) != 1 or t[0] not in PLY_TYPES
+                               for _, t in properties):
+        return None, header['comments']
+
+    dtype = np.dtype([(p, '<' + PLY_TYPES[t[0]]) for p, t in properties])
+    if count == 0:
+        return np.empty(0, dtype=dtype), header['comments']
+    data = np.memmap(path_to_ply_file, dtype=dtype, mode='r',
+                     offset=header['size'], shape=(count,))
+    return data, header['comments']
+
+
 def read_3d_point_cloud_from_ply(path_to_ply_file):
     """
     Read a 3D point cloud from a ply file and return a numpy array.
@@ -15,6 +93,15 @@ def read_3d_point_cloud_from_ply(path_to_ply_file):
         numpy array with the list of 3D points, one point per line
         list of strings with the ply header comments
     """
+    d, comments = memmap_3d_point_cloud_from_ply(path_to_ply_file)
+    if d is not None:
+        names = d.dtype.names
+        array = np.empty((len(d), len(names)),
+                         dtype=np.result_type(*[d.dtype[n] for n in names]))
+        for i, n in enumerate(names):
+            array[:, i] = d[n]
+        return array, comments
+
     plydata = plyfile.PlyData.read(path_to_ply_file)
     d = np.asarray(plydata['vertex'].data)
     array = np.column_stack([d[p.name] for p in plydata['vertex'].properties])
@@ -23,9 +110,10 @@ def read_3d_point_cloud_from_ply(path_to_ply_file):
 
 def write_3d_point_cloud_to_ply(path_to_ply_file, coordinates, colors=None,
                                 extra_properties=None,
-                                extra_properties_names=None, comments=[]):
+                                extra_properties_names=None, comments=[],
+                                bounds=False):
     """
-    Write a 3D point cloud to a ply file.
+    Write a 3D point cloud to a binary little endian ply file.
 
     Args:
         path_to_ply_file (str): path to a .ply file
@@ -36,30 +124,107 @@ def write_3d_point_cloud_to_ply(path_to_ply_file, coordinates, colors=None,
         extra_properties_names (list): list of k strings with the names of the
             (optional) extra properties
         comments (list): list of strings containing the ply header comments
+        bounds (bool): also write the bounds of the point cloud in a sidecar
+            file (see write_bounds)
     """
-    dtypes = [('x', coordinates.dtype),
-              ('y', coordinates.dtype),
-              ('z', coordinates.dtype)]
-    arrays = [coordinates[:, 0], coordinates[:, 1], coordinates[:, 2]]
+    fields = [('x', coordinates[:, 0]),
+              ('y', coordinates[:, 1]),
+              ('z', coordinates[:, 2])]
 
     if colors is not None:
         if colors.shape[1] == 1:  # replicate grayscale 3 times
             colors = np.column_stack([colors] * 3)
         elif colors.shape[1] not in [3, 4]:
             raise Exception('Error: colors must have either 1, 3 or 4 channels')
-        arrays += [colors[:, 0], colors[:, 1], colors[:, 2]]
-        dtypes += [('red', colors.dtype),
-                   ('green', colors.dtype),
-                   ('blue', colors.dtype)]
+        fields += [('red', colors[:, 0]),
+                   ('green', colors[:, 1]),
+                   ('blue', colors[:, 2])]
         if colors.shape[1] == 4:
-            dtypes += [('ir', colors.dtype)]
+            fields += [('ir', colors[:, 3])]
 
     if extra_properties is not None:
         if extra_properties.ndim == 1:
             extra_properties = extra_properties[..., None]
-        arrays += [extra_properties[:, i] for i in range(extra_properties.shape[1])]
-        dtypes += [(s, extra_properties.dtype) for s in extra_properties_names]
+        fields += [(s, extra_properties[:, i])
+                   for i, s in enumerate(extra_properties_names)]
+
+    # single copy of the columns into the interleaved vertex records
+    dtype = np.dtype([(n, a.dtype.newbyteorder('<')) for n, a in fields])
+    data = np.empty(len(coordinates), dtype=dtype)
+    for n, a in fields:
+        data[n] = a
+
+    header = ['ply', 'format binary_little_endian 1.0']
+    header += ['comment {}'.format(c) for c in comments]
+    header += ['element vertex {}'.format(len(data))]
+    header += ['property {} {}'.format(NUMPY_TYPES[dtype[n].str[1:]], n)
+               for n in dtype.names]
+    header += ['end_header', '']
+    with open(path_to_ply_file, 'wb') as f:
+        f.write('\n'.join(header).encode('ascii'))
+        data.tofile(f)
+
+    if bounds:
+        write_bounds(path_to_ply_file, coordinates)
+
+
+def bounds_path(path_to_ply_file):
+    """
+    Path of the bounds sidecar file of a ply file.
+    """
+    return path_to_ply_file + '.bounds.json'
+
+
+def write_bounds(path_to_ply_file, coordinates):
+    """
+    Write the number of points and the bounding box of a point cloud in a json
+    sidecar file next to its ply file.
+
+    Args:
+        path_to_ply_file (str): path to the .ply file
+        coordinates (array): numpy array of shape (n, 3) containing the x, y,
+            z coordinates written in the ply file
+    """
+    if len(coordinates):
+        bounds = {'count': len(coordinates),
+                  'min': np.min(coordinates, axis=0).tolist(),
+                  'max': np.max(coordinates, axis=0).tolist()}
+    else:
+        bounds = {'count': 0, 'min': None, 'max': None}
+    with open(bounds_path(path_to_ply_file), 'w') as f:
+        json.dump(bounds, f)
+
+
+def read_bounds(path_to_ply_file):
+    """
+    Get the number of points and the bounding box of a ply point cloud.
+
+    The bounds are read from the sidecar file written with the cloud if it
+    exists and is up to date, and computed from the cloud otherwise.
+
+    Args:
+        path_to_ply_file (str): path to a .ply file
+
+    Returns:
+        number of points, and two arrays with the minimal and maximal x, y, z
+        coordinates (None if the cloud is empty)
+    """
+    sidecar = bounds_path(path_to_ply_file)
+    if (os.path.exists(sidecar) and
+            os.path.getmtime(sidecar) >= os.path.getmtime(path_to_ply_file)):
+        with open(sidecar) as f:
+            b = json.load(f)
+        if b['count'] == 0:
+            return 0, None, None
+        return b['count'], np.array(b['min']), np.array(b['max'])
 
-    data = np.core.records.fromarrays(arrays, dtypes)
-    plydata = plyfile.PlyElement.describe(data, 'vertex')
-    plyfile.PlyData([plydata], comments=comments).write(path_to_ply_file)
+    d, _ = memmap_3d_point_cloud_from_ply(path_to_ply_file)
+    if d is None:
+        d = read_3d_point_cloud_from_ply(path_to_ply_file)[0][:, :3]
+        xyz = [d[:, 0], d[:, 1], d[:, 2]]
+    else:
+        xyz = [d['x'], d['y'], d['z']]
+    if len(xyz[0]) == 0:
+        return 0, None, None
+    return (len(xyz[0]), np.array([np.min(c) for c in xyz]),
+            np.array([np.max(c) for c in xyz]))
@@ -0,0 +1,102 @@
+"""
+opt-in cProfile profiling of the tilewise calls
+
+The tilewise calls of the functions listed in cfg['profile_functions'] are
+run under cProfile, on a deterministic fraction cfg['profile_fraction'] of the
+tiles, and their profiles are dumped next to their stdout.log files, as
+<function>.prof. The profiles of previous runs are removed when a run starts,
+and at its end the new ones are merged into out_dir/profile.prof, readable
+with pstats or snakeviz, and summarized in out_dir/profile.txt.
+"""
+
+import io
+import os
+import glob
+import zlib
+import pstats
+import cProfile
+import contextlib
+
+from s2p import telemetry
+
+
+def sampled(tile_label, fraction):
+    """
+    Tell whether a tile is in the profiled fraction of the tiles.
+
+    The choice depends only on the tile label (not on the pair), so that the
+    same tiles are profiled by all the functions and all the runs.
+    """
+    if fraction >= 1:
+        return True
+    tile, _ = telemetry.split_tile_label(tile_label)
+    return zlib.crc32(str(tile).encode()) < fraction * 2**32
+
+
+@contextlib.contextmanager
+def profile(cfg, name, tile_label, stdout):
+    """
+    Context manager profiling a tilewise call, if enabled by the config.
+
+    Args:
+        cfg (dict): s2p config dictionary
+        name (str): name of the called function
+        tile_label (str): label of the tile (and pair) of the call
+        stdout (str): path to the log file of the call. The profile is written
+            in the same directory
+    """
+    if name not in cfg['profile_functions'] or not sampled(tile_label, cfg['profile_fraction']):
+        yield
+        return
+
+    profiler = cProfile.Profile()
+    profiler.enable()
+    try:
+        yield
+    finally:
+        profiler.disable()
+        profiler.dump_stats(os.path.join(os.path.dirname(stdout), '{}.prof'.format(name)))
+
+
+def profile_paths(cfg):
+    """
+    Paths of the profiles of the tilewise calls found in the output directory.
+    """
+    return sorted(glob.glob(os.path.join(cfg['out_dir'], 'tiles', '**', '*.prof'),
+                            recursive=True))
+
+
+def remove_profiles(cfg):
+    """
+    Remove the profiles of the tilewise calls left by previous runs, so that
+    they are not merged with those of the current run.
+    """
+    for path in profile_paths(cfg):
+        os.remove(path)
+
+
+def merge_profiles(cfg, nb_lines=50):
+    """
+    Merge the profiles of the tilewise calls into a run-level profile.
+
+    Args:
+        cfg (dict): s2p config dictionary
+        nb_lines (int): number of functions listed in the text summary
+
+    Returns:
+        path to the merged profile, or None if there is no profile
+    """
+    names = set('{}.prof'.format(name) for name in cfg['profile_functions'])
+    paths = [p for p in profile_paths(cfg) if os.path.basename(p) in names]
+    if not paths:
+        return None
+
+    out = os.path.join(cfg['out_dir'], 'profile.prof')
+    pstats.Stats(*paths).dump_stats(out)
+
+    s = io.StringIO()
+    pstats.Stats(out, stream=s).sort_stats('cumulative').print_stats(nb_lines)
+    with open(os.path.join(cfg['out_dir'], 'profile.txt'), 'w') as f:
+        f.write('merged profiles of {} tilewise calls\n'.format(len(paths)))
+        f.write(s.getvalue())
+    return out
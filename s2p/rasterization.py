@@ -0,0 +1,306 @@
+"""
+rasterization of 3D points into digital surface models
+
+The points are accumulated into rasters of sums, with the same footprints and
+weights as plyflatten: each point contributes to the pixels at most radius
+pixels away from the pixel it falls in, with a weight exp(-d^2 / (2 sigma^2))
+depending on its distance d (in meters) to the pixel center, or 1 if sigma is
+None. Each accumulator pixel holds the sum of the weights, the max height and
+the weighted sums of the values (height, colors, confidence) of the points.
+
+Accumulators are merged by adding them (and taking the max of the max band),
+so that the DSM of a tile is the same when computed from the union of the
+points of the tile and its neighbors, or from the overlapping parts of their
+accumulators.
+"""
+
+import json
+
+import numba
+import numpy as np
+from numba import jit, prange
+import affine
+import rasterio
+import rasterio.windows
+
+from s2p import common
+
+
+# bands of an accumulator preceding the weighted sums of the values
+WEIGHT, MAX = 0, 1
+
+
+@jit(nopython=True, cache=True)
+def sort_by_rows(x, y, yoff, resolution, height, radius):
+    """
+    Counting sort of the points by the raster row they fall in.
+
+    The rows are shifted by radius, so that the points whose footprint
+    intersects the raster fall in the buckets 0 to height + 2 radius - 1. The
+    other points, and those with non-finite coordinates, are dropped.
+
+    Returns:
+        array of point indices, sorted by row, and array of the start of each
+        bucket in the first array
+    """
+    nb_buckets = height + 2 * radius
+    rows = np.empty(x.size, np.int64)
+    starts = np.zeros(nb_buckets + 1, np.int64)
+    for k in range(x.size):
+        rows[k] = -1
+        if np.isfinite(x[k]) and np.isfinite(y[k]):
+            j = np.floor((yoff - y[k]) / resolution) + radius
+            if 0 <= j < nb_buckets:
+                rows[k] = int(j)
+                starts[rows[k] + 1] += 1
+    for b in range(nb_buckets):
+        starts[b + 1] += starts[b]
+
+    order = np.empty(starts[nb_buckets], np.int64)
+    position = starts[:nb_buckets].copy()
+    for k in range(x.size):
+        if rows[k] >= 0:
+            order[position[rows[k]]] = k
+            position[rows[k]] += 1
+    return order, starts
+
+
+@jit(nopython=True, cache=True)
+def accumulate_rows(acc, x, y, v, order, starts, xoff, yoff, resolution,
+                    radius, sigma, row0, row1):
+    """
+    Accumulate the points sorted by sort_by_rows into the rows row0 to row1 - 1
+    of an accumulator. The rows of different calls can be filled concurrently.
+    """
+    height, width = acc.shape[0], acc.shape[1]
+    nb_values = v.shape[1]
+    gaussian = np.isfinite(sigma)
+    for b in range(row0, min(row1 + 2 * radius, height + 2 * radius)):
+        j = b - radius
+        for p in range(starts[b], starts[b + 1]):
+            k = order[p]
+            i = int(np.floor((x[k] - xoff) / resolution))
+            for jj in range(max(j - radius, row0), min(j + radius + 1, row1)):
+                for ii in range(max(i - radius, 0), min(i + radius + 1, width)):
+                    w = 1.0
+                    if gaussian:
+                        dx = x[k] - (xoff + resolution * (ii + 0.5))
+                        dy = y[k] - (yoff - resolution * (jj + 0.5))
+                        w = np.exp(-(dx * dx + dy * dy) / (2 * sigma * sigma))
+                    acc[jj, ii, WEIGHT] += w
+                    if v[k, 0] > acc[jj, ii, MAX]:
+                        acc[jj, ii, MAX] = v[k, 0]
+                    for c in range(nb_values):
+                        acc[jj, ii, 2 + c] += w * v[k, c]
+
+
+@jit(nopython=True, cache=True, parallel=True)
+def accumulate_strips(acc, x, y, v, order, starts, xoff, yoff, resolution,
+                      radius, sigma, strip):
+    height = acc.shape[0]
+    for s in prange((height + strip - 1) // strip):
+        accumulate_rows(acc, x, y, v, order, starts, xoff, yoff, resolution,
+                        radius, sigma, s * strip, min((s + 1) * strip, height))
+
+
+def empty_accumulator(xsize, ysize, nb_values):
+    """
+    Accumulator of shape (ysize, xsize, 2 + nb_values) without any point.
+    """
+    acc = np.zeros((ysize, xsize, 2 + nb_values))
+    acc[:, :, MAX] = -np.inf
+    return acc
+
+
+def rasterize(x, y, values, xoff, yoff, resolution, xsize, ysize, radius=0,
+              sigma=None, nb_threads=1):
+    """
+    Accumulate 3D points into a raster.
+
+    Args:
+        x, y (arrays): coordinates of the n points
+        values (array): array of shape (n, k) with the values of the points
+            to aggregate. The first column is the height
+        xoff, yoff (floats): coordinates of the upper left corner of the raster
+        resolution (float): size of the pixels, in the units of x and y
+        xsize, ysize (ints): size of the raster
+        radius (int): radius of the footprint of each point, in pixels
+        sigma (float): standard deviation of the Gaussian weights, in the units
+            of x and y. None for uniform weights
+        nb_threads (int): number of threads, each of them filling strips of
+            rows of the raster
+
+    Returns:
+        accumulator array of shape (ysize, xsize, 2 + k), see the module
+        docstring
+    """
+    x = np.ascontiguousarray(x, dtype=np.float64)
+    y = np.ascontiguousarray(y, dtype=np.float64)
+    values = np.ascontiguousarray(np.asarray(values, dtype=np.float64).reshape(len(x), -1))
+    sigma = np.inf if sigma is None else float(sigma)
+
+    acc = empty_accumulator(xsize, ysize, values.shape[1])
+    order, starts = sort_by_rows(x, y, yoff, resolution, ysize, radius)
+    if nb_threads > 1:
+        numba.set_num_threads(min(nb_threads, numba.config.NUMBA_NUM_THREADS))
+        strip = max(16, -(-ysize // (4 * nb_threads)))
+        accumulate_strips(acc, x, y, values, order, starts, xoff, yoff,
+                          resolution, radius, sigma, strip)
+    else:
+        accumulate_rows(acc, x, y, values, order, starts, xoff, yoff,
+                        resolution, radius, sigma, 0, ysize)
+    return acc
+
+
+def merge(acc, other, row, col):
+    """
+    Add an accumulator into another one, in place.
+
+    Args:
+        acc (array): accumulator to update
+        other (array): accumulator with the same bands, whose upper left pixel
+            is the pixel (row, col) of acc. Only the overlap of the two
+            accumulators is used
+        row, col (ints): position of other in acc
+    """
+    r0, c0 = max(row, 0), max(col, 0)
+    r1 = min(row + other.shape[0], acc.shape[0])
+    c1 = min(col + other.shape[1], acc.shape[1])
+    if r0 >= r1 or c0 >= c1:
+        return
+    a = acc[r0:r1, c0:c1]
+    b = other[r0 - row:r1 - row, c0 - col:c1 - col]
+    np.maximum(a[:, :, MAX], b[:, :, MAX], out=a[:, :, MAX])
+    a[:, :, WEIGHT] += b[:, :, WEIGHT]
+    a[:, :, 2:] += b[:, :, 2:]
+
+
+def bands(acc):
+    """
+    Aggregate the values accumulated in each pixel.
+
+    Args:
+        acc (array): accumulator of shape (ysize, xsize, 2 + k)
+
+    Returns:
+        array of shape (ysize, xsize, k) with the weighted averages of the
+        values, and array of shape (ysize, xsize) with the max heights. Both
+        are float32, and NaN on the pixels without any point
+    """
+    with np.errstate(invalid='ignore', divide='ignore'):
+        average = acc[:, :, 2:] / acc[:, :, WEIGHT, None]
+    empty = ~(acc[:, :, WEIGHT] > 0)
+    average[empty] = np.nan
+    highest = np.where(empty, np.nan, acc[:, :, MAX])
+    return average.astype(np.float32), highest.astype(np.float32)
+
+
+def grid(xmin, xmax, ymin, ymax, resolution):
+    """
+    Smallest raster, aligned on multiples of the resolution, containing a
+    bounding box.
+
+    Returns:
+        xoff, yoff, xsize, ysize
+    """
+    xoff = np.floor(xmin / resolution) * resolution
+    xsize = int(1 + np.floor((xmax - xoff) / resolution))
+    yoff = np.ceil(ymax / resolution) * resolution
+    ysize = int(1 - np.floor((ymin - yoff) / resolution))
+    return xoff, yoff, xsize, ysize
+
+
+def write_accumulator(path, acc, roi, resolution, radius, names, crs=None):
+    """
+    Write an accumulator to a float32 GeoTIFF file.
+
+    Args:
+        path (str): path to the output file
+        acc (array): accumulator covering the roi grown by radius pixels
+        roi (tuple): xoff, yoff, xsize, ysize of the DSM of the tile
+        resolution (float): size of the pixels
+        radius (int): margin of the accumulator around the roi, in pixels
+        names (list): names of the accumulated values
+        crs (rasterio.crs.CRS): coordinate reference system of the points
+    """
+    xoff, yoff = roi[0] - radius * resolution, roi[1] + radius * resolution
+    profile = {'tiled': True, 'compress': 'deflate', 'predictor': 3,
+               'crs': crs, 'transform': affine.Affine(resolution, 0.0, xoff,
+                                                      0.0, -resolution, yoff)}
+    common.rasterio_write(path, acc.astype(np.float32), profile=profile,
+                          tags={'ROI': json.dumps([float(t) for t in roi]),
+                                'VALUES': json.dumps(list(names))})
+
+
+def read_accumulator_tags(path):
+    """
+    Read the DSM roi and the names of the values of an accumulator file.
+
+    Returns:
+        xoff, yoff, xsize, ysize tuple, and list of names
+    """
+    with rasterio.open(path) as f:
+        tags = f.tags()
+    xoff, yoff, xsize, ysize = json.loads(tags['ROI'])
+    return (xoff, yoff, int(xsize), int(ysize)), json.loads(tags['VALUES'])
+
+
+def read_accumulator_window(path, xoff, yoff, xsize, ysize):
+    """
+    Read the part of an accumulator file overlapping a raster.
+
+    Args:
+        path (str): path to an accumulator file
+        xoff, yoff, xsize, ysize: raster, on the same grid as the accumulator
+
+    Returns:
+        accumulator array, and its position (row, col) in the raster, or
+        None, None if they don't overlap
+    """
+    with rasterio.open(path) as f:
+        resolution = f.transform.a
+        col = int(round((f.transform.c - xoff) / resolution))
+        row = int(round((yoff - f.transform.f) / resolution))
+        c0, c1 = max(-col, 0), min(xsize - col, f.width)
+        r0, r1 = max(-row, 0), min(ysize - row, f.height)
+        if c0 >= c1 or r0 >= r1:
+            return None, None
+        window = rasterio.windows.Window(c0, r0, c1 - c0, r1 - r0)
+        acc = f.read(window=window).transpose(1, 2, 0).astype(np.float64)
+    return acc, (row + r0, col + c0)
+
+
+def accumulators_to_dsm(paths):
+    """
+    Compute the DSM of a tile from its accumulator and its neighbors'.
+
+    Only the strips of the neighbors' accumulators overlapping the tile are
+    read.
+
+    Args:
+        paths (list): paths to the accumulator files, the first one being the
+            tile's
+
+    Returns:
+        array of shape (ysize, xsize, k) with the weighted averages of the
+        values, array of shape (ysize, xsize) with the max heights, list of the
+        names of the values, and rasterio profile of the DSM
+    """
+    roi, names = read_accumulator_tags(paths[0])
+    xoff, yoff, xsize, ysize = roi
+    with rasterio.open(paths[0]) as f:
+        resolution = f.transform.a
+        crs = f.crs
+
+    acc = empty_accumulator(xsize, ysize, len(names))
+    for path in paths:
+        other, position = read_accumulator_window(path, xoff, yoff, xsize, ysize)
+        if other is not None:
+            merge(acc, other, *position)
+
+    average, highest = bands(acc)
+    profile = {'tiled': True, 'compress': 'deflate', 'predictor': 2,
+               'nodata': float('nan'), 'crs': crs,
+               'transform': affine.Affine(resolution, 0.0, xoff,
+                                          0.0, -resolution, yoff)}
+    return average, highest, names, profile
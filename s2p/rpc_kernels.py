@@ -0,0 +1,233 @@
+"""
+compiled batched evaluation of RPC camera models
+
+The rational polynomial functions of the RPC models are evaluated point by
+point by numba kernels, which compute the 20 cubic monomials once for the
+numerator and denominator of both output coordinates. Large batches are
+split among several threads.
+"""
+
+import numba
+import numpy as np
+from numba import jit, prange
+import rpcm
+from rpcm.rpc_model import MaxLocalizationIterationsError
+
+
+# minimal number of points for which the multi-threaded kernels are used
+PARALLEL_THRESHOLD = 1 << 16
+
+
+@jit(nopython=True, cache=True)
+def poly(c, r, x, y, z):
+    """
+    Evaluate the cubic polynomial whose coefficients, ordered following the
+    RPC convention, are stored in the row r of c.
+    """
+    return (c[r, 0] + c[r, 1]*y + c[r, 2]*x + c[r, 3]*z + c[r, 4]*y*x
+            + c[r, 5]*y*z + c[r, 6]*x*z + c[r, 7]*y*y + c[r, 8]*x*x
+            + c[r, 9]*z*z + c[r, 10]*x*y*z + c[r, 11]*y*y*y + c[r, 12]*y*x*x
+            + c[r, 13]*y*z*z + c[r, 14]*y*y*x + c[r, 15]*x*x*x
+            + c[r, 16]*x*z*z + c[r, 17]*y*y*z + c[r, 18]*x*x*z
+            + c[r, 19]*z*z*z)
+
+
+@jit(nopython=True, cache=True)
+def rfm_pair(c, x, y, z):
+    """
+    Evaluate two rational functions sharing the same monomials. The rows of c
+    are the numerator and denominator coefficients of the first function,
+    then those of the second one. Once inlined, the monomials are computed
+    only once for the four polynomials.
+    """
+    return (poly(c, 0, x, y, z) / poly(c, 1, x, y, z),
+            poly(c, 2, x, y, z) / poly(c, 3, x, y, z))
+
+
+@jit(nopython=True, cache=True)
+def rfm(c, s, x, y, z, u, v):
+    # s holds the input offsets and scales, then the output offsets and scales
+    for i in range(x.size):
+        p, q = rfm_pair(c, (x[i] - s[0]) / s[3], (y[i] - s[1]) / s[4],
+                        (z[i] - s[2]) / s[5])
+        u[i] = p * s[8] + s[6]
+        v[i] = q * s[9] + s[7]
+
+
+@jit(nopython=True, cache=True, parallel=True)
+def rfm_parallel(c, s, x, y, z, u, v):
+    for i in prange(x.size):
+        p, q = rfm_pair(c, (x[i] - s[0]) / s[3], (y[i] - s[1]) / s[4],
+                        (z[i] - s[2]) / s[5])
+        u[i] = p * s[8] + s[6]
+        v[i] = q * s[9] + s[7]
+
+
+@jit(nopython=True, cache=True)
+def localize(c, col, row, alt):
+    """
+    Same iterative inversion of the projection function as
+    rpcm.RPCModel.localization_iterative, on a single point given by its
+    normalized coordinates. The point stops iterating as soon as it has
+    converged.
+
+    Returns:
+        normalized longitude and latitude, and False if the iterations did not
+        converge
+    """
+    if not (np.isfinite(col) and np.isfinite(row) and np.isfinite(alt)):
+        return np.nan, np.nan, True
+
+    lon = lat = -1.0
+    eps = 2.0
+    x0, y0 = rfm_pair(c, lat, lon, alt)
+    x1, y1 = rfm_pair(c, lat, lon + eps, alt)
+    x2, y2 = rfm_pair(c, lat + eps, lon, alt)
+    n = 0
+    while (x0 - col)**2 + (y0 - row)**2 >= 1e-18:
+        if n > 100:
+            return lon, lat, False
+        e1x, e1y = x1 - x0, y1 - y0
+        e2x, e2y = x2 - x0, y2 - y0
+        ux, uy = col - x0, row - y0
+        lon += (ux * e1x + uy * e1y) / (e1x * e1x + e1y * e1y) * eps
+        lat += (ux * e2x + uy * e2y) / (e2x * e2x + e2y * e2y) * eps
+        eps = 0.1
+        x0, y0 = rfm_pair(c, lat, lon, alt)
+        x1, y1 = rfm_pair(c, lat, lon + eps, alt)
+        x2, y2 = rfm_pair(c, lat + eps, lon, alt)
+        n += 1
+    return lon, lat, True
+
+
+@jit(nopython=True, cache=True)
+def localization_iterative(c, s, col, row, alt, lon, lat):
+    failures = 0
+    for i in range(col.size):
+        x, y, ok = localize(c, (col[i] - s[0]) / s[3], (row[i] - s[1]) / s[4],
+                            (alt[i] - s[2]) / s[5])
+        lon[i] = x * s[8] + s[6]
+        lat[i] = y * s[9] + s[7]
+        failures += not ok
+    return failures
+
+
+@jit(nopython=True, cache=True, parallel=True)
+def localization_iterative_parallel(c, s, col, row, alt, lon, lat):
+    failures = 0
+    for i in prange(col.size):
+        x, y, ok = localize(c, (col[i] - s[0]) / s[3], (row[i] - s[1]) / s[4],
+                            (alt[i] - s[2]) / s[5])
+        lon[i] = x * s[8] + s[6]
+        lat[i] = y * s[9] + s[7]
+        failures += not ok
+    return failures
+
+
+class CompiledRPCModel(rpcm.RPCModel):
+    """
+    Drop-in replacement of rpcm.RPCModel whose projection and localization
+    functions are evaluated by compiled kernels.
+
+    The coefficients are copied into contiguous arrays when the model is
+    built: modifying them afterwards has no effect on the kernels.
+    """
+
+    def __init__(self, rpc, nb_threads=1):
+        """
+        Args:
+            rpc (rpcm.RPCModel): camera model
+            nb_threads (int): number of threads used on batches of more than
+                PARALLEL_THRESHOLD points
+        """
+        super().__init__(dict(rpc.__dict__), dict_format='rpcm')
+        self.nb_threads = nb_threads
+
+        self._projection_coefs = np.array([self.col_num, self.col_den,
+                                           self.row_num, self.row_den])
+        self._projection_scales = np.array([
+            self.lat_offset, self.lon_offset, self.alt_offset,
+            self.lat_scale, self.lon_scale, self.alt_scale,
+            self.col_offset, self.row_offset, self.col_scale, self.row_scale])
+        if hasattr(self, 'lat_num'):
+            self._localization_coefs = np.array([self.lon_num, self.lon_den,
+                                                 self.lat_num, self.lat_den])
+        self._localization_scales = np.array([
+            self.row_offset, self.col_offset, self.alt_offset,
+            self.row_scale, self.col_scale, self.alt_scale,
+            self.lon_offset, self.lat_offset, self.lon_scale, self.lat_scale])
+
+    def _run(self, serial, parallel, *args):
+        """
+        Call a kernel on broadcast copies of the input arrays.
+
+        Returns:
+            the output of the kernel and two float64 arrays with the shape of
+            the broadcast inputs, as rpcm whatever the input dtypes
+        """
+        arrays = [np.asarray(a) for a in args]
+        shape = np.broadcast_shapes(*(a.shape for a in arrays))
+        arrays = [np.ascontiguousarray(np.broadcast_to(a, shape), dtype=np.float64).ravel()
+                  for a in arrays]
+        u = np.empty(arrays[0].size, dtype=np.float64)
+        v = np.empty(arrays[0].size, dtype=np.float64)
+        if self.nb_threads > 1 and u.size >= PARALLEL_THRESHOLD:
+            numba.set_num_threads(min(self.nb_threads, numba.config.NUMBA_NUM_THREADS))
+            out = parallel(*arrays, u, v)
+        else:
+            out = serial(*arrays, u, v)
+        return out, u.reshape(shape)[()], v.reshape(shape)[()]
+
+    def projection(self, lon, lat, alt):
+        """
+        Convert geographic coordinates of 3D points into image coordinates.
+
+        Args:
+            lon, lat, alt (floats or arrays): coordinates of the input points
+
+        Returns:
+            column and row image coordinates of the input points
+        """
+        c, s = self._projection_coefs, self._projection_scales
+        _, col, row = self._run(lambda *a: rfm(c, s, *a),
+                                lambda *a: rfm_parallel(c, s, *a),
+                                lat, lon, alt)
+        return col, row
+
+    def localization(self, col, row, alt, return_normalized=False):
+        """
+        Convert image coordinates plus altitude into geographic coordinates.
+
+        Args:
+            col, row, alt (floats or arrays): image coordinates and altitudes
+                of the input points
+            return_normalized (bool): whether to return normalized longitudes
+                and latitudes
+
+        Returns:
+            longitudes and latitudes of the input points
+
+        Raises:
+            MaxLocalizationIterationsError: if the iterative localization does
+                not converge in 100 iterations for some of the points
+        """
+        s = self._localization_scales
+        if return_normalized:
+            s = np.concatenate([s[:6], [0, 0, 1, 1]])
+
+        if hasattr(self, '_localization_coefs'):
+            c = self._localization_coefs
+            _, lon, lat = self._run(lambda *a: rfm(c, s, *a),
+                                    lambda *a: rfm_parallel(c, s, *a),
+                                    row, col, alt)
+            return lon, lat
+
+        # the iterative kernel normalizes the inputs in (col, row) order
+        s = np.concatenate([s[[1, 0, 2, 4, 3, 5]], s[6:]])
+        c = self._projection_coefs
+        failures, lon, lat = self._run(lambda *a: localization_iterative(c, s, *a),
+                                       lambda *a: localization_iterative_parallel(c, s, *a),
+                                       col, row, alt)
+        if failures:
+            raise MaxLocalizationIterationsError("Max localization iterations (100) exceeded")
+        return lon, lat
@@ -43,6 +43,152 @@ def find_corresponding_point(model_a, model_b, x, y, z):
     return (xp, yp, z)
 
 
+class LocalizationGrid:
+    """
+    Fast approximation of the localization function of a camera model on a
+    region of interest, by trilinear interpolation of exact localizations
+    sampled on a regular (col, row, alt) grid.
+
+    The grid is refined until the interpolation error, measured at the centers
+    of the grid cells, is below a given bound. Points outside of the grid are
+    localized with the exact model. The other attributes of the wrapped model
+    (projection, alt_offset, ...) are exposed unchanged, so that a grid can be
+    used in place of an rpcm.RPCModel instance, for instance as model_a in
+    find_corresponding_point.
+    """
+
+    def __init__(self, rpc, x, y, w, h, alt_min, alt_max, max_error=0.01,
+                 step=64, max_refinements=5):
+        """
+        Args:
+            rpc: instance of the rpcm.RPCModel class
+            x, y, w, h: four numbers defining the rectangular region of
+                interest (ROI) covered by the grid. (x, y) is the top-left
+                corner, and (w, h) are the dimensions of the rectangle.
+            alt_min, alt_max: altitude range covered by the grid
+            max_error (float): maximal interpolation error, in meters
+            step (float): initial spacing of the grid nodes, in pixels
+            max_refinements (int): maximal number of times the grid spacing
+                is halved to reach max_error
+        """
+        self.rpc = rpc
+        self.x, self.y = x, y
+        self.alt_min = alt_min
+        self.alt_max = max(alt_max, alt_min + 1)
+        self.w, self.h = max(w, 1), max(h, 1)
+
+        nc = int(np.ceil(self.w / step)) + 1
+        nr = int(np.ceil(self.h / step)) + 1
+        na = 2
+        for _ in range(max_refinements + 1):
+            self._sample(nc, nr, na)
+            err_xy, err_alt = self._errors()
+            self.error = err_xy + err_alt
+            if self.error <= max_error:
+                break
+            if err_xy > max_error / 2:
+                nc, nr = 2 * nc - 1, 2 * nr - 1
+            if err_alt > max_error / 2:
+                na = 2 * na - 1
+        else:
+            logger.warning("localization grid error of {:.3g} m exceeds the "
+                           "requested {:.3g} m".format(self.error, max_error))
+
+    def __getattr__(self, name):
+        if name == 'rpc':  # avoid infinite recursion while unpickling
+            raise AttributeError(name)
+        return getattr(self.rpc, name)
+
+    def _sample(self, nc, nr, na):
+        """
+        Sample the exact localization function on a grid of nc x nr x na nodes.
+        """
+        self.shape = (na, nr, nc)
+        self.cols = np.linspace(self.x, self.x + self.w, nc)
+        self.rows = np.linspace(self.y, self.y + self.h, nr)
+        self.alts = np.linspace(self.alt_min, self.alt_max, na)
+        a, r, c = np.meshgrid(self.alts, self.rows, self.cols, indexing='ij')
+        lon, lat = self.rpc.localization(c.ravel(), r.ravel(), a.ravel())
+        self.lonlat = np.column_stack([lon, lat])
+
+    def _errors(self):
+        """
+        Measure the interpolation error, in meters, at the centers of the
+        (col, row) cells on the altitude nodes, and at the middle altitudes on
+        the (col, row) nodes.
+        """
+        mid = lambda v: (v[:-1] + v[1:]) / 2
+        errors = []
+        for cols, rows, alts in [(mid(self.cols), mid(self.rows), self.alts),
+                                 (self.cols, self.rows, mid(self.alts))]:
+            a, r, c = [v.ravel() for v in np.meshgrid(alts, rows, cols,
+                                                      indexing='ij')]
+            lon, lat = self.rpc.localization(c, r, a)
+            lon_i, lat_i = self._interpolate(c, r, a)
+            dx = (lon_i - lon) * np.cos(np.radians(lat))
+            dy = lat_i - lat
+            errors.append(np.max(np.hypot(dx, dy)) * 111320)
+        return errors
+
+    def _interpolate(self, col, row, alt):
+        """
+        Trilinear interpolation of the sampled localizations. The input points
+        are assumed to be inside the grid.
+        """
+        na, nr, nc = self.shape
+        u = (col - self.x) * ((nc - 1) / self.w)
+        v = (row - self.y) * ((nr - 1) / self.h)
+        t = (alt - self.alt_min) * ((na - 1) / (self.alt_max - self.alt_min))
+        i = np.clip(u.astype(int), 0, nc - 2)
+        j = np.clip(v.astype(int), 0, nr - 2)
+        k = np.clip(t.astype(int), 0, na - 2)
+        u = (u - i)[:, np.newaxis]
+        v = (v - j)[:, np.newaxis]
+        t = (t - k)[:, np.newaxis]
+
+        g = self.lonlat
+        n = (k * nr + j) * nc + i  # index of the (i, j, k) node
+        lerp = lambda a, b, s: a + s * (b - a)
+        bottom = lerp(lerp(g[n], g[n + 1], u),
+                      lerp(g[n + nc], g[n + nc + 1], u), v)
+        n += nr * nc
+        top = lerp(lerp(g[n], g[n + 1], u),
+                   lerp(g[n + nc], g[n + nc + 1], u), v)
+        out = lerp(bottom, top, t)
+        return out[:, 0], out[:, 1]
+
+    def localization(self, col, row, alt):
+        """
+        Convert image coordinates plus altitude into geographic coordinates.
+
+        Args:
+            col, row, alt (floats or arrays): image coordinates and altitudes
+                of the input points
+
+        Returns:
+            longitudes and latitudes of the input points
+        """
+        col, row, alt = np.broadcast_arrays(col, row, alt)
+        shape = col.shape
+        col, row, alt = [np.asarray(v, dtype=float).ravel() for v in (col, row, alt)]
+
+        inside = ((col >= self.x) & (col <= self.x + self.w) &
+                  (row >= self.y) & (row <= self.y + self.h) &
+                  (alt >= self.alt_min) & (alt <= self.alt_max))
+        if inside.all():
+            lon, lat = self._interpolate(col, row, alt)
+        else:
+            lon = np.empty(col.shape)
+            lat = np.empty(col.shape)
+            lon[inside], lat[inside] = self._interpolate(col[inside],
+                                                         row[inside],
+                                                         alt[inside])
+            out = ~inside
+            lon[out], lat[out] = self.rpc.localization(col[out], row[out],
+                                                       alt[out])
+        return lon.reshape(shape)[()], lat.reshape(shape)[()]
+
+
 def geodesic_bounding_box(rpc, x, y, w, h):
     """
     Computes a bounding box on the WGS84 ellipsoid associated to a Pleiades
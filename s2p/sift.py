@@ -31,11 +31,46 @@ here = os.path.dirname(os.path.abspath(__file__))
 sift4ctypes = os.path.join(os.path.dirname(here), 'lib', 'libsift4ctypes.so')
 lib = ctypes.CDLL(sift4ctypes)
 
+# Set expected args and return types, once for all
+lib.sift.argtypes = (ndpointer(dtype=ctypes.c_float, ndim=2, flags='C_CONTIGUOUS'),
+                     ctypes.c_uint, ctypes.c_uint, ctypes.c_float,
+                     ctypes.c_uint, ctypes.c_uint, ctypes.POINTER(ctypes.c_uint),
+                     ctypes.POINTER(ctypes.c_uint))
+lib.sift.restype = ctypes.POINTER(ctypes.c_float)
+
+lib.matching.argtypes = (ndpointer(dtype=ctypes.c_float, ndim=2, flags='C_CONTIGUOUS'),
+                         ndpointer(dtype=ctypes.c_float, ndim=2, flags='C_CONTIGUOUS'),
+                         ctypes.c_uint, ctypes.c_uint, ctypes.c_uint,
+                         ctypes.c_uint, ctypes.c_float, ctypes.c_float,
+                         ndpointer(dtype=ctypes.c_double, shape=(5,)),
+                         ctypes.c_bool, ctypes.c_bool,
+                         ctypes.POINTER(ctypes.c_uint))
+lib.matching.restype = ctypes.POINTER(ctypes.c_float)
+
+lib.delete_buffer.argtypes = ctypes.POINTER(ctypes.c_float),
+
 
 # Filter warnings from rasterio reading files wihtout georeferencing
 warnings.filterwarnings("ignore", category=rio.errors.NotGeoreferencedWarning)
 
 
+def copy_float_buffer(ptr, shape):
+    """
+    Copy a C buffer of floats into a new float64 numpy array.
+
+    Args:
+        ptr: ctypes pointer to the buffer
+        shape: shape of the output array
+
+    Returns:
+        numpy array of the given shape, that doesn't share memory with the buffer
+    """
+    n = int(np.prod(shape))
+    if n == 0:
+        return np.empty(shape, dtype=np.float64)
+    return np.ctypeslib.as_array(ptr, shape=(n,)).astype(np.float64).reshape(shape)
+
+
 def keypoints_from_nparray(arr, thresh_dog=0.0133, nb_octaves=8, nb_scales=3, offset=None):
     """
     Runs SIFT (the keypoints detection and description only, no matching) on an image stored in a 2D numpy array
@@ -61,29 +96,20 @@ def keypoints_from_nparray(arr, thresh_dog=0.0133, nb_octaves=8, nb_scales=3, of
     # retrieve numpy buffer dimensions
     h, w = arr.shape
 
-    # Set expected args and return types
-    lib.sift.argtypes = (ndpointer(dtype=ctypes.c_float, shape=(h, w)), ctypes.c_uint, ctypes.c_uint, ctypes.c_float,
-                         ctypes.c_uint, ctypes.c_uint, ctypes.POINTER(ctypes.c_uint), ctypes.POINTER(ctypes.c_uint))
-    lib.sift.restype = ctypes.POINTER(ctypes.c_float)
-
     # Create variables to be updated by function call
     nb_points = ctypes.c_uint()
     desc_size = ctypes.c_uint()
 
     # Call sift fonction from sift4ctypes.so
-    keypoints_ptr = lib.sift(arr.astype(np.float32), w, h, thresh_dog,
+    keypoints_ptr = lib.sift(np.ascontiguousarray(arr, dtype=np.float32), w, h, thresh_dog,
                              nb_octaves, nb_scales, ctypes.byref(desc_size), ctypes.byref(nb_points))
 
-    # Transform result into a numpy array
-    keypoints = np.asarray([keypoints_ptr[i]
-                            for i in range(nb_points.value*desc_size.value)])
+    # Copy the result into a numpy array
+    keypoints = copy_float_buffer(keypoints_ptr, (nb_points.value, desc_size.value))
 
     # Delete results to release memory
-    lib.delete_buffer.argtypes = (ctypes.POINTER(ctypes.c_float)),
-    lib.delete_buffer(keypoints_ptr)
-
-    # Reshape keypoints array
-    keypoints = keypoints.reshape((nb_points.value, desc_size.value))
+    if keypoints_ptr:
+        lib.delete_buffer(keypoints_ptr)
 
     if offset is not None:
         x, y = offset
@@ -202,16 +228,6 @@ def keypoints_match_from_nparray(k1, k2, method, sift_threshold,
     """
     Wrapper for the sift keypoints matching function of libsift4ctypes.so.
     """
-    # Set expected args and return types
-    lib.matching.argtypes = (ndpointer(dtype=ctypes.c_float, shape=k1.shape),
-                             ndpointer(dtype=ctypes.c_float, shape=k2.shape),
-                             ctypes.c_uint, ctypes.c_uint, ctypes.c_uint,
-                             ctypes.c_uint, ctypes.c_float, ctypes.c_float,
-                             ndpointer(dtype=ctypes.c_double, shape=(5,)),
-                             ctypes.c_bool, ctypes.c_bool,
-                             ctypes.POINTER(ctypes.c_uint))
-    lib.matching.restype = ctypes.POINTER(ctypes.c_float)
-
     # Get info of descriptor size
     nb_sift_k1, descr = k1.shape
     sift_offset = 4
@@ -231,21 +247,21 @@ def keypoints_match_from_nparray(k1, k2, method, sift_threshold,
     nb_matches = ctypes.c_uint()
 
     # Call sift fonction from sift4ctypes.so
-    matches_ptr = lib.matching(k1.astype('float32'), k2.astype('float32'),
+    matches_ptr = lib.matching(np.ascontiguousarray(k1, dtype=np.float32),
+                               np.ascontiguousarray(k2, dtype=np.float32),
                                length_descr, sift_offset, len(k1), len(k2),
                                sift_threshold, epi_threshold, coeff_mat,
                                use_fundamental_matrix, use_relative_method,
                                ctypes.byref(nb_matches))
 
-    # Transform result into a numpy array
-    matches = np.asarray([matches_ptr[i] for i in range(nb_matches.value * 4)])
+    # Copy the result into a numpy array
+    matches = copy_float_buffer(matches_ptr, (nb_matches.value, 4))
 
     # Delete results to release memory
-    lib.delete_buffer.argtypes = ctypes.POINTER(ctypes.c_float),
-    lib.delete_buffer(matches_ptr)
+    if matches_ptr:
+        lib.delete_buffer(matches_ptr)
 
-    # Reshape keypoints array
-    return matches.reshape((nb_matches.value, 4))
+    return matches
 
 
 def matches_on_rpc_roi(cfg, im1, im2, rpc1, rpc2, x, y, w, h,
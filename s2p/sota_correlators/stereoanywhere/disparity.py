@@ -1,9 +1,11 @@
 import argparse
 from types import SimpleNamespace
 import os
+import logging
 
 import iio
 import numpy as np
+import rasterio
 import torch
 import torch.nn.functional as F
 from scipy import ndimage
@@ -12,6 +14,7 @@ from s2p import common
 from s2p.sota_correlators.stereoanywhere.models.depth_anything_v2 import get_depth_anything_v2
 from s2p.sota_correlators.stereoanywhere.models.stereoanywhere import StereoAnywhere
 
+logger = logging.getLogger(__name__)
 
 def load_stereo_and_mono_models(
     stereo_ckpt: str,
@@ -83,28 +86,80 @@ def read_image(path: str) -> torch.Tensor:
 def pad_to_multiple(x: torch.Tensor, multiple: int = 32):
     """Symmetric replicate-pad so H & W are divisible by *multiple*."""
     h, w = x.shape[-2:]
-    ph = (multiple - h % multiple) % multiple
-    pw = (multiple - w % multiple) % multiple
+    return pad_to_shape(x, padded_size(h, multiple), padded_size(w, multiple))
+
+
+def pad_to_shape(x: torch.Tensor, height: int, width: int):
+    """Symmetric replicate-pad so that x has shape (..., height, width)."""
+    h, w = x.shape[-2:]
+    ph = height - h
+    pw = width - w
     pad = [pw // 2, pw - pw // 2, ph // 2, ph - ph // 2]  # l r t b
     return F.pad(x, pad, mode="replicate"), pad
 
 
+def padded_size(n: int, multiple: int = 32) -> int:
+    """Smallest multiple of *multiple* greater or equal to n."""
+    return -(-n // multiple) * multiple
+
+
 def unpad(x: torch.Tensor, pad):
     _, _, h, w = x.shape
     return x[..., pad[2] : h - pad[3], pad[0] : w - pad[1]]
 
 
-@torch.no_grad()
-def run(
-    left_path, right_path, mono_ckpt, stereo_ckpt, disparity_path, mask_path
-):
-    device = torch.device("cuda" if torch.cuda.is_available() else "cpu")
+def shift_columns(x: torch.Tensor, offset: int) -> torch.Tensor:
+    """
+    Shift the columns of x so that out[..., j] = x[..., j + offset], with
+    replicate padding on the borders.
+    """
+    if offset > 0:
+        return F.pad(x, [0, offset, 0, 0], mode="replicate")[..., offset:]
+    if offset < 0:
+        return F.pad(x, [-offset, 0, 0, 0], mode="replicate")[..., :offset]
+    return x
+
+
+def range_offset_and_iters(disp_range, maxdisp: int, max_iters: int, min_iters: int = 8):
+    """
+    Shift applied to the secondary image and number of GRU iterations used
+    for a known disparity range.
+
+    Args:
+        disp_range: (disp_min, disp_max) tuple, or None
+        maxdisp: disparity range the model was trained for
+        max_iters: number of iterations used for ranges of maxdisp or more
+        min_iters: minimal number of iterations
 
-    left_image = read_image(left_path).to(device)
-    right_image = read_image(right_path).to(device)
+    Returns:
+        offset: upper bound of the range, to be subtracted from the
+            disparities by shifting the secondary image and added back to the
+            result. The residual disparities seen by the model are thus in
+            [disp_min - disp_max, 0], with the sign of the raw flow it was
+            trained on
+        iters: number of iterations, proportional to the width of the range
+    """
+    if disp_range is None:
+        return 0, max_iters
+    disp_min, disp_max = disp_range
+    offset = int(np.ceil(disp_max))
+    iters = int(np.clip(np.ceil(max_iters * (disp_max - disp_min) / maxdisp), min_iters, max_iters))
+    return offset, iters
+
+
+def mask_out_of_range(disparity: np.ndarray, disp_range) -> np.ndarray:
+    """Set to NaN the disparities outside of disp_range (if not None)."""
+    if disp_range is not None:
+        disp_min, disp_max = disp_range
+        disparity[(disparity < disp_min) | (disparity > disp_max)] = np.nan
+    return disparity
 
-    # Load models
-    args = SimpleNamespace(
+
+def default_model_args() -> SimpleNamespace:
+    """
+    Arguments used to build the StereoAnywhere network for inference.
+    """
+    return SimpleNamespace(
         maxdisp=192,
         n_downsample=2,
         n_additional_hourglass=0,
@@ -118,36 +173,340 @@ def run(
         use_aggregate_mono_vol=False,
         iters=32,
     )
-    stereo_model, mono_model = load_stereo_and_mono_models(stereo_ckpt, mono_ckpt, args)
-
-    # Monocular inference
-    cat = torch.cat([left_image, right_image], dim=0)  # [2, 3, H, W]
-    mono_depths = mono_model.infer_image(
-        cat, input_size_width=cat.shape[-1], input_size_height=cat.shape[-2]
-    )  # [2, 1, H, W]
-    # normalize per pair 0-1
-    mono_depths = (mono_depths - mono_depths.min()) / (
-        mono_depths.max() - mono_depths.min()
-    )
-    mono_left, mono_right = mono_depths[0:1], mono_depths[1:2]
-
-    # Pad everything to multiple of 32
-    left_image, pad_left = pad_to_multiple(left_image)  # [1, 3, H, W]
-    right_image, _ = pad_to_multiple(right_image)  # [1, 3, H, W]
-    mono_left, _ = pad_to_multiple(mono_left)
-    mono_right, _ = pad_to_multiple(mono_right)
-    # Stereo inference
-    with torch.no_grad():
-        disparity, _ = stereo_model(
+
+
+class StereoAnywhereEngine:
+    """
+    StereoAnywhere and Depth-Anything-v2 models loaded once and kept on the
+    device, so that many rectified pairs can be processed without reloading
+    the checkpoints.
+    """
+
+    def __init__(self, stereo_ckpt: str, mono_ckpt: str, device: torch.device = None):
+        if device is None:
+            device = torch.device("cuda" if torch.cuda.is_available() else "cpu")
+        self.device = device
+        self.args = default_model_args()
+        self.stereo_model, self.mono_model = load_stereo_and_mono_models(
+            stereo_ckpt, mono_ckpt, self.args, device=device
+        )
+
+    @torch.no_grad()
+    def infer(self, left_image: torch.Tensor, right_image: torch.Tensor,
+              disp_range=None, flow_tol=None) -> np.ndarray:
+        """
+        Compute the disparity map of a rectified pair.
+
+        Args:
+            left_image, right_image: [1, 3, H, W] float32 tensors in [0 .. 1]
+            disp_range (optional): (disp_min, disp_max) tuple. If set, the
+                secondary image is shifted by the upper bound of the range, the
+                number of GRU iterations is proportional to the width of the
+                range and the disparities outside of the range are set to NaN
+            flow_tol (optional): stop the GRU iterations once the mean flow
+                update is below this value (see StereoAnywhere.forward)
+
+        Returns:
+            numpy array of shape (H, W) with the disparities
+        """
+        offset, iters = range_offset_and_iters(disp_range, self.args.maxdisp, self.args.iters)
+        left_image = left_image.to(self.device)
+        right_image = shift_columns(right_image.to(self.device), offset)
+
+        # Monocular inference
+        cat = torch.cat([left_image, right_image], dim=0)  # [2, 3, H, W]
+        mono_depths = self.mono_model.infer_image(
+            cat, input_size_width=cat.shape[-1], input_size_height=cat.shape[-2]
+        )  # [2, 1, H, W]
+        # normalize per pair 0-1
+        mono_depths = (mono_depths - mono_depths.min()) / (
+            mono_depths.max() - mono_depths.min()
+        )
+        mono_left, mono_right = mono_depths[0:1], mono_depths[1:2]
+
+        # Pad everything to multiple of 32
+        left_image, pad_left = pad_to_multiple(left_image)  # [1, 3, H, W]
+        right_image, _ = pad_to_multiple(right_image)  # [1, 3, H, W]
+        mono_left, _ = pad_to_multiple(mono_left)
+        mono_right, _ = pad_to_multiple(mono_right)
+
+        # Stereo inference
+        disparity, _ = self.stereo_model(
             left_image,
             right_image,
             mono_left,
             mono_right,
             test_mode=True,
-            iters=stereo_model.args.iters,
+            iters=iters,
+            flow_tol=flow_tol,
         )
-        # disparity = -disparity
-        disparity = unpad(disparity, pad_left).squeeze([0, 1]).cpu().numpy()
+        disparity = unpad(disparity, pad_left).squeeze([0, 1]).cpu().numpy() + offset
+        return mask_out_of_range(disparity, disp_range)
+
+    def weights_memory(self) -> float:
+        """
+        Memory used by the weights of both models, in MB.
+        """
+        return sum(
+            p.numel() * p.element_size()
+            for model in (self.stereo_model, self.mono_model)
+            for p in model.parameters()
+        ) / 2 ** 20
+
+    @torch.no_grad()
+    def infer_windowed(self, left_image: torch.Tensor, right_image: torch.Tensor,
+                       max_memory: float, overlap: int = 64, **kwargs) -> np.ndarray:
+        """
+        Compute the disparity map of a rectified pair by running the models on
+        overlapping horizontal windows, so that the peak memory stays below
+        max_memory. The overlaps are blended with linear weights.
+
+        Args:
+            left_image, right_image: [1, 3, H, W] float32 tensors in [0 .. 1]
+            max_memory: peak memory target, in MB, including the model weights
+            overlap: number of rows shared by consecutive windows
+            kwargs: passed to infer
+
+        Returns:
+            numpy array of shape (H, W) with the disparities
+        """
+        h, w = left_image.shape[-2:]
+        win = window_height(padded_size(w), max_memory - self.weights_memory(), overlap)
+        if win >= h:
+            return self.infer(left_image, right_image, **kwargs)
+
+        ramp = np.linspace(0, 1, overlap + 2, dtype=np.float32)[1:-1]
+        out = np.zeros((h, w), dtype=np.float32)
+        weights = np.zeros((h, w), dtype=np.float32)
+        starts = list(range(0, h - win, win - overlap)) + [h - win]
+        for y in starts:
+            disparity = self.infer(left_image[..., y:y + win, :],
+                                   right_image[..., y:y + win, :], **kwargs)
+            wgt = np.ones(win, dtype=np.float32)
+            if y > 0:
+                wgt[:overlap] = ramp
+            if y + win < h:
+                wgt[-overlap:] = ramp[::-1]
+            # NaN disparities (out of range) do not contribute to the blending
+            valid = np.isfinite(disparity)
+            out[y:y + win] += np.where(valid, disparity, 0) * wgt[:, None]
+            weights[y:y + win] += valid * wgt[:, None]
+        with np.errstate(invalid='ignore', divide='ignore'):
+            return np.where(weights > 0, out / weights, np.nan).astype(np.float32)
+
+    @torch.no_grad()
+    def infer_batch(self, left_images: list, right_images: list,
+                    disp_ranges: list = None, flow_tol=None) -> list:
+        """
+        Compute the disparity maps of several rectified pairs in a single
+        forward pass of each model.
+
+        All the images are padded to the same shape, so the pairs should have
+        similar sizes (see make_batches).
+
+        Args:
+            left_images, right_images: lists of [1, 3, H, W] float32 tensors
+                in [0 .. 1]
+            disp_ranges (optional): list of (disp_min, disp_max) tuples, one
+                per pair (see infer). The number of GRU iterations is the
+                largest one needed by the pairs of the batch
+            flow_tol (optional): see infer
+
+        Returns:
+            list of numpy arrays with the disparities, one per pair
+        """
+        if disp_ranges is None:
+            disp_ranges = [None] * len(left_images)
+        offsets, iters = zip(*[range_offset_and_iters(r, self.args.maxdisp, self.args.iters)
+                               for r in disp_ranges])
+
+        height = padded_size(max(x.shape[-2] for x in left_images + right_images))
+        width = padded_size(max(x.shape[-1] for x in left_images + right_images))
+
+        lefts, rights, pads = [], [], []
+        for left_image, right_image, offset in zip(left_images, right_images, offsets):
+            left_image, pad = pad_to_shape(left_image, height, width)
+            right_image, _ = pad_to_shape(shift_columns(right_image, offset), height, width)
+            lefts.append(left_image)
+            rights.append(right_image)
+            pads.append(pad)
+        left = torch.cat(lefts, dim=0).to(self.device)  # [B, 3, H, W]
+        right = torch.cat(rights, dim=0).to(self.device)  # [B, 3, H, W]
+        b = len(pads)
+
+        # Monocular inference
+        mono_depths = self.mono_model.infer_image(
+            torch.cat([left, right], dim=0),
+            input_size_width=width,
+            input_size_height=height,
+        )  # [2B, 1, H, W]
+        mono_left, mono_right = mono_depths[:b], mono_depths[b:]
+
+        # normalize per pair 0-1, ignoring the padding
+        for k, pad in enumerate(pads):
+            valid = torch.cat([unpad(mono_left[k:k + 1], pad),
+                               unpad(mono_right[k:k + 1], pad)])
+            lo, hi = valid.min(), valid.max()
+            mono_left[k] = (mono_left[k] - lo) / (hi - lo)
+            mono_right[k] = (mono_right[k] - lo) / (hi - lo)
+
+        # Stereo inference
+        disparity, _ = self.stereo_model(
+            left,
+            right,
+            mono_left,
+            mono_right,
+            test_mode=True,
+            iters=max(iters),
+            flow_tol=flow_tol,
+        )
+        return [mask_out_of_range(unpad(disparity[k:k + 1], pad).squeeze([0, 1]).cpu().numpy() + offset, r)
+                for k, (pad, offset, r) in enumerate(zip(pads, offsets, disp_ranges))]
+
+
+def estimate_memory(h: int, w: int, batch_size: int = 1,
+                    volume_channels: int = 8, n_downsample: int = 2) -> float:
+    """
+    Rough estimate of the peak memory needed to process a batch of pairs.
+
+    Args:
+        h, w: padded height and width of the images
+        batch_size: number of pairs processed together
+        volume_channels, n_downsample: StereoAnywhere parameters
+
+    Returns:
+        memory in MB
+    """
+    hl, wl = h / 2 ** n_downsample, w / 2 ** n_downsample
+    # all-pairs correlation volumes (stereo, mono and aggregated mono) of
+    # shape C x H/4 x W/4 x W/4
+    volumes = 3 * volume_channels * hl * wl * wl
+    # encoder features, context and GRU hidden states at 1/4 resolution
+    features = 1024 * hl * wl
+    # Depth-Anything attention matrices on both images (16 heads, 14x14 patches)
+    tokens = (h / 14) * (w / 14)
+    attention = 2 * 16 * tokens * tokens
+    return batch_size * 4 * (volumes + features + attention) / 2 ** 20
+
+
+def window_height(width: int, max_memory: float, overlap: int, multiple: int = 32) -> int:
+    """
+    Height of the largest window of padded width *width* whose inference
+    fits in max_memory.
+
+    Args:
+        width: padded width of the images
+        max_memory: memory budget for the activations, in MB
+        overlap: number of rows shared by consecutive windows
+        multiple: the window height is a multiple of this value
+
+    Returns:
+        window height, in pixels. It is never smaller than overlap + multiple,
+        even if the budget is not met.
+    """
+    h = multiple
+    while estimate_memory(h + multiple, width) <= max_memory:
+        h += multiple
+    if estimate_memory(h, width) > max_memory:
+        logger.warning('a window of width %d does not fit in %.0f MB', width, max_memory)
+    return max(h, overlap + multiple)
+
+
+def make_batches(shapes: list, max_batch_size: int, max_memory: float = None) -> list:
+    """
+    Group pairs with the same padded shape into batches.
+
+    Args:
+        shapes: list of (h, w) shapes of the pairs
+        max_batch_size: maximal number of pairs per batch
+        max_memory (optional): memory budget of a batch, in MB
+
+    Returns:
+        list of batches, each batch being a list of indices in shapes
+    """
+    buckets = {}
+    for k, (h, w) in enumerate(shapes):
+        buckets.setdefault((padded_size(h), padded_size(w)), []).append(k)
+
+    batches = []
+    for (h, w), indices in sorted(buckets.items()):
+        batch = []
+        for k in indices:
+            full = len(batch) == max_batch_size
+            if max_memory is not None:
+                full |= estimate_memory(h, w, len(batch) + 1) > max_memory
+            if batch and full:
+                batches.append(batch)
+                batch = []
+            batch.append(k)
+        batches.append(batch)
+    return batches
+
+
+# engines already loaded in this process, keyed by (stereo_ckpt, mono_ckpt, device)
+_ENGINES: dict = {}
+
+
+def get_engine(stereo_ckpt: str, mono_ckpt: str, device: torch.device = None) -> StereoAnywhereEngine:
+    """
+    Return the engine of the current process for the given checkpoints,
+    loading the models on the first call only.
+    """
+    if device is None:
+        device = torch.device("cuda" if torch.cuda.is_available() else "cpu")
+    key = (os.path.abspath(stereo_ckpt), os.path.abspath(mono_ckpt), str(device))
+    if key not in _ENGINES:
+        _ENGINES[key] = StereoAnywhereEngine(stereo_ckpt, mono_ckpt, device)
+    return _ENGINES[key]
+
+
+def release_engines() -> None:
+    """
+    Drop the engines loaded in this process and free the device memory.
+    """
+    _ENGINES.clear()
+    if torch.cuda.is_available():
+        torch.cuda.empty_cache()
+
+
+@torch.no_grad()
+def run(
+    left_path, right_path, mono_ckpt, stereo_ckpt, disparity_path, mask_path,
+    persistent=False, max_memory=None, window_overlap=64, disp_range=None,
+    flow_tol=None,
+):
+    """
+    Compute the disparity map and the rejection mask of a rectified pair.
+
+    Args:
+        left_path, right_path: paths to the rectified images
+        mono_ckpt, stereo_ckpt: paths to the Depth-Anything-v2 and
+            StereoAnywhere checkpoints
+        disparity_path, mask_path: paths to the output disparity and mask
+        persistent (bool): if True the models are kept loaded in the current
+            process and reused by the next calls
+        max_memory (optional): peak memory target, in MB. If set, the pair is
+            processed by overlapping horizontal windows fitting in this budget
+        window_overlap: number of rows shared by consecutive windows
+        disp_range (optional): (disp_min, disp_max) tuple, used to shift the
+            secondary image, adapt the number of iterations and reject the
+            disparities outside of the range
+        flow_tol (optional): early exit threshold of the GRU iterations
+    """
+    left_image = read_image(left_path)
+    right_image = read_image(right_path)
+
+    if persistent:
+        engine = get_engine(stereo_ckpt, mono_ckpt)
+    else:
+        engine = StereoAnywhereEngine(stereo_ckpt, mono_ckpt)
+    if max_memory is None:
+        disparity = engine.infer(left_image, right_image,
+                                 disp_range=disp_range, flow_tol=flow_tol)
+    else:
+        disparity = engine.infer_windowed(left_image, right_image, max_memory,
+                                          overlap=window_overlap,
+                                          disp_range=disp_range, flow_tol=flow_tol)
 
     # Save disparity
     iio.write(disparity_path, disparity)
@@ -156,6 +515,84 @@ def run(
     create_rejection_mask(disparity_path, left_path, right_path, mask_path)
 
 
+@torch.no_grad()
+def run_batch(pairs, mono_ckpt, stereo_ckpt, max_batch_size=4, max_memory=None,
+              persistent=False, disp_ranges=None, flow_tol=None):
+    """
+    Compute the disparity maps and rejection masks of several rectified pairs,
+    processing pairs of similar sizes together.
+
+    If the inference of a batch fails, its pairs are processed one by one, so
+    that a bad pair doesn't prevent the others from being processed.
+
+    Args:
+        pairs: list of (left_path, right_path, disparity_path, mask_path)
+        mono_ckpt, stereo_ckpt: paths to the Depth-Anything-v2 and
+            StereoAnywhere checkpoints
+        max_batch_size: maximal number of pairs per forward pass
+        max_memory (optional): memory budget of a forward pass, in MB
+        persistent (bool): if True the models are kept loaded in the current
+            process and reused by the next calls
+        disp_ranges (optional): list of (disp_min, disp_max) tuples, one per
+            pair (see run)
+        flow_tol (optional): early exit threshold of the GRU iterations
+
+    Returns:
+        list of the indices of the pairs that have failed
+    """
+    if disp_ranges is None:
+        disp_ranges = [None] * len(pairs)
+
+    failed = []
+    shapes = {}
+    for k, (left_path, right_path, _, _) in enumerate(pairs):
+        try:
+            with rasterio.open(left_path) as f, rasterio.open(right_path) as g:
+                shapes[k] = (max(f.height, g.height), max(f.width, g.width))
+        except Exception:
+            logger.exception('cannot read the rectified pair %s, %s:', left_path, right_path)
+            failed.append(k)
+
+    if persistent:
+        engine = get_engine(stereo_ckpt, mono_ckpt)
+    else:
+        engine = StereoAnywhereEngine(stereo_ckpt, mono_ckpt)
+
+    def process(batch):
+        left_images = [read_image(pairs[k][0]) for k in batch]
+        right_images = [read_image(pairs[k][1]) for k in batch]
+        disparities = engine.infer_batch(left_images, right_images,
+                                         disp_ranges=[disp_ranges[k] for k in batch],
+                                         flow_tol=flow_tol)
+
+        for k, disparity in zip(batch, disparities):
+            left_path, right_path, disparity_path, mask_path = pairs[k]
+            iio.write(disparity_path, disparity)
+            create_rejection_mask(disparity_path, left_path, right_path, mask_path)
+
+    indices = list(shapes)
+    for batch in make_batches(list(shapes.values()), max_batch_size, max_memory):
+        batch = [indices[j] for j in batch]
+        try:
+            process(batch)
+            continue
+        except Exception:
+            if len(batch) > 1:
+                logger.exception('batched inference of %d pairs has failed, '
+                                 'processing them one by one:', len(batch))
+            else:
+                logger.exception('inference has failed on %s:', pairs[batch[0]][0])
+                failed += batch
+                continue
+        for k in batch:
+            try:
+                process([k])
+            except Exception:
+                logger.exception('inference has failed on %s:', pairs[k][0])
+                failed.append(k)
+    return sorted(failed)
+
+
 def create_rejection_mask(disp_path, im1_path, im2_path, mask_path):
     im1 = common.rio_read_as_array_with_nans(im1_path)
     im2 = common.rio_read_as_array_with_nans(im2_path)
@@ -92,7 +92,9 @@ class StereoAnywhere(nn.Module):
                 for param in layer.parameters():
                     param.requires_grad = False
             
-    def forward(self, image2, image3, mde2, mde3, iters=12, test_mode=False):
+    def forward(self, image2, image3, mde2, mde3, iters=12, test_mode=False, flow_tol=None):
+        # flow_tol (test_mode only): stop the GRU iterations as soon as the mean absolute
+        # flow update (in pixels at 1/2**n_downsample resolution) is below this value
         B, C, H, W = image2.shape
         W_lowres = W // (2 ** self.args.n_downsample)
 
@@ -282,8 +284,10 @@ class StereoAnywhere(nn.Module):
             _flow_up = coords1 - coords0
             _flow_up = _flow_up[:,:1]
 
+            converged = test_mode and flow_tol is not None and delta_flow[:, :1].abs().mean().item() < flow_tol
+
             # We do not need to upsample or output intermediate results in test_mode
-            if test_mode and itr < iters-1:
+            if test_mode and itr < iters-1 and not converged:
                 continue
 
             # Upsample flow and confidence to full resolution
@@ -293,6 +297,9 @@ class StereoAnywhere(nn.Module):
             flow_predictions.append(flow_up)
             conf_predicitons.append(None)
 
+            if converged:
+                break
+
         if test_mode:
             return flow_up, None
         
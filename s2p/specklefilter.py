@@ -6,10 +6,120 @@ Copyright (C) 2017-2018, Gabriele Facciolo <facciolo@cmla.ens-cachan.fr>
 
 import numpy as np
 
-from numba import jit
-
-
-def specklefilter(off, area=25, th=0):
+import numba
+from numba import jit, prange
+
+
+@jit(nopython=True, cache=True)
+def find(i, idx):     # finds the root of a dsf
+    r = i
+    while idx.flat[r] != r:
+        r = idx.flat[r]
+    while idx.flat[i] != r:  # path compression
+        n = idx.flat[i]
+        idx.flat[i] = r
+        i = n
+    return r
+
+
+@jit(nopython=True, cache=True)
+def root(i, idx):     # finds the root of a dsf, without modifying it
+    while idx.flat[i] != i:
+        i = idx.flat[i]
+    return i
+
+
+@jit(nopython=True, cache=True)
+def dsf_rows(D, idx, th, j0, j1):    # builds the dsf of rows j0 to j1 - 1
+    w = D.shape[1]
+    for j in range(j0, j1):
+        for i in range(w):
+            idx[j,i] = j*w + i
+
+    for j in range(j0, j1):
+        for i in range(w):
+            if(i>0):
+                if( abs(D[j,i] - D[j,i-1])<= th ):
+                    a = find(idx[j,i],idx)
+                    b = find(idx[j,i-1],idx)
+                    idx[j,i] = idx[j,i-1]
+                    idx.flat[a] = b
+
+            if(j>j0):
+                if( abs(D[j,i] - D[j-1,i])<= th ):
+                    a = find(idx[j,i],idx)
+                    b = find(idx[j-1,i],idx)
+                    idx[j,i] = idx[j-1,i]
+                    idx.flat[a] = b
+
+
+@jit(nopython=True, cache=True)
+def dsf(D, th=0):    # builds a dsf
+    h,w = D.shape[0],D.shape[1]
+    idx = np.zeros((h,w),dtype=np.int64)
+    dsf_rows(D, idx, th, 0, h)
+    return idx
+
+
+@jit(nopython=True, cache=True, parallel=True)
+def dsf_parallel(D, th=0, nb_strips=1):    # builds a dsf, by strips of rows
+    h,w = D.shape[0],D.shape[1]
+    idx = np.zeros((h,w),dtype=np.int64)
+    nb_strips = max(1, min(nb_strips, h))
+    bounds = np.linspace(0, h, nb_strips + 1).astype(np.int64)
+
+    # first pass: label each strip independently. The strips don't share
+    # any node of the dsf, so they can be processed concurrently
+    for s in prange(nb_strips):
+        dsf_rows(D, idx, th, bounds[s], bounds[s+1])
+
+    # second pass: merge the components across the strips boundaries
+    for s in range(1, nb_strips):
+        j = bounds[s]
+        for i in range(w):
+            if( abs(D[j,i] - D[j-1,i])<= th ):
+                a = find(idx[j,i],idx)
+                b = find(idx[j-1,i],idx)
+                if a != b:
+                    idx.flat[a] = b
+
+    return idx
+
+
+@jit(nopython=True, cache=True)
+def labels(idx):
+    h,w=idx.shape[0],idx.shape[1]
+    lab = idx*0
+
+    for i in range(h*w):
+        ind = find(i,idx)
+        lab.flat[i] = ind
+    return lab
+
+
+@jit(nopython=True, cache=True, parallel=True)
+def labels_parallel(idx):
+    h,w=idx.shape[0],idx.shape[1]
+    lab = idx*0
+
+    for i in prange(h*w):
+        lab.flat[i] = root(np.int64(i),idx)
+    return lab
+
+
+@jit(nopython=True, cache=True)
+def areas(lab):
+    h,w=lab.shape[0],lab.shape[1]
+    area = np.zeros((h,w),dtype=np.int64)
+    LL = np.zeros((h,w),dtype=np.int64)
+    for i in range(w*h):
+        area.flat[lab.flat[i]] += 1
+    for i in range(w*h):
+        LL.flat[i] = area.flat[lab.flat[i]]
+    return LL
+
+
+def specklefilter(off, area=25, th=0, parallel=False):
     '''
     speckle filter of dispairt map off
 
@@ -17,72 +127,22 @@ def specklefilter(off, area=25, th=0):
         off:  numpy array with the input disparity map
         area: the surface (in pixels) of the smallest allowed connected component of disparity
         th:   similarity threshold used to determin if two neighboring pixels have the same value
+        parallel: if True, label the connected components with a two-pass
+            algorithm that runs on all the numba threads. Worth it on large rasters
 
     Returns:
        numpy array with the filtered disparity map, removed points are set to nan
     '''
-
-    @jit(nopython=True)
-    def find(i,idx):     # finds the root of a dsf
-        if idx.flat[i] == i:
-            return i
-        else:
-            ret = find(idx.flat[i],idx)
-            idx.flat[i] = ret    # path compression is useles with idx passed by value
-            return ret
-
-    @jit(nopython=True)
-    def dsf(D, th=0):    # builds a dsf
-        h,w = D.shape[0],D.shape[1]
-        idx = np.zeros((h,w),dtype=np.int64)
-        for j in range(h):
-            for i in range(w):
-                idx[j,i] = j*w + i
-
-        for j in range(h):
-            for i in range(w):
-                if(i>0):
-                    if( abs(D[j,i] - D[j,i-1])<= th ):
-                        a = find(idx[j,i],idx)
-                        b = find(idx[j,i-1],idx)
-                        idx[j,i] = idx[j,i-1]
-                        idx.flat[a] = b
-
-                if(j>0):
-                    if( abs(D[j,i] - D[j-1,i])<= th ):
-                        a = find(idx[j,i],idx)
-                        b = find(idx[j-1,i],idx)
-                        idx[j,i] = idx[j-1,i]
-                        idx.flat[a] = b
-
-        return idx
-
-    @jit(nopython=True)
-    def labels(idx):
-        h,w=idx.shape[0],idx.shape[1]
-        lab = idx*0
-
-        for i in range(h*w):
-            ind = find(i,idx)
-            lab.flat[i] = ind
-        return lab
-
-    @jit(nopython=True)
-    def areas(lab):
-        h,w=lab.shape[0],lab.shape[1]
-        area = np.zeros((h,w),dtype=np.int64)
-        LL = np.zeros((h,w),dtype=np.int64)
-        for i in range(w*h):
-            area.flat[lab.flat[i]] += 1
-        for i in range(w*h):
-            LL.flat[i] = area.flat[lab.flat[i]]
-        return LL
-
-
-    # build the dsf
-    ind = dsf(off, th=th)
-    # extract the labels of all the regions
-    lab = labels(ind)
+    if parallel:
+        # build the dsf
+        ind = dsf_parallel(off, th=th, nb_strips=4 * numba.get_num_threads())
+        # extract the labels of all the regions
+        lab = labels_parallel(ind)
+    else:
+        # build the dsf
+        ind = dsf(off, th=th)
+        # extract the labels of all the regions
+        lab = labels(ind)
     # creat e map where all the regions are tagged with their area
     are = areas(lab)
     # filter the disparity map
@@ -91,10 +151,10 @@ def specklefilter(off, area=25, th=0):
     return filtered
 
 
-def call(inf, outf, area=25, th=0):
+def call(inf, outf, area=25, th=0, parallel=False):
     import iio
     im=iio.read(inf).squeeze()
-    out = specklefilter(im, area, th)
+    out = specklefilter(im, area, th, parallel)
     iio.write(outf, out)
 
 
@@ -0,0 +1,337 @@
+"""
+performance telemetry of the tilewise calls and of the pipeline steps
+
+Each tilewise call, and each step of s2p.main, appends a JSON line to
+out_dir/telemetry.jsonl, with:
+    kind: "task" (tilewise call) or "step"
+    name: name of the function, or of the step
+    tile, pair: label of the tile and index of the pair (tasks only)
+    pid, start: process id and start time (seconds since the epoch)
+    wall, cpu_user, cpu_system: wall and CPU times of the process, in seconds
+    children_cpu: CPU time of the subprocesses that have finished
+    subprocess_time: wall time spent in common.run
+    peak_rss: peak resident set size of the process during the call, in bytes
+        (since the process started if it can't be reset)
+    read_bytes, write_bytes: bytes read and written by the process system
+        calls (files and pipes)
+    status: "ok" or "error"
+Each line is written with a single append, so that the workers can share the
+file.
+
+The counters are those of the process running the call. The step records are
+written by the main process: their CPU times, peak RSS and I/O exclude the
+work of the pool workers, and their children_cpu only counts the workers that
+have exited during the step, i.e. none with cfg['persistent_pool']. The
+resources used by a step are best read from the task records of its time
+window, as in summarize.
+
+The report command summarizes such a file:
+    s2p-telemetry out_dir/telemetry.jsonl
+"""
+
+import os
+import sys
+import json
+import logging
+import time
+import resource
+import argparse
+import contextlib
+from collections import defaultdict
+
+import numpy as np
+
+logger = logging.getLogger(__name__)
+
+
+# wall time spent in subprocesses by the current process, see common.run
+subprocess_time = 0.0
+
+# name, start time and initial counters of the current step of the pipeline
+_step = None
+
+
+def path(cfg):
+    """
+    Path to the telemetry file of a run, or None if the telemetry is disabled.
+    """
+    return os.path.join(cfg['out_dir'], 'telemetry.jsonl') if cfg.get('telemetry') else None
+
+
+def add_subprocess_time(seconds):
+    global subprocess_time
+    subprocess_time += seconds
+
+
+def io_counters():
+    """
+    Number of bytes read and written by the current process system calls.
+    """
+    try:
+        with open('/proc/self/io') as f:
+            io = dict(line.split(': ') for line in f.read().splitlines())
+        return int(io['rchar']), int(io['wchar'])
+    except (OSError, KeyError, ValueError):
+        return 0, 0
+
+
+def reset_peak_rss():
+    """
+    Reset the peak resident set size of the current process (Linux only).
+
+    Returns:
+        True if it has been reset
+    """
+    try:
+        with open('/proc/self/clear_refs', 'w') as f:
+            f.write('5')
+        return True
+    except OSError:
+        return False
+
+
+def peak_rss():
+    """
+    Peak resident set size of the current process, in bytes.
+    """
+    try:
+        with open('/proc/self/status') as f:
+            for line in f:
+                if line.startswith('VmHWM:'):
+                    return int(line.split()[1]) * 1024
+    except OSError:
+        pass
+    # kilobytes on Linux, bytes on macOS
+    rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return rss if sys.platform == 'darwin' else rss * 1024
+
+
+def counters():
+    """
+    Current wall time, CPU times, I/O and subprocess counters of the process.
+    """
+    usage = resource.getrusage(resource.RUSAGE_SELF)
+    children = resource.getrusage(resource.RUSAGE_CHILDREN)
+    read, written = io_counters()
+    return {'wall': time.perf_counter(),
+            'cpu_user': usage.ru_utime,
+            'cpu_system': usage.ru_stime,
+            'children_cpu': children.ru_utime + children.ru_stime,
+            'subprocess_time': subprocess_time,
+            'read_bytes': read,
+            'write_bytes': written}
+
+
+def write_record(telemetry_path, record):
+    """
+    Append a record to a telemetry file, with a single write.
+    """
+    line = (json.dumps(record) + '\n').encode()
+    try:
+        fd = os.open(telemetry_path, os.O_WRONLY | os.O_CREAT | os.O_APPEND, 0o644)
+        try:
+            os.write(fd, line)
+        finally:
+            os.close(fd)
+    except OSError as e:
+        logger.warning('could not write telemetry record: %s', e)
+
+
+def make_record(kind, name, start, initial, status='ok', **fields):
+    """
+    Telemetry record of a call, from the counters at its start.
+    """
+    final = counters()
+    record = {'kind': kind, 'name': name}
+    record.update(fields)
+    record.update(pid=os.getpid(), start=start)
+    record.update({k: final[k] - initial[k] for k in final})
+    record.update(peak_rss=peak_rss(), status=status)
+    return record
+
+
+def split_tile_label(tile_label):
+    """
+    Split a tile label of parallel.tilewise_log_and_label into the tile label
+    and the pair index (or None).
+    """
+    if tile_label is None:
+        return None, None
+    head, tail = os.path.split(tile_label.rstrip('/'))
+    if tail.startswith('pair_'):
+        return head, int(tail[5:])
+    return tile_label, None
+
+
+@contextlib.contextmanager
+def measure(telemetry_path, name, tile_label=None):
+    """
+    Context manager recording a tilewise call in a telemetry file.
+
+    Args:
+        telemetry_path (str): path to the telemetry file, or None to record
+            nothing
+        name (str): name of the called function
+        tile_label (str): label of the tile (and pair) of the call
+    """
+    if telemetry_path is None:
+        yield
+        return
+
+    tile, pair = split_tile_label(tile_label)
+    reset_peak_rss()
+    start, initial = time.time(), counters()
+    status = 'error'
+    try:
+        yield
+        status = 'ok'
+    finally:
+        write_record(telemetry_path, make_record('task', name, start, initial, status,
+                                                 tile=tile, pair=pair))
+
+
+def step(cfg, name=None):
+    """
+    Record the end of the current step of the pipeline, if any, and start
+    another one.
+
+    Args:
+        cfg (dict): s2p config dictionary
+        name (str): name of the new step, or None to only end the current one
+    """
+    global _step
+    telemetry_path = path(cfg)
+    if telemetry_path is None:
+        return
+    if _step is not None:
+        write_record(telemetry_path, make_record('step', *_step))
+    _step = None
+    if name is not None:
+        reset_peak_rss()
+        _step = (name, time.time(), counters())
+
+
+def read_records(telemetry_path):
+    """
+    Read the records of a telemetry file, ignoring truncated lines.
+    """
+    records = []
+    with open(telemetry_path) as f:
+        for line in f:
+            try:
+                records.append(json.loads(line))
+            except ValueError:
+                continue
+    return records
+
+
+def summarize(records, top=10):
+    """
+    Aggregate telemetry records.
+
+    Args:
+        records (list): telemetry records
+        top (int): number of slowest tiles to report
+
+    Returns:
+        dictionary with:
+            tasks: per task name, number of calls and errors, wall time
+                percentiles (50, 90, 99, max) and totals of the other counters
+            slowest_tiles: list of (tile, total wall time, wall time per task
+                name) tuples
+            steps: per step, its wall time, the number of tasks run during the
+                step, their total wall time, and its critical path: the tile
+                whose tasks took the longest total time during the step
+    """
+    tasks = [r for r in records if r['kind'] == 'task']
+    steps = [r for r in records if r['kind'] == 'step']
+
+    by_name = defaultdict(list)
+    for r in tasks:
+        by_name[r['name']].append(r)
+    task_summary = {}
+    for name, rs in by_name.items():
+        wall = np.array([r['wall'] for r in rs])
+        p50, p90, p99 = np.percentile(wall, [50, 90, 99])
+        task_summary[name] = {
+            'count': len(rs),
+            'errors': sum(r['status'] != 'ok' for r in rs),
+            'wall_total': float(wall.sum()),
+            'wall_p50': float(p50), 'wall_p90': float(p90),
+            'wall_p99': float(p99), 'wall_max': float(wall.max()),
+            'cpu_total': sum(r['cpu_user'] + r['cpu_system'] + r['children_cpu'] for r in rs),
+            'subprocess_time': sum(r['subprocess_time'] for r in rs),
+            'read_bytes': sum(r['read_bytes'] for r in rs),
+            'write_bytes': sum(r['write_bytes'] for r in rs),
+            'peak_rss_max': max(r['peak_rss'] for r in rs)}
+
+    per_tile = defaultdict(lambda: defaultdict(float))
+    for r in tasks:
+        per_tile[r['tile']][r['name']] += r['wall']
+    slowest = sorted(((tile, sum(d.values()), dict(d)) for tile, d in per_tile.items()),
+                     key=lambda x: -x[1])[:top]
+
+    step_summary = []
+    for s in steps:
+        end = s['start'] + s['wall']
+        inside = [r for r in tasks if s['start'] <= r['start'] < end]
+        chains = defaultdict(float)
+        for r in inside:
+            chains[r['tile']] += r['wall']
+        critical = max(chains.items(), key=lambda x: x[1]) if chains else (None, 0.0)
+        step_summary.append({'name': s['name'], 'wall': s['wall'],
+                             'tasks': len(inside),
+                             'tasks_wall': sum(r['wall'] for r in inside),
+                             'critical_tile': critical[0],
+                             'critical_path': critical[1]})
+
+    return {'tasks': task_summary, 'slowest_tiles': slowest, 'steps': step_summary}
+
+
+def report(records, top=10):
+    """
+    Human readable summary of telemetry records, see summarize.
+    """
+    s = summarize(records, top)
+    lines = ['steps:',
+             '  {:<28} {:>9} {:>7} {:>11} {:>11}  {}'.format(
+                 'name', 'wall', 'tasks', 'tasks wall', 'crit. path', 'critical tile')]
+    for st in s['steps']:
+        lines.append('  {:<28} {:>9.1f} {:>7} {:>11.1f} {:>11.1f}  {}'.format(
+            st['name'], st['wall'], st['tasks'], st['tasks_wall'],
+            st['critical_path'], st['critical_tile'] or ''))
+
+    lines += ['', 'tasks (wall times in seconds, sizes in MiB):',
+              '  {:<28} {:>6} {:>4} {:>8} {:>8} {:>8} {:>8} {:>9} {:>9} {:>8} {:>9} {:>9}'.format(
+                  'name', 'calls', 'err', 'p50', 'p90', 'p99', 'max', 'total',
+                  'cpu', 'subproc', 'read', 'written')]
+    for name, t in sorted(s['tasks'].items(), key=lambda x: -x[1]['wall_total']):
+        lines.append('  {:<28} {:>6} {:>4} {:>8.2f} {:>8.2f} {:>8.2f} {:>8.2f} {:>9.1f} {:>9.1f} {:>8.1f} {:>9.1f} {:>9.1f}'.format(
+            name, t['count'], t['errors'], t['wall_p50'], t['wall_p90'],
+            t['wall_p99'], t['wall_max'], t['wall_total'], t['cpu_total'],
+            t['subprocess_time'], t['read_bytes'] / 2**20, t['write_bytes'] / 2**20))
+        lines[-1] += '  peak rss {:.0f} MiB'.format(t['peak_rss_max'] / 2**20)
+
+    lines += ['', 'slowest tiles:']
+    for tile, wall, names in s['slowest_tiles']:
+        detail = ', '.join('{} {:.1f}'.format(n, w)
+                           for n, w in sorted(names.items(), key=lambda x: -x[1]))
+        lines.append('  {:>9.1f}  {}  ({})'.format(wall, tile, detail))
+    return '\n'.join(lines)
+
+
+def main():
+    """
+    Command line interface of the telemetry report.
+    """
+    parser = argparse.ArgumentParser(description='S2P: telemetry report')
+    parser.add_argument('telemetry', metavar='telemetry.jsonl',
+                        help='path to the telemetry file of a run')
+    parser.add_argument('--top', type=int, default=10,
+                        help='number of slowest tiles to list')
+    args = parser.parse_args()
+    print(report(read_records(args.telemetry), top=args.top))
+
+
+if __name__ == '__main__':
+    main()
@@ -4,6 +4,7 @@
 
 import os
 import ctypes
+import weakref
 from ctypes import c_int, c_float, c_double, byref, POINTER
 from numpy.ctypeslib import ndpointer
 import numpy as np
@@ -12,7 +13,10 @@ import rasterio
 
 from s2p import common
 from s2p import ply
+from s2p import compact_cloud
+from s2p import rasterization
 from s2p import geographiclib
+from s2p import rpc_utils
 
 here = os.path.dirname(os.path.abspath(__file__))
 lib_path = os.path.join(os.path.dirname(here), 'lib', 'disp_to_h.so')
@@ -58,31 +62,100 @@ class RPCStruct(ctypes.Structure):
         self.iscale[1] = rpc.lat_scale
         self.iscale[2] = rpc.alt_scale
 
-        for i in range(20):
-            self.inumx[i] = rpc.col_num[i]
-            self.idenx[i] = rpc.col_den[i]
-            self.inumy[i] = rpc.row_num[i]
-            self.ideny[i] = rpc.row_den[i]
+        self.inumx[:] = rpc.col_num
+        self.idenx[:] = rpc.col_den
+        self.inumy[:] = rpc.row_num
+        self.ideny[:] = rpc.row_den
 
         if hasattr(rpc, 'lat_num'):
-            for i in range(20):
-                self.numx[i] = rpc.lon_num[i]
-                self.denx[i] = rpc.lon_den[i]
-                self.numy[i] = rpc.lat_num[i]
-                self.deny[i] = rpc.lat_den[i]
+            self.numx[:] = rpc.lon_num
+            self.denx[:] = rpc.lon_den
+            self.numy[:] = rpc.lat_num
+            self.deny[:] = rpc.lat_den
         else:
-            for i in range(20):
-                self.numx[i] = np.nan
-                self.denx[i] = np.nan
-                self.numy[i] = np.nan
-                self.deny[i] = np.nan
+            self.numx[:] = [np.nan] * 20
+            self.denx[:] = [np.nan] * 20
+            self.numy[:] = [np.nan] * 20
+            self.deny[:] = [np.nan] * 20
 
 	# initialization factor for iterative localization
         self.delta = delta
 
 
+# RPCStruct objects already built in this process, keyed by the id of their
+# rpc model and dropped when the model is garbage collected. The models can't
+# be used as keys: they define __eq__ without __hash__
+rpc_structs = {}
+
+
+def rpc_struct(rpc, delta=1.0):
+    """
+    Return the RPCStruct of an rpc model, built once per process and model.
+
+    Args:
+        rpc (rpcm.RPCModel): rpc model
+        delta (float): initialization factor for iterative localization
+
+    Returns:
+        RPCStruct object. It must not be modified.
+    """
+    key = id(rpc)
+    if key not in rpc_structs:
+        rpc_structs[key] = {}
+        weakref.finalize(rpc, rpc_structs.pop, key, None)
+    structs = rpc_structs[key]
+    if delta not in structs:
+        structs[delta] = RPCStruct(rpc, delta)
+    return structs[delta]
+
+
+# declare the argument types of the disp_to_h.so functions, once for all
+lib.disp_to_lonlatalt.argtypes = (ndpointer(dtype=c_double, ndim=3, flags='C_CONTIGUOUS'),
+                                  ndpointer(dtype=c_float, ndim=2, flags='C_CONTIGUOUS'),
+                                  ndpointer(dtype=c_float, ndim=2, flags='C_CONTIGUOUS'),
+                                  ndpointer(dtype=c_float, ndim=2, flags='C_CONTIGUOUS'),
+                                  ndpointer(dtype=c_float, ndim=2, flags='C_CONTIGUOUS'),
+                                  c_int, c_int,
+                                  ndpointer(dtype=c_float, ndim=2, flags='C_CONTIGUOUS'),
+                                  c_int, c_int,
+                                  ndpointer(dtype=c_double, shape=(9,)),
+                                  ndpointer(dtype=c_double, shape=(9,)),
+                                  POINTER(RPCStruct), POINTER(RPCStruct),
+                                  ndpointer(dtype=c_float, shape=(4,)),
+                                  c_int)
+
+lib.stereo_corresp_to_lonlatalt.argtypes = (ndpointer(dtype=c_double, ndim=2, flags='C_CONTIGUOUS'),
+                                            ndpointer(dtype=c_float, ndim=2, flags='C_CONTIGUOUS'),
+                                            ndpointer(dtype=c_float, ndim=2, flags='C_CONTIGUOUS'),
+                                            ndpointer(dtype=c_float, ndim=2, flags='C_CONTIGUOUS'),
+                                            c_int, POINTER(RPCStruct), POINTER(RPCStruct))
+
+lib.remove_isolated_3d_points.argtypes = (ndpointer(dtype=c_double, ndim=3, flags='C_CONTIGUOUS'),
+                                          c_int, c_int, c_float, c_int, c_int, c_int,
+                                          c_int)
+
+
+def lonlatalt_to_crs(lonlatalt, out_crs=None):
+    """
+    Convert in place an array of (lon, lat, alt) points to the output CRS.
+    Only the points with finite coordinates are converted.
+
+    Args:
+        lonlatalt (array): C-contiguous float64 array of shape (..., 3)
+        out_crs (pyproj.crs.CRS): object defining the desired coordinate
+            reference system
+
+    Returns:
+        lonlatalt, with its finite points expressed in out_crs
+    """
+    in_crs = geographiclib.pyproj_crs("epsg:4979")
+    if not out_crs or out_crs == in_crs:
+        return lonlatalt
+    return geographiclib.pyproj_transform_finite(lonlatalt, in_crs, out_crs)
+
+
 def disp_to_xyz(rpc1, rpc2, H1, H2, disp, mask_rect, img_bbx, mask_orig, A=None,
-                out_crs=None):
+                out_crs=None, nb_threads=1):
     """
     Compute a 3D coordinates map from a disparity map, using RPC camera models.
 
@@ -98,6 +171,8 @@ def disp_to_xyz(rpc1, rpc2, H1, H2, disp, mask_rect, img_bbx, mask_orig, A=None,
         A (array): 3x3 array with the pointing correction matrix for im2
         out_crs (pyproj.crs.CRS): object defining the desired coordinate
             reference system for the output xyz map
+        nb_threads (int): number of threads used by the native code, on
+            blocks of rows. The GIL is released during the call
 
     Returns:
         xyz: array of shape (h, w, 3) where each pixel contains the 3D
@@ -106,62 +181,35 @@ def disp_to_xyz(rpc1, rpc2, H1, H2, disp, mask_rect, img_bbx, mask_orig, A=None,
         err: array of shape (h, w) where each pixel contains the triangulation
             error
     """
-    # copy rpc coefficients to an RPCStruct object
-    rpc1_c_struct = RPCStruct(rpc1)
-    rpc2_c_struct = RPCStruct(rpc2)
+    # get the cached copy of the rpc coefficients as RPCStruct objects
+    rpc1_c_struct = rpc_struct(rpc1)
+    rpc2_c_struct = rpc_struct(rpc2)
 
     if A is not None:  # apply pointing correction
         H2 = np.dot(H2, np.linalg.inv(A))
 
-    # define the argument types of the disp_to_lonlatalt function from disp_to_h.so
+    # call the disp_to_lonlatalt function from disp_to_h.so
     h, w = disp.shape
     hh, ww = mask_orig.shape
-    lib.disp_to_lonlatalt.argtypes = (ndpointer(dtype=c_double, shape=(h, w, 3)),
-                                      ndpointer(dtype=c_float, shape=(h, w)),
-                                      ndpointer(dtype=c_float, shape=(h, w)),
-                                      ndpointer(dtype=c_float, shape=(h, w)),
-                                      ndpointer(dtype=c_float, shape=(h, w)),
-                                      c_int, c_int,
-                                      ndpointer(dtype=c_float, shape=(hh, ww)),
-                                      c_int, c_int,
-                                      ndpointer(dtype=c_double, shape=(9,)),
-                                      ndpointer(dtype=c_double, shape=(9,)),
-                                      POINTER(RPCStruct), POINTER(RPCStruct),
-                                      ndpointer(dtype=c_float, shape=(4,)))
-
-
-    # call the disp_to_lonlatalt function from disp_to_h.so
     lonlatalt = np.zeros((h, w, 3), dtype='float64')
     err = np.zeros((h, w), dtype='float32')
-    dispx = disp.astype('float32')
+    dispx = np.ascontiguousarray(disp, dtype='float32')
     dispy = np.zeros((h, w), dtype='float32')
-    msk_rect = mask_rect.astype('float32')
-    msk_orig = mask_orig.astype('float32')
+    msk_rect = np.ascontiguousarray(mask_rect, dtype='float32')
+    msk_orig = np.ascontiguousarray(mask_orig, dtype='float32')
     lib.disp_to_lonlatalt(lonlatalt, err, dispx, dispy, msk_rect, w, h,
                           msk_orig, ww, hh,
-                          H1.flatten(), H2.flatten(),
+                          np.asarray(H1, dtype='float64').flatten(),
+                          np.asarray(H2, dtype='float64').flatten(),
                           byref(rpc1_c_struct), byref(rpc2_c_struct),
-                          np.asarray(img_bbx, dtype='float32'))
+                          np.asarray(img_bbx, dtype='float32'), nb_threads)
 
     # output CRS conversion
-    in_crs = geographiclib.pyproj_crs("epsg:4979")
-
-    if out_crs and out_crs != in_crs:
-
-        # reshape the lonlatlat array into a 3-column 2D-array
-        lonlatalt = lonlatalt.reshape(-1, 3)
-
-        x, y, z = geographiclib.pyproj_transform(lonlatalt[:, 0], lonlatalt[:, 1],
-                                                 in_crs, out_crs, lonlatalt[:, 2])
-
-        xyz_array = np.column_stack((x, y, z)).reshape(h, w, 3).astype(np.float64)
-    else:
-        xyz_array = lonlatalt
-
-    return xyz_array, err
+    return lonlatalt_to_crs(lonlatalt, out_crs), err
 
 
-def height_map_to_xyz(heights, rpc, off_x=0, off_y=0, out_crs=None):
+def height_map_to_xyz(heights, rpc, off_x=0, off_y=0, out_crs=None,
+                      max_localization_error=None):
     """
     Compute a 3D coordinates map from a height map, using an RPC camera model.
 
@@ -174,6 +222,9 @@ def height_map_to_xyz(heights, rpc, off_x=0, off_y=0, out_crs=None):
             size image
         out_crs (pyproj.crs.CRS): object defining the desired coordinate
             reference system for the output xyz map
+        max_localization_error (float, optional): if given, the pixels are
+            localized by interpolation on a rpc_utils.LocalizationGrid with
+            this maximal error (in meters) instead of the exact RPC model
 
     Returns:
         xyz: array of shape (h, w, 3) where each pixel contains the 3D
@@ -198,22 +249,16 @@ def height_map_to_xyz(heights, rpc, off_x=0, off_y=0, out_crs=None):
     rows = rows + off_y
 
     # localize pixels
-    lons = np.empty_like(heights, dtype=np.float64)
-    lats = np.empty_like(heights, dtype=np.float64)
-    lons[non_nan_ind], lats[non_nan_ind] = rpc.localization(cols, rows, alts)
+    if max_localization_error is not None and alts.size:
+        rpc = rpc_utils.LocalizationGrid(rpc, off_x, off_y, w - 1, h - 1,
+                                         alts.min(), alts.max(),
+                                         max_error=max_localization_error)
+    xyz_array = np.full((h * w, 3), np.nan)
+    xyz_array[non_nan_ind, 0], xyz_array[non_nan_ind, 1] = rpc.localization(cols, rows, alts)
+    xyz_array[non_nan_ind, 2] = alts
 
     # output CRS conversion
-    in_crs = geographiclib.pyproj_crs("epsg:4979")
-
-    if out_crs and out_crs != in_crs:
-        x, y, z = geographiclib.pyproj_transform(lons, lats,
-                                                 in_crs, out_crs, heights)
-    else:
-        x, y, z = lons, lats, heights
-
-    xyz_array = np.column_stack((x, y, z)).reshape(h, w, 3)
-
-    return xyz_array
+    return lonlatalt_to_crs(xyz_array.reshape(h, w, 3), out_crs)
 
 
 def stereo_corresp_to_xyz(rpc1, rpc2, pts1, pts2, out_crs=None):
@@ -235,43 +280,26 @@ def stereo_corresp_to_xyz(rpc1, rpc2, pts1, pts2, out_crs=None):
         err: array of shape (h, w) where each pixel contains the triangulation
             error
     """
-    # copy rpc coefficients to an RPCStruct object
-    rpc1_c_struct = RPCStruct(rpc1, delta=0.1)
-    rpc2_c_struct = RPCStruct(rpc2, delta=0.1)
+    # get the cached copy of the rpc coefficients as RPCStruct objects
+    rpc1_c_struct = rpc_struct(rpc1, delta=0.1)
+    rpc2_c_struct = rpc_struct(rpc2, delta=0.1)
 
     # get number of points to triangulate
     n = pts1.shape[0]
 
-    # define the argument types of the stereo_corresp_to_lonlatalt function from disp_to_h.so
-    lib.stereo_corresp_to_lonlatalt.argtypes = (ndpointer(dtype=c_double, shape=(n, 3)),
-                                                ndpointer(dtype=c_float, shape=(n, 1)),
-                                                ndpointer(dtype=c_float, shape=(n, 2)),
-                                                ndpointer(dtype=c_float, shape=(n, 2)),
-                                                c_int, POINTER(RPCStruct), POINTER(RPCStruct))
-
     # call the stereo_corresp_to_lonlatalt function from disp_to_h.so
     lonlatalt =  np.zeros((n, 3), dtype='float64')
     err =  np.zeros((n, 1), dtype='float32')
     lib.stereo_corresp_to_lonlatalt(lonlatalt, err,
-                                    pts1.astype('float32'), pts2.astype('float32'),
+                                    np.ascontiguousarray(pts1, dtype='float32').reshape(n, 2),
+                                    np.ascontiguousarray(pts2, dtype='float32').reshape(n, 2),
                                     n, byref(rpc1_c_struct), byref(rpc2_c_struct))
 
     # output CRS conversion
-    in_crs = geographiclib.pyproj_crs("epsg:4979")
+    return lonlatalt_to_crs(lonlatalt, out_crs), err
 
-    if out_crs and out_crs != in_crs:
 
-        x, y, z = geographiclib.pyproj_transform(lonlatalt[:, 0], lonlatalt[:, 1],
-                                                 in_crs, out_crs, lonlatalt[:, 2])
-
-        xyz_array = np.column_stack((x, y, z)).astype(np.float64)
-    else:
-        xyz_array = lonlatalt
-
-    return xyz_array, err
-
-
-def remove_isolated_3d_points(xyz, r, p, n, q=1):
+def remove_isolated_3d_points(xyz, r, p, n, q=1, nb_threads=1):
     """
     Discard (in place) isolated (groups of) points in a gridded set of 3D points
 
@@ -287,18 +315,16 @@ def remove_isolated_3d_points(xyz, r, p, n, q=1):
         p (int): filering window radius, in pixels (square window of size 2p+1)
         n (int): filtering threshold, in number of points
         q (int): 2nd filtering window radius, in pixels (square of size 2q+1)
+        nb_threads (int): number of threads used to count the neighbors
     """
     h, w, d = xyz.shape
     assert d == 3, 'expecting a 3-channels image with shape (h, w, 3)'
 
-    lib.remove_isolated_3d_points.argtypes = (
-        ndpointer(dtype=c_double, shape=(h, w, 3)),
-        c_int, c_int, c_float, c_int, c_int, c_int)
+    lib.remove_isolated_3d_points(np.ascontiguousarray(xyz), w, h, r, p, n, q,
+                                  nb_threads)
 
-    lib.remove_isolated_3d_points(np.ascontiguousarray(xyz), w, h, r, p, n, q)
 
-
-def filter_xyz(xyz, r, n, img_gsd):
+def filter_xyz(xyz, r, n, img_gsd, nb_threads=1):
     """
     Discard (in place) points that have less than n points closer than r units (ex: meters).
 
@@ -308,12 +334,14 @@ def filter_xyz(xyz, r, n, img_gsd):
         r (float): filtering radius, in the unit of the CRS (ex: meters)
         n (int): filtering threshold, in number of points
         img_gsd (float): ground sampling distance, in units of the CRS (ex: meters) / pix
+        nb_threads (int): number of threads used to count the neighbors
     """
     p = np.ceil(r / img_gsd).astype(int)
-    remove_isolated_3d_points(xyz, r, p, n)
+    remove_isolated_3d_points(xyz, r, p, n, nb_threads=nb_threads)
 
 
-def height_map(x, y, w, h, rpc1, rpc2, H1, H2, disp, mask, mask_orig, A=None):
+def height_map(x, y, w, h, rpc1, rpc2, H1, H2, disp, mask, mask_orig, A=None,
+               nb_threads=1):
     """
     Computes an altitude map, on the grid of the original reference image, from
     a disparity map given on the grid of the rectified reference image.
@@ -328,6 +356,7 @@ def height_map(x, y, w, h, rpc1, rpc2, H1, H2, disp, mask, mask_orig, A=None):
         mask_orig (array): 2D array representing the unrectified image validity
             domain
         A (array): 3x3 array with the pointing correction matrix for im2
+        nb_threads (int): number of threads used for the triangulation
 
     Returns:
         array of shape (h, w) with the height map
@@ -341,7 +370,7 @@ def height_map(x, y, w, h, rpc1, rpc2, H1, H2, disp, mask, mask_orig, A=None):
     xyz, err = disp_to_xyz(rpc1, rpc2, H1, H2, disp, mask,
                            img_bbx=(x-p, x+w+2*p, y-p, y+h+2*p),
                            mask_orig=np.pad(mask_orig, p, constant_values=1),
-                           A=A, out_crs=None)
+                           A=A, out_crs=None, nb_threads=nb_threads)
     height_map = xyz[:, :, 2].squeeze()
 
     # transfer the rectified height map onto an unrectified height map
@@ -359,17 +388,22 @@ def height_map(x, y, w, h, rpc1, rpc2, H1, H2, disp, mask, mask_orig, A=None):
     return out
 
 
-def write_to_ply(path_to_ply_file, xyz, colors=None, proj_com='', confidence=''):
+def point_lists(xyz, colors=None, confidence=''):
     """
-    Write raster of 3D point coordinates as a 3D point cloud in a .ply file
+    Flatten rasters of 3D points, colors and confidence into lists of valid
+    points.
 
     Args:
-        path_to_ply_file (str): path to a .ply file
         xyz (array): 3D array of shape (h, w, 3) where each pixel contains the
             x, y, and z  coordinates of a 3D point.
         colors (np.array): colors image, optional
-        proj_com (str): projection comment in the .ply file
         confidence (str): path to an image containig a confidence map, optional
+
+    Returns:
+        array of shape (n, 3) with the coordinates of the finite points, array
+        of shape (n, c) with their colors or None, array of shape (n,) with
+        their confidence or None, and list of the extra properties names or
+        None
     """
     # flatten the xyz array into a list and remove nan points
     xyz_list = xyz.reshape(-1, 3)
@@ -390,10 +424,98 @@ def write_to_ply(path_to_ply_file, xyz, colors=None, proj_com='', confidence='')
         extra_list  = None
         extra_names = None
 
+    return xyz_list[valid], colors_list, extra_list, extra_names
+
+
+def write_to_ply(path_to_ply_file, xyz, colors=None, proj_com='', confidence='',
+                 compact=False, compression=None):
+    """
+    Write raster of 3D point coordinates as a 3D point cloud in a .ply file
+
+    Args:
+        path_to_ply_file (str): path to a .ply file
+        xyz (array): 3D array of shape (h, w, 3) where each pixel contains the
+            x, y, and z  coordinates of a 3D point.
+        colors (np.array): colors image, optional
+        proj_com (str): projection comment in the .ply file
+        confidence (str): path to an image containig a confidence map, optional
+        compact (bool): write a compact_cloud file instead of a .ply file
+        compression (str): compression of the compact_cloud file, None or 'zstd'
+    """
+    points, colors_list, extra_list, extra_names = point_lists(xyz, colors,
+                                                               confidence)
+
+    comments = ["created by S2P", "projection: {}".format(proj_com)]
+    if compact:
+        compact_cloud.write_compact_cloud(path_to_ply_file, points,
+                                          colors=colors_list,
+                                          extra_properties=extra_list,
+                                          extra_properties_names=extra_names,
+                                          comments=comments,
+                                          compression=compression)
+        return
+
     # write the point cloud to a ply file
-    ply.write_3d_point_cloud_to_ply(path_to_ply_file, xyz_list[valid],
+    ply.write_3d_point_cloud_to_ply(path_to_ply_file, points,
                                     colors=colors_list,
                                     extra_properties=extra_list,
                                     extra_properties_names=extra_names,
-                                    comments=["created by S2P",
-                                              "projection: {}".format(proj_com)])
+                                    comments=comments, bounds=True)
+
+
+def write_to_accumulator(path, xyz, colors=None, confidence='', resolution=1,
+                         radius=0, sigma=None, crs=None, nb_threads=1):
+    """
+    Rasterize a raster of 3D point coordinates into a DSM accumulator file.
+
+    The accumulator covers the DSM of the point cloud, on a grid aligned on
+    multiples of the resolution, grown by radius pixels so that it contains
+    all the contributions of the points.
+
+    Args:
+        path (str): path to the output GeoTIFF file
+        xyz (array): 3D array of shape (h, w, 3) where each pixel contains the
+            x, y, and z  coordinates of a 3D point.
+        colors (np.array): colors image, optional
+        confidence (str): path to an image containig a confidence map, optional
+        resolution (float): resolution of the DSM, in meters
+        radius (int): radius of the footprint of each point, in pixels
+        sigma (float): standard deviation of the Gaussian weights of the
+            points, in meters. None for uniform weights
+        crs (rasterio.crs.CRS): coordinate reference system of the points
+        nb_threads (int): number of threads used by the rasterization
+
+    Returns:
+        number of rasterized points. The file is not written if it is 0
+    """
+    points, colors_list, extra_list, extra_names = point_lists(xyz, colors,
+                                                               confidence)
+    if len(points) == 0:
+        return 0
+
+    values = [points[:, 2:3]]
+    names = ['z']
+    if colors_list is not None:
+        values.append(colors_list)
+        if colors_list.shape[1] == 1:
+            names += ['gray']
+        else:
+            names += ['red', 'green', 'blue', 'ir'][:colors_list.shape[1]]
+    if extra_list is not None:
+        values.append(extra_list[:, None])
+        names += extra_names
+
+    xmin, ymin = np.min(points[:, :2], axis=0)
+    xmax, ymax = np.max(points[:, :2], axis=0)
+    roi = rasterization.grid(xmin, xmax, ymin, ymax, resolution)
+    xoff, yoff, xsize, ysize = roi
+    acc = rasterization.rasterize(points[:, 0], points[:, 1],
+                                  np.column_stack(values),
+                                  xoff - radius * resolution,
+                                  yoff + radius * resolution, resolution,
+                                  xsize + 2 * radius, ysize + 2 * radius,
+                                  radius=radius, sigma=sigma,
+                                  nb_threads=nb_threads)
+    rasterization.write_accumulator(path, acc, roi, resolution, radius, names,
+                                    crs=crs)
+    return len(points)
@@ -81,4 +81,6 @@ setup(name="s2p",
       entry_points="""
           [console_scripts]
           s2p=s2p.cli:main
+          s2p-telemetry=s2p.telemetry:main
+          s2p-cloud=s2p.compact_cloud:main
       """)
@@ -0,0 +1,92 @@
+import struct
+
+import numpy as np
+import pytest
+
+from s2p import compact_cloud, ply
+
+
+@pytest.mark.parametrize("compression", [None, "zstd"])
+def test_compact_cloud(tmp_path, compression):
+    """
+    Check that a cloud written in the compact format is read back within the
+    quantization step, with its colors and confidence, and expanded to a ply
+    file.
+    """
+    if compression == "zstd":
+        pytest.importorskip("zstandard")
+    rng = np.random.default_rng(0)
+    xyz = rng.uniform(0, 1000, size=(1000, 3)) + [300000, 7600000, 0]
+    colors = rng.integers(0, 255, size=(1000, 3), dtype=np.uint8)
+    confidence = rng.random(1000, dtype=np.float32)
+    path = str(tmp_path / "cloud.s2pc")
+    comments = ["created by S2P", "projection: CRS epsg:32740"]
+    compact_cloud.write_compact_cloud(path, xyz, colors, confidence, ["confidence"],
+                                      comments=comments, compression=compression,
+                                      chunk_size=300)
+
+    array, c = compact_cloud.read_compact_cloud(path)
+    assert c == comments
+    np.testing.assert_allclose(array[:, :3], xyz, rtol=0, atol=compact_cloud.SCALE / 2 + 1e-9)
+    np.testing.assert_array_equal(array[:, 3:6], colors)
+    np.testing.assert_array_equal(array[:, 6], confidence)
+
+    count, bmin, bmax = compact_cloud.read_bounds(path)
+    assert count == 1000
+    np.testing.assert_array_equal(bmin, xyz.min(axis=0))
+
+    # the compact file is 3 int32 + 3 uint8 + 1 float32 per point
+    assert (tmp_path / "cloud.s2pc").stat().st_size < 1000 * 19 + 2000
+
+    ply_path = str(tmp_path / "cloud.ply")
+    compact_cloud.compact_clouds_to_ply([path, path], ply_path)
+    expanded, c = ply.read_3d_point_cloud_from_ply(ply_path)
+    assert c == comments
+    np.testing.assert_array_equal(expanded, np.concatenate([array, array]))
+
+
+def test_compact_cloud_to_las(tmp_path):
+    """
+    Check the header and the points of the LAS export of a compact cloud.
+    """
+    rng = np.random.default_rng(0)
+    xyz = rng.uniform(0, 1000, size=(100, 3)) + [300000, 7600000, 0]
+    colors = rng.integers(0, 255, size=(100, 3), dtype=np.uint8)
+    path = str(tmp_path / "cloud.s2pc")
+    compact_cloud.write_compact_cloud(path, xyz, colors,
+                                      comments=["projection: CRS epsg:32740+5773"])
+    las_path = str(tmp_path / "cloud.las")
+    compact_cloud.compact_cloud_to_las(path, las_path)
+
+    with open(las_path, "rb") as f:
+        las = f.read()
+    assert las[:4] == b"LASF"
+    offset, nb_vlrs, fmt, length, count = struct.unpack("<IIBHI", las[96:111])
+    assert (nb_vlrs, fmt, length, count) == (1, 2, 26, 100)
+    scales = struct.unpack("<3d", las[131:155])
+    offsets = struct.unpack("<3d", las[155:179])
+    keys = struct.unpack("<20H", las[227 + 54:offset])
+    assert keys[-4:] == (4096, 0, 1, 5773)
+    assert keys[-8:-4] == (3072, 0, 1, 32740)
+
+    points = np.frombuffer(las[offset:], dtype=[("X", "<i4"), ("Y", "<i4"), ("Z", "<i4"),
+                                               ("pad", "V8"), ("rgb", "<u2", 3)])
+    xyz_las = np.column_stack([points[k] * s + o for k, s, o in zip("XYZ", scales, offsets)])
+    np.testing.assert_allclose(xyz_las, xyz, rtol=0, atol=compact_cloud.SCALE / 2 + 1e-9)
+    np.testing.assert_array_equal(points["rgb"], colors.astype(np.uint16) * 257)
+
+
+def test_main(tmp_path, monkeypatch):
+    """
+    Export compact clouds with the command line interface.
+    """
+    path = str(tmp_path / "cloud.s2pc")
+    xyz = np.random.default_rng(0).uniform(0, 1000, size=(10, 3))
+    compact_cloud.write_compact_cloud(path, xyz)
+    for args in [["ply", str(tmp_path / "cloud.ply"), path, path],
+                 ["las", path, str(tmp_path / "cloud.las")]]:
+        monkeypatch.setattr("sys.argv", ["s2p-cloud"] + args)
+        compact_cloud.main()
+    points, _ = ply.read_3d_point_cloud_from_ply(str(tmp_path / "cloud.ply"))
+    assert len(points) == 20
+    assert (tmp_path / "cloud.las").stat().st_size > 10 * 26
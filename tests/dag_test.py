@@ -0,0 +1,73 @@
+import os
+
+import pytest
+
+from s2p import dag_tasks, parallel
+from s2p.tile import Tile
+
+
+def grid_tiles(out_dir, nb_rows, nb_cols):
+    """
+    Tiles of a grid, with the neighborhood_dirs of initialization.tiles_full_info.
+    """
+    def tile_dir(r, c):
+        return os.path.join(out_dir, 'tiles', 'row_{:07d}_height_100'.format(100 * r),
+                            'col_{:07d}_width_100'.format(100 * c))
+
+    tiles = []
+    for r in range(nb_rows):
+        for c in range(nb_cols):
+            neighbors = [os.path.relpath(tile_dir(rr, cc), tile_dir(r, c))
+                         for rr in range(max(r - 1, 0), min(r + 2, nb_rows))
+                         for cc in range(max(c - 1, 0), min(c + 2, nb_cols))]
+            tiles.append(Tile(coordinates=(100 * c, 100 * r, 100, 100),
+                              dir=tile_dir(r, c), neighborhood_dirs=neighbors, json=''))
+    return tiles
+
+
+@pytest.mark.parametrize("nb_images, in_memory", [(2, False), (2, True), (3, False)])
+def test_dag_tasks(nb_images, in_memory):
+    """
+    Check that the dependencies of the tasks of the dag scheduler exist, and
+    that each DSM waits for the cloud of its tile.
+    """
+    cfg = {'images': [{}] * nb_images}
+    tiles = grid_tiles('/out', 2, 3)
+    tiles_pairs = [(cfg, t, i) for i in range(1, nb_images) for t in tiles]
+    tasks = dag_tasks(cfg, tiles_pairs, None, in_memory)
+    parallel.check_dag(tasks)
+
+    dsm = [t for t in tasks if t.key[0] == 'dsm']
+    assert len(dsm) == (len(tiles) if nb_images == 2 else 0)
+    for t in dsm:
+        assert t.requires[0][1] == t.key[1]
+        assert len(t.after) == len(t.args[1].neighborhood_dirs) - 1
+
+
+def test_tilewise_log_and_label():
+    """
+    Check that the pair index of a call is found whatever the number of
+    arguments following it.
+    """
+    tile = grid_tiles('/out', 1, 1)[0]
+    label = 'row_0000000_height_100/col_0000000_width_100'
+    for args in [(None, tile, 2), (None, tile, 2, None)]:
+        log, tile_label = parallel.tilewise_log_and_label(args)
+        assert log == os.path.join(tile.dir, 'pair_2', 'stdout.log')
+        assert tile_label == '/' + label + '/pair_2'
+    log, tile_label = parallel.tilewise_log_and_label((None, tile))
+    assert log == os.path.join(tile.dir, 'stdout.log')
+
+
+def square(x):
+    return x * x
+
+
+@pytest.mark.parametrize("nb_workers", [1, 2])
+def test_launch_dag_without_timeout(nb_workers):
+    """
+    Check that the calls are run without any timeout when it is None.
+    """
+    tasks = [parallel.Task(k, square, (k,), after=[k - 1] if k else []) for k in range(4)]
+    outputs = parallel.launch_dag({}, tasks, nb_workers, tilewise=False, timeout=None)
+    assert outputs == {k: k * k for k in range(4)}
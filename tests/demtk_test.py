@@ -0,0 +1,26 @@
+# s2p.demtk testing module
+
+import numpy as np
+
+from s2p import demtk
+
+
+def test_descending_neumann_interpolation_local():
+    """
+    Check that filling each hole independently gives the same DEM as the
+    interpolation over the whole grid.
+    """
+    rng = np.random.default_rng(0)
+    i, j = np.mgrid[:40, :50]
+    x = 0.1 * i + 0.05 * j + rng.normal(scale=0.5, size=i.shape)
+    x[5:9, 5:12] = np.nan      # interior hole
+    x[20:23, 30] = np.nan      # thin hole
+    x[0:4, 44:50] = np.nan     # hole touching the corner
+    x[30:40, 0:3] = np.nan     # hole touching the border
+    x[15, 15] = np.nan         # isolated pixel
+
+    expected = demtk.descending_neumann_interpolation(x).reshape(x.shape)
+    for workers in [1, 3]:
+        computed = demtk.descending_neumann_interpolation_local(x, workers=workers)
+        assert np.isfinite(computed).all()
+        np.testing.assert_allclose(computed, expected, atol=1e-6)
@@ -0,0 +1,47 @@
+# s2p.fusion testing module
+
+import warnings
+
+import numpy as np
+import pytest
+import rasterio
+
+from s2p import common
+from s2p import fusion
+
+
+@pytest.mark.parametrize('averaging', ['average_if_close', 'np.nanmedian',
+                                       'np.nanmean', 'np.nanmin', 'np.max'])
+def test_merge_n(tmp_path, averaging):
+    """
+    Check that the row-block merge_n matches the former pixelwise
+    np.apply_along_axis implementation, NaNs included.
+    """
+    rng = np.random.default_rng(0)
+    h, w, n = 37, 23, 3
+    x = rng.normal(scale=2, size=(h, w, n)).astype(np.float32)
+    x[rng.random((h, w, n)) < 0.2] = np.nan
+    x[:2, :2, :] = np.nan  # all-NaN pixels
+    offsets = [0.5, -1., 2.]
+
+    inputs = []
+    for i in range(n):
+        inputs.append(str(tmp_path / 'height_map_{}.tif'.format(i)))
+        common.rasterio_write(inputs[i], x[:, :, i])
+    output = str(tmp_path / 'height_map.tif')
+    fusion.merge_n(output, inputs, offsets, averaging=averaging, threshold=1,
+                   block_rows=10)
+    with rasterio.open(output) as f:
+        computed = f.read(1)
+
+    registered = x.astype(np.float64) - np.array(offsets)
+    with warnings.catch_warnings():
+        warnings.simplefilter('ignore', RuntimeWarning)  # all-NaN slices
+        if averaging == 'average_if_close':
+            expected = np.apply_along_axis(fusion.average_if_close, 2, registered, 1)
+        else:
+            f = getattr(np, averaging.split('.')[1])
+            expected = np.apply_along_axis(f, 2, registered)
+    expected = (expected + np.mean(offsets)).astype(np.float32)
+
+    np.testing.assert_allclose(computed, expected, atol=1e-5, equal_nan=True)
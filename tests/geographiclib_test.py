@@ -0,0 +1,33 @@
+# s2p.geographiclib testing module
+
+import numpy as np
+
+from s2p import geographiclib
+
+
+def test_pyproj_transform_finite():
+    """
+    Check that pyproj_transform_finite converts in place the finite points
+    like pyproj_transform, leaves the others untouched, and reuses the same
+    cached transformer.
+    """
+    in_crs = geographiclib.pyproj_crs("epsg:4979")
+    out_crs = geographiclib.pyproj_crs("epsg:32740")
+    assert geographiclib.pyproj_transformer(in_crs, out_crs) is \
+        geographiclib.pyproj_transformer(in_crs, out_crs)
+
+    rng = np.random.default_rng(0)
+    xyz = np.stack([rng.uniform(57.4, 57.6, (20, 30)),
+                    rng.uniform(-20.2, -20.0, (20, 30)),
+                    rng.uniform(0, 100, (20, 30))], axis=-1)
+    xyz[rng.random((20, 30)) < 0.3] = np.nan
+    xyz[0, 0] = [57.5, -20.1, np.nan]
+    valid = np.all(np.isfinite(xyz), axis=-1)
+
+    x, y, z = geographiclib.pyproj_transform(xyz[valid, 0], xyz[valid, 1],
+                                             in_crs, out_crs, xyz[valid, 2])
+    out = geographiclib.pyproj_transform_finite(xyz, in_crs, out_crs)
+    assert out is xyz
+    np.testing.assert_allclose(xyz[valid], np.column_stack((x, y, z)))
+    assert np.isnan(xyz[~valid, 2]).all()
+    assert xyz[0, 0, 0] < 180  # untouched longitude
@@ -0,0 +1,77 @@
+# s2p.morphology testing module
+
+import numpy as np
+from scipy import ndimage
+
+from s2p import common
+from s2p import morphology
+
+
+def random_image_with_nans(shape=(53, 41), seed=0):
+    rng = np.random.default_rng(seed)
+    x = rng.normal(scale=4, size=shape).astype(np.float32)
+    x[rng.random(shape) < 0.2] = np.nan
+    x[:5, :5] = np.nan
+    return x
+
+
+def test_erosion():
+    """
+    Compare s2p.morphology.erosion with a direct implementation of the
+    "morsi diskR erosion" command, which ignores NaNs and outside pixels.
+    """
+    x = random_image_with_nans()
+    h, w = x.shape
+    radius = 3
+    offsets = [(i, j) for i in range(-4, 5) for j in range(-4, 5)
+               if np.hypot(i, j) < radius]
+    expected = np.full(x.shape, np.nan, dtype=np.float32)
+    for y in range(h):
+        for z in range(w):
+            v = [x[y + i, z + j] for i, j in offsets
+                 if 0 <= y + i < h and 0 <= z + j < w]
+            if not np.all(np.isnan(v)):
+                expected[y, z] = np.nanmin(v)
+    np.testing.assert_array_equal(morphology.erosion(x, radius), expected)
+
+    # integer masks follow the same path, without NaNs
+    mask = (x > 0).astype(np.uint8) * 255
+    computed = morphology.erosion(mask, radius)
+    assert computed.dtype == np.uint8
+    np.testing.assert_array_equal(computed,
+                                  morphology.erosion(mask.astype(np.float32), radius))
+
+
+def test_opening_closing():
+    """
+    Compare s2p.morphology.opening_closing with the nan-aware scipy filters
+    of s2p.common.
+    """
+    x = random_image_with_nans()
+    opening, closing = morphology.opening_closing(x, 5)
+    expected_opening = common.maximum_filter_ignore_nan(
+        common.minimum_filter_ignore_nan(x, size=5), size=5)
+    expected_closing = common.minimum_filter_ignore_nan(
+        common.maximum_filter_ignore_nan(x, size=5), size=5)
+    np.testing.assert_array_equal(opening, expected_opening)
+    np.testing.assert_array_equal(closing, expected_closing)
+
+    mn, mx = morphology.minmax_filter(x, 5)
+    np.testing.assert_array_equal(morphology.gradient(x, 5), mx - mn)
+    np.testing.assert_array_equal(mn, common.minimum_filter_ignore_nan(x, size=5))
+
+
+def test_remove_small_cc():
+    """
+    Compare s2p.morphology.remove_small_cc with scipy.ndimage.label.
+    """
+    x = random_image_with_nans()
+    lab, _ = ndimage.label(~np.isnan(x))
+    sizes = np.bincount(lab.ravel())
+    expected = np.where((lab > 0) & (sizes[lab] > 10), x, np.nan)
+    np.testing.assert_array_equal(morphology.remove_small_cc(x, 10), expected)
+
+    # with a threshold, pixels differing by more than it are disconnected
+    y = np.array([[0, 0, 9, 9, 9]], dtype=np.float32)
+    np.testing.assert_array_equal(morphology.remove_small_cc(y, 2, 5),
+                                  [[np.nan, np.nan, 9, 9, 9]])
@@ -0,0 +1,76 @@
+import affine
+import numpy as np
+import pytest
+import rasterio
+import rasterio.merge
+
+from s2p import common
+from s2p import mosaic
+
+
+def write_tiles(tmp_path):
+    """
+    Write three overlapping tiles with a dsm, and a confidence for two of them.
+    """
+    rng = np.random.default_rng(0)
+    tiles = []
+    for i, (x, y, w, h) in enumerate([(0, 0, 40, 30), (30, 10, 50, 40), (10, 25, 30, 30)]):
+        profile = {'crs': 'epsg:32631', 'nodata': np.nan,
+                   'transform': affine.Affine(0.5, 0, 1000 + 0.5 * x, 0, -0.5, 5000 - 0.5 * y)}
+        tile = {}
+        for name in ['dsm', 'confidence'] if i < 2 else ['dsm']:
+            a = rng.uniform(0, 10, (h, w)).astype(np.float32)
+            a[rng.random((h, w)) < 0.2] = np.nan
+            tile[name] = str(tmp_path / '{}_{}.tif'.format(name, i))
+            common.rasterio_write(tile[name], a, profile=dict(profile))
+        tiles.append(tile)
+    return tiles
+
+
+@pytest.mark.parametrize("method", ["first", "last", "min", "max"])
+def test_mosaic(tmp_path, method):
+    """
+    Check that the mosaics assembled chunk by chunk by several threads are
+    those of rasterio.merge.merge.
+    """
+    tiles = write_tiles(tmp_path)
+    outputs = {n: str(tmp_path / '{}.tif'.format(n)) for n in ['dsm', 'confidence']}
+    mosaic.mosaic(tiles, outputs, 0.5, method=method, nb_workers=3,
+                  creation_options={'blockxsize': 16, 'blockysize': 16},
+                  blocks_per_chunk=1)
+
+    # all the mosaics share the grid of the union of the tiles
+    _, transform = rasterio.merge.merge([t['dsm'] for t in tiles])
+    with rasterio.open(outputs['dsm']) as f:
+        bounds = f.bounds
+    for n, path in outputs.items():
+        expected, _ = rasterio.merge.merge([t[n] for t in tiles if n in t], bounds=bounds,
+                                           method=method, nodata=np.nan)
+        with rasterio.open(path) as f:
+            assert f.transform == transform
+            np.testing.assert_array_equal(f.read(), expected)
+
+
+@pytest.mark.parametrize("method", ["first", "max"])
+def test_write_vrt(tmp_path, method):
+    """
+    Check that the virtual mosaics read as the physical ones, and that they
+    have the overviews of the tiles.
+    """
+    tiles = write_tiles(tmp_path)
+    for t in tiles:
+        for path in t.values():
+            mosaic.add_overviews(path, min_size=8)
+    outputs = {n: str(tmp_path / '{}.tif'.format(n)) for n in ['dsm', 'confidence']}
+    vrts = {n: str(tmp_path / 'out' / '{}.vrt'.format(n)) for n in ['dsm', 'confidence']}
+    (tmp_path / 'out').mkdir()
+    mosaic.mosaic(tiles, outputs, 0.5, method=method)
+    mosaic.write_vrt(tiles, vrts, 0.5, method=method)
+
+    for n in outputs:
+        with rasterio.open(outputs[n]) as f, rasterio.open(vrts[n]) as g:
+            assert g.transform == f.transform
+            assert g.crs == f.crs
+            np.testing.assert_array_equal(g.read(), f.read())
+    with rasterio.open(tiles[0]['dsm']) as f:
+        assert f.overviews(1) == [2]
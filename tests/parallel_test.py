@@ -1,3 +1,4 @@
+import os
 import time
 import subprocess
 
@@ -23,3 +24,111 @@ def test_launch_calls_error():
     with pytest.raises(subprocess.CalledProcessError):
         parallel.launch_calls(cfg, raise_exception, [1, 1, 1, 1], 2,
                               subprocess.CalledProcessError(1, "failcmd"), tilewise=False)
+
+
+def succeed_unless(x, failing):
+    """
+    Return False if x is in failing, True otherwise.
+    """
+    return x not in failing
+
+
+def test_launch_dag_dependencies():
+    """
+    Run interdependent calls and check that the tasks requiring a failed task
+    are skipped, while those only waiting for it are run.
+    """
+    cfg = get_default_config()
+    Task = parallel.Task
+    tasks = [Task('d', succeed_unless, ('d', 'b'), requires=['c']),
+             Task('a', succeed_unless, ('a', 'b')),
+             Task('b', succeed_unless, ('b', 'b'), after=['a']),
+             Task('c', succeed_unless, ('c', 'b'), requires=['b']),
+             Task('e', succeed_unless, ('e', 'b'), after=['c', 'a'], group='g')]
+    for nb_workers in [1, 2]:
+        outputs = parallel.launch_dag(cfg, tasks, nb_workers, tilewise=False,
+                                      group_limits={'g': 1})
+        assert outputs == {'a': True, 'b': False, 'e': True}
+
+
+def test_launch_dag_error():
+    """
+    Check that an error raised by a task is propagated.
+    """
+    cfg = get_default_config()
+    tasks = [parallel.Task(i, raise_exception, (1, subprocess.CalledProcessError(1, "failcmd")))
+             for i in range(4)]
+    with pytest.raises(subprocess.CalledProcessError):
+        parallel.launch_dag(cfg, tasks, 2, tilewise=False)
+
+
+def worker_pid(x):
+    """
+    Return the pid of the process running the call.
+    """
+    return os.getpid()
+
+
+def test_shared_pool():
+    """
+    Check that the calls of several launch_calls reuse the workers of the
+    shared pool.
+    """
+    cfg = get_default_config()
+    parallel.start_pool(2)
+    try:
+        pids = set(parallel.launch_calls(cfg, worker_pid, range(8), 2, tilewise=False))
+        pids |= set(parallel.launch_calls(cfg, worker_pid, range(8), 2, tilewise=False))
+        assert len(pids) <= 2
+        assert os.getpid() not in pids
+    finally:
+        parallel.stop_pool()
+
+
+def is_published_cfg(cfg, x):
+    """
+    Tell whether cfg is the config published to the worker.
+    """
+    return cfg is parallel.published_cfg
+
+
+def test_published_cfg():
+    """
+    Check that the config given to the pool is substituted in the calls
+    instead of being sent with each of them.
+    """
+    cfg = get_default_config()
+    assert parallel.remap_cfg((cfg, 1), cfg) == (parallel.CFG_SENTINEL, 1)
+    assert all(parallel.launch_calls(cfg, is_published_cfg, [(cfg, i) for i in range(4)], 2,
+                                     tilewise=False))
+
+
+def test_separate_pools():
+    """
+    Check that the calls of a separate group are run by at most as many
+    distinct workers as its limit, with or without a shared pool.
+    """
+    cfg = get_default_config()
+    Task = parallel.Task
+    tasks = [Task(('stereo', i), worker_pid, (i,), group='stereo') for i in range(8)]
+    tasks += [Task(('other', i), worker_pid, (i,)) for i in range(8)]
+    for shared in [False, True]:
+        if shared:
+            parallel.start_pool(3)
+            parallel.start_pool(2, name='stereo')
+        try:
+            outputs = parallel.launch_dag(cfg, tasks, 3, tilewise=False,
+                                          group_limits={'stereo': 2},
+                                          separate_groups=['stereo'])
+            stereo = set(outputs[('stereo', i)] for i in range(8))
+            other = set(outputs[('other', i)] for i in range(8))
+            assert len(stereo) <= 2
+            assert not stereo & other
+            pids = set(parallel.launch_calls(cfg, worker_pid, range(8), 2, tilewise=False,
+                                             pool='stereo'))
+            assert len(pids) <= 2
+            if shared:
+                # the same two workers run all the stereo calls
+                assert len(stereo | pids) <= 2
+        finally:
+            parallel.stop_pool()
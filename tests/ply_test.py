@@ -0,0 +1,71 @@
+import os
+
+import numpy as np
+import plyfile
+
+from s2p import ply
+
+
+def test_write_read_3d_point_cloud(tmp_path):
+    """
+    Check that the point clouds written by ply.write_3d_point_cloud_to_ply are
+    read identically by plyfile and by the memory-mapped reader.
+    """
+    rng = np.random.default_rng(0)
+    xyz = rng.uniform(-1000, 1000, size=(100, 3))
+    colors = rng.integers(0, 255, size=(100, 3), dtype=np.uint8)
+    confidence = rng.random(100, dtype=np.float32)
+    path = str(tmp_path / "cloud.ply")
+    comments = ["created by S2P", "projection: CRS epsg:32740"]
+    ply.write_3d_point_cloud_to_ply(path, xyz, colors=colors,
+                                    extra_properties=confidence,
+                                    extra_properties_names=["confidence"],
+                                    comments=comments)
+
+    plydata = plyfile.PlyData.read(path)
+    assert plydata.comments == comments
+    assert [p.name for p in plydata["vertex"].properties] == ["x", "y", "z", "red", "green", "blue", "confidence"]
+    np.testing.assert_array_equal(plydata["vertex"]["z"], xyz[:, 2])
+    np.testing.assert_array_equal(plydata["vertex"]["confidence"], confidence)
+
+    data, c = ply.memmap_3d_point_cloud_from_ply(path)
+    assert isinstance(data, np.memmap)
+    assert c == comments
+    np.testing.assert_array_equal(data["green"], colors[:, 1])
+
+    array, c = ply.read_3d_point_cloud_from_ply(path)
+    assert c == comments
+    np.testing.assert_array_equal(array, np.column_stack([xyz, colors, confidence]))
+
+    # ascii files are read with plyfile
+    el = plyfile.PlyElement.describe(np.array(data), "vertex")
+    del data
+    plyfile.PlyData([el], text=True, comments=comments).write(path)
+    assert ply.memmap_3d_point_cloud_from_ply(path)[0] is None
+    np.testing.assert_allclose(ply.read_3d_point_cloud_from_ply(path)[0], array, rtol=1e-6)
+
+
+def test_read_bounds(tmp_path):
+    """
+    Check that ply.read_bounds gives the same result from the sidecar file
+    and from the point cloud.
+    """
+    xyz = np.random.default_rng(0).uniform(-1000, 1000, size=(100, 3))
+    path = str(tmp_path / "cloud.ply")
+    ply.write_3d_point_cloud_to_ply(path, xyz, bounds=True)
+    assert os.path.exists(ply.bounds_path(path))
+
+    count, bmin, bmax = ply.read_bounds(path)
+    assert count == 100
+    np.testing.assert_array_equal(bmin, xyz.min(axis=0))
+    np.testing.assert_array_equal(bmax, xyz.max(axis=0))
+
+    os.remove(ply.bounds_path(path))
+    count, bmin, bmax = ply.read_bounds(path)
+    assert count == 100
+    np.testing.assert_array_equal(bmin, xyz.min(axis=0))
+    np.testing.assert_array_equal(bmax, xyz.max(axis=0))
+
+    ply.write_3d_point_cloud_to_ply(path, xyz[:0], bounds=True)
+    assert ply.read_bounds(path) == (0, None, None)
+    assert len(ply.read_3d_point_cloud_from_ply(path)[0]) == 0
@@ -0,0 +1,62 @@
+import os
+import pstats
+
+from s2p import profiling
+
+
+def busy(n):
+    return sum(i * i for i in range(n))
+
+
+def test_profile_and_merge(tmp_path):
+    """
+    Profile a function on a sample of tiles and merge the profiles.
+    """
+    cfg = {'out_dir': str(tmp_path), 'profile_functions': ['busy'],
+           'profile_fraction': 0.5}
+    labels = ['row_{:07d}_height_100/col_0000000_width_100'.format(100 * k)
+              for k in range(40)]
+    profiled = []
+    for label in labels:
+        tile_dir = os.path.join(str(tmp_path), 'tiles', label, 'pair_1')
+        os.makedirs(tile_dir)
+        with profiling.profile(cfg, 'busy', label + '/pair_1',
+                               os.path.join(tile_dir, 'stdout.log')):
+            busy(1000)
+        with profiling.profile(cfg, 'other', label, os.path.join(tile_dir, 'stdout.log')):
+            busy(1000)
+        if os.path.exists(os.path.join(tile_dir, 'busy.prof')):
+            profiled.append(label)
+        assert not os.path.exists(os.path.join(tile_dir, 'other.prof'))
+
+    # the sample is deterministic and roughly of the requested size
+    assert profiled == [l for l in labels if profiling.sampled(l, 0.5)]
+    assert 5 < len(profiled) < 35
+
+    path = profiling.merge_profiles(cfg)
+    stats = pstats.Stats(path)
+    calls = [v[1] for k, v in stats.stats.items() if k[2] == 'busy']
+    assert calls == [len(profiled)]
+    assert os.path.exists(os.path.join(str(tmp_path), 'profile.txt'))
+
+
+def test_remove_profiles(tmp_path):
+    """
+    Check that the profiles of a previous run are not merged with the new
+    ones once removed.
+    """
+    cfg = {'out_dir': str(tmp_path), 'profile_functions': ['busy'],
+           'profile_fraction': 1}
+    tile_dirs = [os.path.join(str(tmp_path), 'tiles', 'row_{:07d}_height_100'.format(100 * k),
+                              'col_0000000_width_100') for k in range(2)]
+    for tile_dir in tile_dirs:
+        os.makedirs(tile_dir)
+    with profiling.profile(cfg, 'busy', 'previous', os.path.join(tile_dirs[0], 'stdout.log')):
+        busy(1000)
+
+    profiling.remove_profiles(cfg)
+    assert profiling.merge_profiles(cfg) is None
+    with profiling.profile(cfg, 'busy', 'current', os.path.join(tile_dirs[1], 'stdout.log')):
+        busy(1000)
+    stats = pstats.Stats(profiling.merge_profiles(cfg))
+    assert [v[1] for k, v in stats.stats.items() if k[2] == 'busy'] == [1]
@@ -2,9 +2,14 @@
 
 import math
 
+import affine
 import numpy as np
 import rasterio
-from plyflatten import plyflatten_from_plyfiles_list
+from plyflatten import plyflatten, plyflatten_from_plyfiles_list
+
+import s2p
+from s2p import compact_cloud, rasterization
+from s2p.config import get_default_config
 
 from tests_utils import data_path
 
@@ -58,3 +63,101 @@ def test_plyflatten():
         assert math.isnan(test_nodata)
     else:
         assert test_nodata == expected_nodata
+
+
+def random_points(n, seed=0):
+    rng = np.random.default_rng(seed)
+    x = rng.uniform(1000, 1100, n)
+    y = rng.uniform(5000, 5080, n)
+    values = np.column_stack([rng.uniform(0, 50, n), rng.uniform(0, 255, (n, 3)),
+                              rng.random(n)])
+    return x, y, values
+
+
+def test_rasterize():
+    """
+    Check that the averages computed by rasterization.rasterize are those of
+    plyflatten, with and without threads, footprint radius and Gaussian weights.
+    """
+    x, y, values = random_points(20000)
+    resolution = 0.5
+    xoff, yoff, xsize, ysize = rasterization.grid(x.min(), x.max(), y.min(), y.max(),
+                                                  resolution)
+    for radius, sigma in [(0, None), (2, 0.6)]:
+        expected = plyflatten(np.column_stack([x, y, values]), xoff, yoff, resolution,
+                              xsize, ysize, radius, math.inf if sigma is None else sigma)
+        for nb_threads in [1, 4]:
+            acc = rasterization.rasterize(x, y, values, xoff, yoff, resolution, xsize,
+                                          ysize, radius, sigma, nb_threads=nb_threads)
+            average, highest = rasterization.bands(acc)
+            np.testing.assert_allclose(average, expected, rtol=1e-5, equal_nan=True)
+            assert np.array_equal(np.isnan(highest), np.isnan(expected[:, :, 0]))
+            assert np.all(highest[~np.isnan(highest)] >= average[:, :, 0][~np.isnan(highest)] - 1e-4)
+
+
+def test_accumulators_to_dsm(tmp_path):
+    """
+    Check that the DSM computed from the accumulators of two tiles, whose
+    bounding boxes overlap, is the rasterization of the union of their points.
+    """
+    x, y, values = random_points(20000)
+    resolution, radius = 0.5, 1
+    tiles = [x + y / 2 < 3590, x + y / 2 >= 3590]
+    paths = []
+    for i, t in enumerate(tiles):
+        roi = rasterization.grid(x[t].min(), x[t].max(), y[t].min(), y[t].max(), resolution)
+        acc = rasterization.rasterize(x[t], y[t], values[t],
+                                      roi[0] - radius * resolution,
+                                      roi[1] + radius * resolution, resolution,
+                                      roi[2] + 2 * radius, roi[3] + 2 * radius, radius)
+        paths.append(str(tmp_path / "acc_{}.tif".format(i)))
+        rasterization.write_accumulator(paths[-1], acc, roi, resolution, radius,
+                                        ["z", "red", "green", "blue", "confidence"])
+
+    average, highest, names, profile = rasterization.accumulators_to_dsm(paths)
+    assert names == ["z", "red", "green", "blue", "confidence"]
+
+    roi, _ = rasterization.read_accumulator_tags(paths[0])
+    xoff, yoff, xsize, ysize = roi
+    assert profile["transform"] == affine.Affine(resolution, 0, xoff, 0, -resolution, yoff)
+    expected_average, expected_highest = rasterization.bands(rasterization.rasterize(
+        x, y, values, xoff, yoff, resolution, xsize, ysize, radius))
+    np.testing.assert_allclose(average, expected_average, rtol=1e-5, equal_nan=True)
+    np.testing.assert_array_equal(highest, expected_highest)
+
+
+def test_compact_clouds_to_dsm(tmp_path):
+    """
+    Check that the DSM of compact clouds is the plyflatten rasterization of
+    their decoded points, and that the clouds outside of the DSM are ignored.
+    """
+    x, y, values = random_points(20000)
+    z, confidence = values[:, 0], values[:, 4]
+    colors = values[:, 1:4].astype(np.uint8)
+    paths = []
+    for i, t in enumerate([x < 1050, x >= 1050]):
+        paths.append(str(tmp_path / "cloud_{}.s2pc".format(i)))
+        compact_cloud.write_compact_cloud(paths[-1], np.column_stack([x[t], y[t], z[t]]),
+                                          colors[t], confidence[t], ["confidence"])
+    far = str(tmp_path / "far.s2pc")
+    compact_cloud.write_compact_cloud(far, np.column_stack([x + 500, y, z]), colors)
+
+    cfg = get_default_config()
+    cfg.update(dsm_resolution=0.5, dsm_radius=1, dsm_sigma=0.6, out_crs="epsg:32740",
+               dsm_aggregation_with_max=False)
+    roi = rasterization.grid(1000, 1049, 5000, 5080, cfg['dsm_resolution'])
+    dsm, conf, profile = s2p.compact_clouds_to_dsm(cfg, paths + [far], roi)
+
+    decoded = [compact_cloud.read_compact_cloud_columns(p)[0] for p in paths]
+    cloud = np.column_stack([np.concatenate([c[n] for c in decoded])
+                             for n in ["x", "y", "z", "confidence"]])
+    expected = plyflatten(cloud, *roi[:2], cfg['dsm_resolution'], *roi[2:],
+                          cfg['dsm_radius'], cfg['dsm_sigma'])
+    np.testing.assert_allclose(dsm, expected[:, :, 0], rtol=1e-5, equal_nan=True)
+    np.testing.assert_allclose(conf, expected[:, :, 1], rtol=1e-4, equal_nan=True)
+    assert profile["transform"] == affine.Affine(0.5, 0, roi[0], 0, -0.5, roi[1])
+
+    cfg['dsm_aggregation_with_max'] = True
+    dsm, _, _ = s2p.compact_clouds_to_dsm(cfg, paths, roi)
+    assert np.array_equal(np.isnan(dsm), np.isnan(expected[:, :, 0]))
+    assert np.nanmin(dsm - expected[:, :, 0]) > -1e-4
@@ -0,0 +1,55 @@
+import numpy as np
+import pytest
+import rpcm
+
+from s2p import rpc_kernels
+from tests_utils import data_path
+
+
+@pytest.mark.parametrize("nb_threads", [1, 2])
+def test_compiled_rpc_model(nb_threads, monkeypatch):
+    """
+    Check that CompiledRPCModel gives the same projections and localizations
+    as rpcm.RPCModel, with the serial and multi-threaded kernels.
+    """
+    monkeypatch.setattr(rpc_kernels, "PARALLEL_THRESHOLD", 1)
+    rpc = rpcm.rpc_from_geotiff(data_path("input_pair/img_01.tif"))
+    model = rpc_kernels.CompiledRPCModel(rpc, nb_threads=nb_threads)
+    assert isinstance(model, rpcm.RPCModel)
+
+    rng = np.random.default_rng(0)
+    col = rng.uniform(0, 1000, size=(10, 20))
+    row = rng.uniform(0, 1000, size=(10, 20))
+    alt = rng.uniform(300, 500, size=(10, 20))
+
+    lon, lat = model.localization(col, row, alt)
+    assert lon.shape == (10, 20)
+    expected = rpc.localization(col.ravel(), row.ravel(), alt.ravel())
+    np.testing.assert_allclose(lon.ravel(), expected[0], rtol=0, atol=1e-12)
+    np.testing.assert_allclose(lat.ravel(), expected[1], rtol=0, atol=1e-12)
+
+    x, y = model.projection(lon, lat, alt)
+    np.testing.assert_allclose(x, rpc.projection(lon, lat, alt)[0], rtol=0, atol=1e-9)
+    np.testing.assert_allclose(y, rpc.projection(lon, lat, alt)[1], rtol=0, atol=1e-9)
+    np.testing.assert_allclose(x, col, rtol=0, atol=1e-6)
+    np.testing.assert_allclose(y, row, rtol=0, atol=1e-6)
+
+    # scalars and float32 inputs, whose outputs are float64 as rpcm's
+    np.testing.assert_allclose(model.localization(100, 200, 400),
+                               rpc.localization(100, 200, 400), rtol=0, atol=1e-12)
+    p = [np.float32(v) for v in (lon[0, 0], lat[0, 0], alt[0, 0])]
+    x, y = model.projection(*p)
+    assert x.dtype == y.dtype == np.float64
+    np.testing.assert_allclose([x, y], rpc.projection(*[float(v) for v in p]),
+                               rtol=0, atol=1e-9)
+    lon32, lat32 = model.localization(np.float32(100), np.float32(200), np.float32(400))
+    assert lon32.dtype == np.float64
+    np.testing.assert_allclose([lon32, lat32], rpc.localization(100, 200, 400),
+                               rtol=0, atol=1e-12)
+
+    # analytic localization functions
+    rpc.lon_num, rpc.lon_den = [0, 0, 1] + [0] * 17, [1] + [0] * 19
+    rpc.lat_num, rpc.lat_den = [0, 1] + [0] * 18, [1] + [0] * 19
+    model = rpc_kernels.CompiledRPCModel(rpc, nb_threads=nb_threads)
+    np.testing.assert_allclose(model.localization(col, row, alt),
+                               rpc.localization(col, row, alt), rtol=0, atol=1e-12)
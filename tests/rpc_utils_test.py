@@ -79,3 +79,30 @@ def test_roi_process(use_srtm, exogenous_dem, exogenous_dem_geoid_mode, expected
     )
     computed = [output[k] for k in ["x", "y", "w", "h"]]
     np.testing.assert_allclose(computed, expected, atol=1e-3)
+
+
+def test_localization_grid():
+    """
+    Test for rpc_utils.LocalizationGrid: the interpolated localization is
+    within the requested error of the exact one, inside and outside of the
+    grid, and the other attributes are those of the wrapped model.
+    """
+    rpc = rpcm.rpc_from_geotiff(data_path(os.path.join("input_pair", "img_01.tif")))
+    grid = rpc_utils.LocalizationGrid(rpc, 500, 150, 350, 350, 300, 500,
+                                      max_error=1e-4, step=256)
+    assert grid.error <= 1e-4
+    assert grid.alt_offset == rpc.alt_offset
+
+    rng = np.random.default_rng(0)
+    col = rng.uniform(400, 900, 1000)
+    row = rng.uniform(100, 550, 1000)
+    alt = rng.uniform(250, 550, 1000)
+    lon, lat = grid.localization(col, row, alt)
+    expected_lon, expected_lat = rpc.localization(col, row, alt)
+    error = np.hypot((lon - expected_lon) * np.cos(np.radians(lat)),
+                     lat - expected_lat) * 111320
+    assert error.max() < 1e-4
+
+    lon, lat = grid.localization(600, 200, 400)
+    np.testing.assert_allclose([lon, lat], rpc.localization(600, 200, 400),
+                               atol=1e-8)
@@ -2,6 +2,10 @@
 # Copyright (C) 2019, Carlo de Franchis (CMLA) <carlo.de-franchis@ens-paris-saclay.fr>
 # Copyright (C) 2019, Julien Michel (CNES) <julien.michel@cnes.fr>
 
+import ctypes
+import logging
+import timeit
+
 import numpy as np
 import rpcm
 
@@ -50,3 +54,33 @@ def test_matches_on_rpc_roi():
     expected = np.loadtxt(data_path('expected_output/units/matches_on_rpc_roi.txt'))
     np.testing.assert_allclose(computed, expected, rtol=0.01, atol=0.1,
                                verbose=True)
+
+
+def test_copy_float_buffer():
+    """
+    Check that sift.copy_float_buffer matches, and is faster than, the former
+    element-wise conversion of the libsift4ctypes output buffers, in a float64
+    copy.
+
+    The timings are the best of a few runs, on a large buffer, and only have
+    to differ by a loose factor, so that a loaded machine doesn't make the
+    test fail.
+    """
+    shape = (20000, 132)
+    values = np.random.rand(*shape).astype(np.float32)
+    ptr = values.ctypes.data_as(ctypes.POINTER(ctypes.c_float))
+
+    def elementwise():
+        return np.asarray([ptr[i] for i in range(shape[0] * shape[1])]).reshape(shape)
+
+    computed = sift.copy_float_buffer(ptr, shape)
+    np.testing.assert_array_equal(computed, elementwise())
+    assert computed.dtype == np.float64
+    assert not np.shares_memory(computed, values)
+    assert sift.copy_float_buffer(ptr, (0, 132)).shape == (0, 132)
+
+    t_loop = min(timeit.repeat(elementwise, number=1, repeat=2))
+    t_copy = min(timeit.repeat(lambda: sift.copy_float_buffer(ptr, shape), number=1, repeat=5))
+    logging.getLogger(__name__).info('copy_float_buffer: %.4f s, element-wise: %.4f s',
+                                     t_copy, t_loop)
+    assert t_copy * 3 < t_loop
@@ -0,0 +1,29 @@
+# s2p.specklefilter testing module
+
+import numpy as np
+import pytest
+from scipy import ndimage
+
+from s2p.specklefilter import specklefilter
+
+
+@pytest.mark.parametrize('parallel', [False, True])
+def test_specklefilter(parallel):
+    """
+    Compare the connected components removed by s2p.specklefilter.specklefilter
+    with the ones computed by scipy.ndimage.label.
+    """
+    rng = np.random.default_rng(0)
+    x = rng.integers(0, 3, size=(301, 97)).astype(np.float32)
+    x[rng.random(x.shape) < 0.05] = np.nan
+    area = 4
+
+    expected = np.full(x.shape, np.nan, dtype=np.float32)
+    for v in range(3):
+        lab, _ = ndimage.label(x == v)
+        sizes = np.bincount(lab.ravel())
+        keep = (lab > 0) & (sizes[lab] > area)
+        expected[keep] = v
+
+    computed = specklefilter(x, area, 0, parallel=parallel)
+    np.testing.assert_array_equal(computed, expected)
@@ -0,0 +1,195 @@
+import os
+from types import SimpleNamespace
+
+import numpy as np
+import pytest
+
+from s2p import common
+
+torch = pytest.importorskip("torch")
+from s2p.sota_correlators.stereoanywhere import disparity  # noqa: E402
+
+
+def test_make_batches():
+    """
+    Check that the pairs are grouped by padded shape, within the batch size
+    and memory limits, and that each pair is in exactly one batch.
+    """
+    shapes = [(100, 100), (90, 120), (100, 100), (300, 300), (100, 100)]
+    assert disparity.make_batches(shapes, 2) == [[1], [0, 2], [4], [3]]
+    assert disparity.make_batches(shapes, 8) == [[1], [0, 2, 4], [3]]
+
+    # a budget fitting a single 128 x 128 pair
+    memory = 1.5 * disparity.estimate_memory(128, 128)
+    batches = disparity.make_batches(shapes, 8, memory)
+    assert batches == [[1], [0], [2], [4], [3]]
+    assert sorted(sum(batches, [])) == list(range(len(shapes)))
+
+
+class FakeEngine:
+    """
+    Engine whose batched inference fails on the batches containing a "bad"
+    pair, and records the sizes of the batches.
+    """
+    batch_sizes = []
+
+    def __init__(self, *args, **kwargs):
+        pass
+
+    def infer_batch(self, left_images, right_images, disp_ranges=None, flow_tol=None):
+        FakeEngine.batch_sizes.append(len(left_images))
+        if any('bad' in p for p in left_images):
+            raise RuntimeError('bad pair')
+        return [np.zeros((32, 32), dtype=np.float32) for _ in left_images]
+
+
+def test_run_batch_fallback(tmp_path, monkeypatch):
+    """
+    Check that the pairs of a failed batch are processed one by one, and that
+    only the bad pairs are reported as failed.
+    """
+    monkeypatch.setattr(disparity, 'StereoAnywhereEngine', FakeEngine)
+    monkeypatch.setattr(disparity, 'read_image', lambda path: path)
+    FakeEngine.batch_sizes = []
+
+    pairs = []
+    for name in ['a', 'bad', 'b']:
+        d = tmp_path / name
+        d.mkdir()
+        left, right = str(d / 'rectified_ref.tif'), str(d / 'rectified_sec.tif')
+        for path in [left, right]:
+            common.rasterio_write(path, np.ones((32, 32), dtype=np.float32))
+        pairs.append((left, right, str(d / 'rectified_disp.tif'),
+                      str(d / 'rectified_mask.png')))
+    pairs.append((str(tmp_path / 'missing_ref.tif'), str(tmp_path / 'missing_sec.tif'),
+                  str(tmp_path / 'missing_disp.tif'), str(tmp_path / 'missing_mask.png')))
+
+    failed = disparity.run_batch(pairs, 'mono.pth', 'stereo.pth', max_batch_size=4)
+    assert failed == [1, 3]
+    assert FakeEngine.batch_sizes == [3, 1, 1, 1]
+    for k in [0, 2]:
+        assert os.path.exists(pairs[k][2])
+        assert os.path.exists(pairs[k][3])
+    assert not os.path.exists(pairs[1][2])
+
+
+def test_window_height(caplog):
+    """
+    Check that the windows are the largest ones fitting in the memory budget,
+    and that the budget is exceeded with a warning when it is too small.
+    """
+    m = disparity.estimate_memory(256, 512)
+    assert disparity.estimate_memory(256, 512, batch_size=3) == pytest.approx(3 * m)
+    assert disparity.estimate_memory(288, 512) > m
+    assert disparity.estimate_memory(256, 544) > m
+
+    for budget in [m, 1.1 * m, 10 * m]:
+        h = disparity.window_height(512, budget, overlap=64)
+        assert h % 32 == 0
+        assert disparity.estimate_memory(h, 512) <= budget
+        assert disparity.estimate_memory(h + 32, 512) > budget
+    assert disparity.window_height(512, m, overlap=64) == 256
+
+    h = disparity.window_height(512, 1e-3, overlap=64)
+    assert h == 96
+    assert 'does not fit' in caplog.text
+
+
+def test_infer_windowed(monkeypatch):
+    """
+    Check that the windows cover the whole image and that their overlaps are
+    blended without seams, with an engine returning the first channel of the
+    left image as disparity.
+    """
+    engine = object.__new__(disparity.StereoAnywhereEngine)
+    engine.weights_memory = lambda: 0
+    engine.infer = lambda left, right, **kwargs: left[0, 0].copy()
+    monkeypatch.setattr(disparity, 'window_height', lambda width, max_memory, overlap: 160)
+
+    h, w = 700, 50
+    left = np.zeros((1, 3, h, w), dtype=np.float32)
+    left[0, 0] = np.arange(h)[:, None] + np.arange(w)
+    out = disparity.StereoAnywhereEngine.infer_windowed(engine, left, left, max_memory=1)
+    np.testing.assert_allclose(out, left[0, 0], rtol=1e-6)
+
+
+@pytest.mark.parametrize("offset", [-3, 0, 2])
+def test_shift_columns(offset):
+    """
+    Check that out[..., j] = x[..., j + offset], with replicated borders.
+    """
+    x = torch.arange(10, dtype=torch.float32).reshape(1, 1, 1, 10).repeat(1, 3, 2, 1)
+    out = disparity.shift_columns(x, offset)
+    assert out.shape == x.shape
+    expected = np.clip(np.arange(10) + offset, 0, 9)
+    np.testing.assert_array_equal(out[0, 2, 1].numpy(), expected)
+
+
+def test_range_offset_and_iters():
+    """
+    Check that the disparity ranges are shifted to [disp_min - disp_max, 0],
+    and the number of GRU iterations, proportional to the range width and
+    clipped.
+    """
+    assert disparity.range_offset_and_iters(None, 192, 32) == (0, 32)
+    assert disparity.range_offset_and_iters((-10, 30), 192, 32) == (30, 8)
+    assert disparity.range_offset_and_iters((-50, 46), 192, 32) == (46, 16)
+    assert disparity.range_offset_and_iters((-300, 100), 192, 32) == (100, 32)
+    assert disparity.range_offset_and_iters((5, 5), 192, 32, min_iters=4) == (5, 4)
+    assert disparity.range_offset_and_iters((-7.5, -2.5), 192, 32) == (-2, 8)
+
+
+def block_matching(left, right, mono_left, mono_right, maxdisp, **kwargs):
+    """
+    Stand-in for the stereo model: pixelwise matching of the residual
+    disparities in [-maxdisp, 0], the range the model was trained on.
+    """
+    w = left.shape[-1]
+    candidates = range(-maxdisp, 1)
+    costs = torch.full((len(candidates),) + left[:, :1].shape, float('inf'))
+    for k, d in enumerate(candidates):
+        lo, hi = max(0, -d), min(w, w - d)
+        costs[k, ..., lo:hi] = (left[..., lo:hi] - right[..., lo + d:hi + d]).abs().sum(1, keepdim=True)
+    return torch.tensor(list(candidates), dtype=torch.float32)[costs.argmin(0)], None
+
+
+@pytest.mark.parametrize("batched", [False, True])
+def test_infer_shifted_pair(batched):
+    """
+    Check that the disparities of a synthetic pair are recovered when they
+    are far from 0, and beyond the range matched by the model, but inside the
+    given disparity range.
+    """
+    maxdisp = 24
+    engine = object.__new__(disparity.StereoAnywhereEngine)
+    engine.device = torch.device('cpu')
+    engine.args = disparity.default_model_args()
+    engine.args.maxdisp = maxdisp
+    engine.mono_model = SimpleNamespace(infer_image=lambda x, **kwargs: x[:, :1])
+    engine.stereo_model = lambda *args, **kwargs: block_matching(*args, maxdisp=maxdisp, **kwargs)
+
+    # left[y, x] = right[y, x + d[y]], with d in [-60, -42]
+    h, w = 6, 128
+    d = np.array([-60, -55, -50, -47, -44, -42])
+    texture = np.random.default_rng(0).random((3, h, w + 64), dtype=np.float32)
+    left = texture[:, :, :w]
+    right = np.stack([texture[:, y, -d[y]:w - d[y]] for y in range(h)], axis=1)
+    left, right = torch.from_numpy(left)[None], torch.from_numpy(right)[None]
+
+    disp_range = (-62, -40)
+    if batched:
+        out = engine.infer_batch([left, left], [right, right], disp_ranges=[disp_range] * 2)[1]
+    else:
+        out = engine.infer(left, right, disp_range=disp_range)
+    # the columns whose match is inside the secondary image
+    np.testing.assert_array_equal(out[:, 64:], np.broadcast_to(d[:, None], (h, w - 64)))
+
+
+def test_mask_out_of_range():
+    """
+    Check that only the disparities outside of the range are set to NaN.
+    """
+    d = np.array([-6, -5, 0, 7, 7.5, np.nan], dtype=np.float32)
+    out = disparity.mask_out_of_range(d.copy(), (-5, 7))
+    np.testing.assert_array_equal(out, [np.nan, -5, 0, 7, np.nan, np.nan])
+    np.testing.assert_array_equal(disparity.mask_out_of_range(d.copy(), None), d)
@@ -0,0 +1,73 @@
+import os
+
+import numpy as np
+import pytest
+
+from s2p import telemetry
+
+
+def test_measure(tmp_path):
+    """
+    Record a successful and a failing tilewise call in a telemetry file.
+    """
+    path = str(tmp_path / 'telemetry.jsonl')
+    label = 'row_0000000_height_500/col_0000000_width_500/pair_1'
+    with telemetry.measure(path, 'allocate', label):
+        telemetry.add_subprocess_time(0.5)
+        a = np.ones(1 << 22)
+        with open(os.path.join(str(tmp_path), 'a.npy'), 'wb') as f:
+            np.save(f, a)
+    with pytest.raises(ValueError):
+        with telemetry.measure(path, 'fail', 'row_0000000_height_500/col_0000500_width_500'):
+            raise ValueError
+
+    ok, error = telemetry.read_records(path)
+    assert ok['kind'] == 'task' and ok['name'] == 'allocate'
+    assert ok['tile'] == 'row_0000000_height_500/col_0000000_width_500'
+    assert ok['pair'] == 1
+    assert ok['status'] == 'ok'
+    assert ok['wall'] > 0
+    assert ok['subprocess_time'] == pytest.approx(0.5)
+    assert ok['peak_rss'] >= a.nbytes
+    assert ok['write_bytes'] >= a.nbytes
+    assert error['pair'] is None
+    assert error['status'] == 'error'
+
+
+def test_summarize():
+    """
+    Aggregate synthetic records by task, tile and step.
+    """
+    def task(name, tile, start, wall):
+        return {'kind': 'task', 'name': name, 'tile': tile, 'pair': 1,
+                'start': start, 'wall': wall, 'cpu_user': wall,
+                'cpu_system': 0, 'children_cpu': 0, 'subprocess_time': 0,
+                'read_bytes': 1, 'write_bytes': 2, 'peak_rss': 3,
+                'status': 'ok'}
+
+    records = [task('rectification_pair', 'tile_{}'.format(k), 10 + k, 1 + k)
+               for k in range(100)]
+    records += [task('stereo_matching', 'tile_0', 200, 120),
+                task('stereo_matching', 'tile_0', 260, 50),
+                task('stereo_matching', 'tile_1', 200, 60)]
+    records += [{'kind': 'step', 'name': '3_rectification', 'start': 10, 'wall': 150},
+                {'kind': 'step', 'name': '4_stereo_matching', 'start': 190, 'wall': 100}]
+
+    s = telemetry.summarize(records, top=2)
+    r = s['tasks']['rectification_pair']
+    assert r['count'] == 100
+    assert r['wall_p50'] == pytest.approx(50.5)
+    assert r['wall_p90'] == pytest.approx(90.1)
+    assert r['wall_max'] == 100
+    assert r['read_bytes'] == 100
+    assert s['slowest_tiles'][0][0] == 'tile_0'
+    assert s['slowest_tiles'][0][2] == {'rectification_pair': 1, 'stereo_matching': 170}
+    assert s['slowest_tiles'][1][0] == 'tile_99'
+
+    rect, matching = s['steps']
+    assert rect['tasks'] == 100
+    assert rect['critical_tile'] == 'tile_99'
+    assert matching['tasks'] == 3
+    assert matching['critical_tile'] == 'tile_0'
+    assert matching['critical_path'] == 170
+    assert 'tile_99' in telemetry.report(records)
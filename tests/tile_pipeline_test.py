@@ -0,0 +1,94 @@
+import os
+
+import numpy as np
+import pytest
+
+import s2p
+from s2p import common
+from s2p.config import get_default_config
+from s2p.tile import Tile
+
+
+@pytest.fixture()
+def stubs(monkeypatch):
+    """
+    Replace the rectification, the stereo matcher and the triangulation of
+    tile_pipeline by stubs recording their calls.
+    """
+    calls = {'match': [], 'triangulate': []}
+    H = np.eye(3)
+
+    def rectify(cfg, tile, i, rect1, rect2):
+        for path in [rect1, rect2]:
+            common.rasterio_write(path, np.zeros((8, 8), dtype=np.float32))
+        return H, H, -3, 5, cfg['rectification_succeeds']
+
+    def match(cfg, rect1, rect2, disp, mask, disp_min, disp_max, gpu_mem_manager):
+        calls['match'].append((disp_min, disp_max))
+        if cfg['matching_succeeds']:
+            common.rasterio_write(disp, np.ones((8, 8), dtype=np.float32))
+            common.rasterio_write(mask, np.ones((8, 8), dtype=np.uint8))
+
+    def triangulate(cfg, tile, H_ref, H_sec, rect_ref, disp, mask_rect, extra, ply_file):
+        assert all(os.path.exists(p) for p in [rect_ref, disp, mask_rect])
+        calls['triangulate'].append((os.path.dirname(disp), extra, ply_file))
+        open(ply_file, 'w').close()
+
+    monkeypatch.setattr(s2p, 'rectify_tile_pair', rectify)
+    monkeypatch.setattr(s2p, 'match_tile_pair', match)
+    monkeypatch.setattr(s2p, 'triangulate_tile_pair', triangulate)
+    return calls
+
+
+@pytest.mark.parametrize("checkpoints", [False, True])
+def test_tile_pipeline(tmp_path, stubs, checkpoints):
+    """
+    Check that tile_pipeline chains the steps through a scratch directory,
+    writes the cloud in the tile directory, and removes the scratch files.
+    """
+    cfg = get_default_config()
+    cfg['temporary_dir'] = str(tmp_path / 'tmp')
+    cfg['tile_pipeline_checkpoints'] = checkpoints
+    cfg['rectification_succeeds'] = cfg['matching_succeeds'] = True
+    os.makedirs(cfg['temporary_dir'])
+    tile_dir = str(tmp_path / 'tiles' / 'row_0000000_height_8' / 'col_0000000_width_8')
+    os.makedirs(os.path.join(tile_dir, 'pair_1'))
+    tile = Tile(coordinates=(0, 0, 8, 8), dir=tile_dir, neighborhood_dirs=[], json='')
+
+    assert s2p.tile_pipeline(cfg, tile, 1, None)
+    assert stubs['match'] == [(-3, 5)]
+    scratch, extra, ply_file = stubs['triangulate'][0]
+    assert os.path.dirname(scratch) == cfg['temporary_dir']
+    assert extra == ''
+    assert ply_file == os.path.join(tile_dir, s2p.cloud_name(cfg))
+    assert os.path.exists(ply_file)
+    assert os.listdir(cfg['temporary_dir']) == []
+
+    saved = sorted(os.listdir(os.path.join(tile_dir, 'pair_1')))
+    if checkpoints:
+        assert saved == ['H_ref.txt', 'H_sec.txt', 'disp_min_max.txt', 'rectified_disp.tif',
+                         'rectified_mask.png', 'rectified_ref.tif']
+    else:
+        assert saved == []
+
+
+@pytest.mark.parametrize("failing", ['rectification_succeeds', 'matching_succeeds'])
+def test_tile_pipeline_failure(tmp_path, stubs, failing):
+    """
+    Check that tile_pipeline stops, without triangulating, when the
+    rectification or the stereo matching fails, and that the DSM accumulator
+    of a previous run is not left in the tile directory.
+    """
+    cfg = get_default_config()
+    cfg['temporary_dir'] = str(tmp_path)
+    cfg['direct_rasterization'] = True
+    cfg['rectification_succeeds'] = cfg['matching_succeeds'] = True
+    cfg[failing] = False
+    tile = Tile(coordinates=(0, 0, 8, 8), dir=str(tmp_path), neighborhood_dirs=[], json='')
+    stale = os.path.join(tile.dir, s2p.ACCUMULATOR_NAME)
+    open(stale, 'w').close()
+
+    assert not s2p.tile_pipeline(cfg, tile, 1, None)
+    assert stubs['triangulate'] == []
+    assert len(stubs['match']) == (failing == 'matching_succeeds')
+    assert not os.path.exists(stale)
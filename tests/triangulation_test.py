@@ -1,9 +1,13 @@
+import copy
 import os
 import shutil
 
+import numpy as np
 import pytest
+import rpcm
 
 from s2p import disparity_to_ply, read_config_file
+from s2p import geographiclib, triangulation
 from s2p.config import get_default_config
 from s2p.initialization import build_cfg
 from s2p.ply import read_3d_point_cloud_from_ply
@@ -35,3 +39,38 @@ def test_disparity_to_ply(tmp_path, out_crs):
     _, comments = read_3d_point_cloud_from_ply(os.path.join(tile_dir, "cloud.ply"))
     expected_crs = out_crs or "epsg:32740"
     assert comments[-1] == "projection: CRS {}".format(expected_crs)
+
+
+def test_disp_to_xyz_threads():
+    """
+    Check that the C copies of the rpc models are built once, and that
+    triangulating disparity maps with several threads gives the same result
+    as with a single one.
+    """
+    rpc1 = rpcm.rpc_from_geotiff(data_path("input_pair/img_01.tif"))
+    rpc2 = rpcm.rpc_from_geotiff(data_path("input_pair/img_02.tif"))
+    assert triangulation.rpc_struct(rpc1) is triangulation.rpc_struct(rpc1)
+    assert triangulation.rpc_struct(rpc1) is not triangulation.rpc_struct(rpc1, delta=0.1)
+    assert bytes(triangulation.rpc_struct(copy.deepcopy(rpc1))) == bytes(triangulation.RPCStruct(rpc1))
+
+    rng = np.random.default_rng(0)
+    for x, y, w, h in [(500, 150, 40, 30), (600, 200, 25, 35)]:
+        H1 = np.array([[1, 0, -x], [0, 1, -y], [0, 0, 1]], dtype=float)
+        H2 = np.array([[1, 0, -x + 3], [0, 1, -y - 2], [0, 0, 1]], dtype=float)
+        p = dict(rpc1=rpc1, rpc2=rpc2, H1=H1, H2=H2,
+                 disp=rng.uniform(-2, 2, size=(h, w)),
+                 mask_rect=rng.random((h, w)) > 0.1,
+                 img_bbx=(x, x + w, y, y + h),
+                 mask_orig=np.ones((h, w), dtype=bool))
+        for out_crs in [None, geographiclib.pyproj_crs("epsg:32740")]:
+            xyz, err = triangulation.disp_to_xyz(**p, out_crs=out_crs, nb_threads=3)
+            expected_xyz, expected_err = triangulation.disp_to_xyz(**p, out_crs=out_crs)
+            np.testing.assert_array_equal(xyz, expected_xyz)
+            np.testing.assert_array_equal(err, expected_err)
+            assert np.isfinite(xyz).any()
+
+    # the multi-threaded 3D filtering gives the same result
+    filtered = [xyz.copy(), xyz.copy()]
+    for x, nb_threads in zip(filtered, [1, 3]):
+        triangulation.remove_isolated_3d_points(x, 0.5, 2, 4, nb_threads=nb_threads)
+    np.testing.assert_array_equal(filtered[0], filtered[1])